@@ -0,0 +1,131 @@
+import json
+import logging
+import logging.config
+import time
+from typing import List, Optional
+
+from hpc_provisioner.aws_queries import reconcile_subnet_pool
+from hpc_provisioner.cluster import Cluster, ClusterJSONEncoder
+from hpc_provisioner.constants import CREATOR_FUNCTION_NAME
+from hpc_provisioner.dynamodb_actions import (
+    AdmissionRequest,
+    get_admission_requests,
+    get_subnet_pool,
+    put_admission_request,
+    remove_admission_request,
+)
+from hpc_provisioner.logging_config import LOGGING_CONFIG
+from hpc_provisioner.utils import get_admission_policy
+
+FIFO = "fifo"
+VLAB_FAIR = "vlab_fair"
+ADMISSION_POLICIES = (FIFO, VLAB_FAIR)
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("hpc-resource-provisioner")
+
+
+class InvalidAdmissionPolicy(Exception):
+    """Raised when ADMISSION_POLICY is not one of ADMISSION_POLICIES"""
+
+
+def order_admission_requests(
+    requests: List[AdmissionRequest], policy: Optional[str] = None
+) -> List[AdmissionRequest]:
+    """
+    Sort queued cluster creations in the order they are to be dispatched.
+
+    fifo: oldest first.
+    vlab_fair: round robin over the vlabs, oldest first within a vlab, so a vlab queueing
+        many clusters cannot hold back the others.
+    """
+    policy = policy or get_admission_policy()
+    if policy not in ADMISSION_POLICIES:
+        raise InvalidAdmissionPolicy(f"Unknown admission policy {policy}")
+
+    fifo = sorted(requests, key=lambda request: (request.enqueued_at, request.cluster))
+    if policy == FIFO:
+        return fifo
+
+    ranks = {}
+    ranked = []
+    for request in fifo:
+        rank = ranks.get(request.vlab_id, 0)
+        ranks[request.vlab_id] = rank + 1
+        ranked.append((rank, request.enqueued_at, request.cluster, request))
+    return [request for *_, request in sorted(ranked, key=lambda entry: entry[:3])]
+
+
+def enqueue_cluster(dynamodb_client, cluster: Cluster, enqueued_at: Optional[int] = None) -> int:
+    """
+    Queue the creation of a cluster until a subnet is free.
+    A cluster that was dispatched before keeps its original enqueued_at, and thus its position.
+
+    Returns the cluster's (1-based) position in the queue.
+    """
+    request = AdmissionRequest(
+        cluster=cluster.name,
+        vlab_id=cluster.vlab_id,
+        cluster_spec=json.dumps(cluster, cls=ClusterJSONEncoder),
+        enqueued_at=enqueued_at or time.time_ns(),
+    )
+    if put_admission_request(dynamodb_client, request):
+        logger.info(f"Queued creation of cluster {cluster.name}")
+    return get_queue_position(dynamodb_client, cluster.name)
+
+
+def get_queue_position(dynamodb_client, cluster_name: str) -> Optional[int]:
+    """Get the (1-based) position of a cluster in the admission queue, or None if not queued"""
+    for position, request in enumerate(
+        order_admission_requests(get_admission_requests(dynamodb_client)), start=1
+    ):
+        if request.cluster == cluster_name:
+            return position
+    return None
+
+
+def dispatch_admission_queue(ec2_client, dynamodb_client, lambda_client) -> List[str]:
+    """
+    Hand queued cluster creations to the creator, as many as there are free subnets.
+
+    A request is removed from the queue before the creator is invoked, so that concurrent
+    dispatchers never dispatch it twice. Should more clusters be dispatched than there are
+    subnets after all, the creators that miss out put their cluster back in the queue,
+    at its original position.
+
+    Returns the dispatched clusters.
+    """
+    requests = get_admission_requests(dynamodb_client)
+    if not requests:
+        return []
+
+    pool = get_subnet_pool(dynamodb_client)
+    if pool is None or (not pool.free_subnets and pool.draining_subnets):
+        pool = reconcile_subnet_pool(ec2_client, dynamodb_client)
+    capacity = len(pool.free_subnets)
+    logger.debug(f"{len(requests)} queued clusters, {capacity} free subnets")
+
+    dispatched = []
+    for request in order_admission_requests(requests):
+        if len(dispatched) >= capacity:
+            break
+        if not remove_admission_request(dynamodb_client, request.cluster):
+            logger.debug(f"Cluster {request.cluster} was dispatched by someone else")
+            continue
+        try:
+            lambda_client.invoke_async(
+                FunctionName=CREATOR_FUNCTION_NAME,
+                InvokeArgs=json.dumps(
+                    {
+                        "cluster": json.loads(request.cluster_spec),
+                        "enqueued_at": request.enqueued_at,
+                    }
+                ),
+            )
+        except Exception:
+            put_admission_request(dynamodb_client, request)
+            raise
+        logger.info(f"Dispatched queued cluster {request.cluster}")
+        dispatched.append(request.cluster)
+
+    return dispatched
@@ -0,0 +1,107 @@
+import logging
+import logging.config
+import threading
+from typing import NamedTuple
+
+from hpc_provisioner.logging_config import LOGGING_CONFIG
+
+# Enough connections for the concurrent calls a single invocation makes,
+# kept alive so warm invocations can reuse them.
+MAX_POOL_CONNECTIONS = 20
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("hpc-resource-provisioner")
+
+
+class RetryPolicy(NamedTuple):
+    """
+    How a client retries throttled and transient errors, see botocore's retry modes.
+    Both modes back off exponentially with jitter; adaptive mode additionally rate limits
+    the client as soon as its service starts throttling it.
+    """
+
+    mode: str
+    max_attempts: int
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy(mode="standard", max_attempts=5)
+# The control plane APIs a burst of cluster creations throttles first. Clients are shared
+# by all threads of an invocation, so the adaptive rate limiter paces all of them together.
+# DynamoDB is on the subnet claim path and scales on demand: it only gets more attempts.
+SERVICE_RETRY_POLICIES = {
+    "cloudformation": RetryPolicy(mode="adaptive", max_attempts=10),
+    "ec2": RetryPolicy(mode="adaptive", max_attempts=10),
+    "secretsmanager": RetryPolicy(mode="adaptive", max_attempts=10),
+    "dynamodb": RetryPolicy(mode="standard", max_attempts=10),
+}
+
+
+def get_retry_policy(service_name: str) -> RetryPolicy:
+    return SERVICE_RETRY_POLICIES.get(service_name, DEFAULT_RETRY_POLICY)
+
+
+class ClientRegistry:
+    """
+    Process-wide boto3 session and clients, shared by all modules and threads.
+    boto3 is only imported when the first client is requested,
+    so code paths that don't talk to AWS stay cheap to import.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._clients = {}
+
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                import boto3  # noqa: PLC0415
+
+                self._session = boto3.session.Session()
+            return self._session
+
+    def client(self, service_name: str):
+        if client := self._clients.get(service_name):
+            return client
+
+        session = self.session()
+        with self._lock:
+            if service_name not in self._clients:
+                logger.debug(f"Creating {service_name} client")
+                self._clients[service_name] = session.client(
+                    service_name, config=self._client_config(service_name)
+                )
+            return self._clients[service_name]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._clients.clear()
+            self._session = None
+
+    @staticmethod
+    def _client_config(service_name: str):
+        from botocore.config import Config  # noqa: PLC0415
+
+        retry_policy = get_retry_policy(service_name)
+        return Config(
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+            tcp_keepalive=True,
+            retries={"mode": retry_policy.mode, "total_max_attempts": retry_policy.max_attempts},
+        )
+
+
+_registry = ClientRegistry()
+
+
+def get_client(service_name: str):
+    """
+    Return the shared boto3 client for service_name, creating it on first use.
+    boto3 clients are thread-safe, and reusing them across warm Lambda invocations
+    saves the client construction, endpoint resolution and TLS handshake.
+    """
+    return _registry.client(service_name)
+
+
+def reset_clients() -> None:
+    """Drop all cached clients and the session, e.g. after credentials or region changed"""
+    _registry.reset()
@@ -1,12 +1,15 @@
 import logging
 import logging.config
+import random
+import threading
 import time
-from typing import Optional
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
-import boto3
 from botocore.exceptions import ClientError
 
+from hpc_provisioner.aws_clients import get_client
 from hpc_provisioner.constants import (
+    AVAILABLE_IPS_IN_UNUSED_SUBNET,
     BILLING_TAG_KEY,
     BILLING_TAG_VALUE,
     PROJECT_TAG_KEY,
@@ -14,11 +17,22 @@ from hpc_provisioner.constants import (
 )
 from hpc_provisioner.dynamodb_actions import (
     SubnetAlreadyRegisteredException,
+    SubnetLeaseLostException,
+    SubnetPool,
+    SubnetPoolChangedException,
+    backfill_cluster_subnets,
+    bind_subnet,
+    claim_free_subnet,
     dynamodb_client,
-    free_subnet,
+    get_cluster_subnets,
+    get_expired_subnet_leases,
+    get_fsx_index_entry,
     get_registered_subnets,
-    get_subnet,
-    register_subnet,
+    get_subnet_pool,
+    put_fsx_index_entries,
+    put_subnet_pool,
+    release_subnet,
+    renew_subnet_lease,
 )
 from hpc_provisioner.logging_config import LOGGING_CONFIG
 
@@ -111,7 +125,16 @@ def get_efs(efs_client) -> str:
     """
     Get the ID for the EFS for pclusters
     """
-    file_systems = efs_client.describe_file_systems()["FileSystems"]
+    file_systems = []
+    marker = None
+    while True:
+        if marker:
+            response = efs_client.describe_file_systems(Marker=marker)
+        else:
+            response = efs_client.describe_file_systems()
+        file_systems.extend(response["FileSystems"])
+        if not (marker := response.get("NextMarker")):
+            break
     logger.debug(f"file systems found: {file_systems}")
     candidates = [
         fs for fs in file_systems if {"Key": "HPC_Goal", "Value": "compute_cluster"} in fs["Tags"]
@@ -141,168 +164,342 @@ def get_security_group(ec2_client) -> str:
 
 def release_subnets(cluster_name: str) -> None:
     client = dynamodb_client()
-    registered_subnets = get_registered_subnets(client)
-    claimed_subnets = [
-        subnet for subnet in registered_subnets if registered_subnets[subnet] == cluster_name
-    ]
+    claimed_subnets = get_cluster_subnets(client, cluster_name)
+    if claimed_subnets is None:
+        logger.debug(f"Cluster {cluster_name} is not indexed - looking for its claims")
+        registered_subnets = get_registered_subnets(client)
+        claimed_subnets = [
+            subnet for subnet in registered_subnets if registered_subnets[subnet] == cluster_name
+        ]
     logger.debug(f"Release subnets {claimed_subnets}")
     for subnet_id in claimed_subnets:
         logger.debug(f"Release subnet {subnet_id}")
-        free_subnet(client, subnet_id)
+        release_subnet(client, subnet_id, cluster_name)
+
+
+def bind_cluster_subnet(cluster_name: str, subnet_id: str) -> None:
+    """
+    Bind the subnet reserved for a cluster to its stack, once the stack exists
+    """
+    bind_subnet(dynamodb_client(), subnet_id, cluster_name)
+
+
+def sweep_subnet_leases(cf_client, dynamodb_client, now: Optional[int] = None) -> Dict[str, str]:
+    """
+    Deal with subnet reservations that outlived their lease, i.e. whose creator died:
+      * if the cluster's stack exists after all, bind the subnet to it
+      * otherwise, release the subnet, unless somebody renewed or bound it in the meantime
 
+    Returns the action taken for each subnet that was swept: "bound" or "released"
+    """
+    now = int(time.time()) if now is None else now
+    swept = {}
+    for subnet_id, cluster_name in get_expired_subnet_leases(dynamodb_client, now).items():
+        if stack_exists(cf_client, cluster_name):
+            logger.info(f"Stack {cluster_name} exists - binding expired subnet {subnet_id}")
+            try:
+                bind_subnet(dynamodb_client, subnet_id, cluster_name)
+            except SubnetLeaseLostException:
+                continue
+            swept[subnet_id] = "bound"
+        else:
+            logger.info(f"Stack {cluster_name} never appeared - releasing subnet {subnet_id}")
+            if release_subnet(dynamodb_client, subnet_id, cluster_name, expired_before=now):
+                swept[subnet_id] = "released"
+
+    return swept
 
-def claim_subnet(dynamodb_client, ec2_subnets: list, cluster_name: str) -> Optional[str]:
+
+def claim_subnet(dynamodb_client, cluster_name: str) -> str:
     """
     Tries to claim a subnet for the given cluster_name
-      * Check whether there are free subnets
-      * Find an unclaimed subnet
-      * Register it
-      * Read the DynamoDB entry we just wrote to ensure nobody claimed it just before us
+      * Return the subnet already claimed by the cluster according to the cluster index, if any
+      * Pick a subnet from the free pool
+      * Move it to the cluster in a transaction, which fails if anybody claimed it before us
       * Continue with another subnet if needed
+    Raises OutOfSubnetsException if the pool has no free subnet left.
     """
-    registered_subnets = get_registered_subnets(dynamodb_client)
-    logger.debug(f"Registered subnets: {registered_subnets}")
-    logger.debug(f"EC2 subnets: {ec2_subnets}")
-
     logger.info(f"Checking for existing claims for {cluster_name}")
-    claimed_subnets = [
-        subnet for subnet in registered_subnets if registered_subnets[subnet] == cluster_name
-    ]
+    claimed_subnets = sorted(get_cluster_subnets(dynamodb_client, cluster_name) or [])
     if claimed_subnets:
         claim = claimed_subnets.pop()
         logger.debug(f"Already claimed subnet {claim}")
         for claimed_subnet in claimed_subnets:
             logger.debug(f"Releasing subnet {claimed_subnet}")
-            free_subnet(dynamodb_client, claimed_subnet)
+            release_subnet(dynamodb_client, claimed_subnet, cluster_name)
+        # A previous creator may have died before the stack existed: start a fresh lease
+        renew_subnet_lease(dynamodb_client, claim, cluster_name)
 
         return claim
 
-    if len(registered_subnets) == len(ec2_subnets):
-        raise OutOfSubnetsException(
-            "All subnets are in use - either deploy more or remove some pclusters"
-        )
+    attempted = set()
+    while (pool := get_subnet_pool(dynamodb_client)) and (
+        candidates := pool.free_subnets - attempted
+    ):
+        # Spread concurrent claimers over the pool rather than all racing for the same subnet
+        subnet_id = random.choice(sorted(candidates))
+        attempted.add(subnet_id)
+        logger.debug(f"Trying to claim {subnet_id}")
+        try:
+            claim_free_subnet(dynamodb_client, subnet_id, cluster_name)
+        except SubnetAlreadyRegisteredException:
+            logger.debug("Subnet was claimed just before us - continuing")
+            continue
 
-    subnet_id = None
-    for subnet in ec2_subnets:
-        if subnet["SubnetId"] not in registered_subnets:
-            logger.debug(f"Trying to register {subnet['SubnetId']}")
+        logger.info(f"Subnet {subnet_id} claimed for cluster {cluster_name}")
+        return subnet_id
 
-            try:
-                register_subnet(dynamodb_client, subnet["SubnetId"], cluster_name)
-            except SubnetAlreadyRegisteredException:
-                logger.debug("Subnet was registered just before us - continuing")
-                continue
+    raise OutOfSubnetsException("Could not find a subnet")
 
-            check_subnet = get_subnet(dynamodb_client, subnet["SubnetId"])
 
-            claimed_cluster = check_subnet.get(subnet["SubnetId"])
-            if check_subnet and claimed_cluster and claimed_cluster == cluster_name:
-                logger.info(f"Subnet {subnet['SubnetId']} claimed for cluster {cluster_name}")
-                subnet_id = subnet["SubnetId"]
-                break
-            else:
-                logger.info(
-                    f"Subnet {subnet['SubnetId']} already claimed for cluster {claimed_cluster}"
-                )
+def get_compute_subnets(ec2_client) -> Dict[str, int]:
+    """
+    Return the number of available addresses of all subnets marked for compute_cluster
+    """
+    subnets = {}
+    kwargs = {"Filters": [{"Name": "tag:HPC_Goal", "Values": ["compute_cluster"]}]}
+    while True:
+        result = ec2_client.describe_subnets(**kwargs)
+        for subnet in result["Subnets"]:
+            subnets[subnet["SubnetId"]] = subnet["AvailableIpAddressCount"]
+        if not (next_token := result.get("NextToken")):
+            return subnets
+        kwargs["NextToken"] = next_token
+
+
+def reconcile_subnet_pool(ec2_client, dynamodb_client) -> SubnetPool:
+    """
+    Rebuild the subnet pool from the compute subnets in EC2 and the claims in DynamoDB.
+    An unclaimed subnet is free once all of its addresses are available, and draining until then.
+    Also indexes the claims of clusters that are missing from the cluster index.
+    """
+    while True:
+        pool = get_subnet_pool(dynamodb_client)
+        registered_subnets = get_registered_subnets(dynamodb_client)
+        # Clusters that claimed their subnets before the cluster index existed
+        backfill_cluster_subnets(dynamodb_client, registered_subnets)
+        unclaimed_subnets = {
+            subnet_id: available_ips
+            for subnet_id, available_ips in get_compute_subnets(ec2_client).items()
+            if subnet_id not in registered_subnets
+        }
+        free_subnets = frozenset(
+            subnet_id
+            for subnet_id, available_ips in unclaimed_subnets.items()
+            if available_ips == AVAILABLE_IPS_IN_UNUSED_SUBNET
+        )
+        draining_subnets = frozenset(unclaimed_subnets) - free_subnets
+        version = pool.version if pool else None
+        try:
+            put_subnet_pool(dynamodb_client, free_subnets, draining_subnets, version)
+        except SubnetPoolChangedException:
+            logger.debug("Subnet pool changed while rebuilding it - trying again")
+            continue
 
-    if not subnet_id:
-        raise OutOfSubnetsException("Could not find a subnet")
-    return subnet_id
+        logger.info(
+            f"Rebuilt subnet pool: {len(free_subnets)} free, {len(draining_subnets)} draining"
+        )
+        return SubnetPool(free_subnets, draining_subnets, (version or 0) + 1)
 
 
 def get_available_subnet(ec2_client, cluster_name: str) -> str:
     """
-    Check all subnets marked for compute_cluster, and pick one which is available
+    Claim a subnet from the pool of subnets marked for compute_cluster.
+    The pool is only rebuilt from EC2 when it has no free subnet left.
+    Raises OutOfSubnetsException if there is still none after that.
 
     Return the subnet_id
     """
 
-    ec2_subnets = ec2_client.describe_subnets(
-        Filters=[
-            {"Name": "tag:HPC_Goal", "Values": ["compute_cluster"]},
-            {"Name": "available-ip-address-count", "Values": ["251"]},
-        ]
-    )["Subnets"]
-
-    if not ec2_subnets:
-        raise OutOfSubnetsException()
-
     client = dynamodb_client()
-    subnet_id = None
-    while not subnet_id:
-        logger.debug("Trying to find a subnet until all subnets are claimed")
-        try:
-            subnet_id = claim_subnet(client, ec2_subnets, cluster_name)
-        except OutOfSubnetsException:
-            try:
-                logger.info("Could not find a subnet - waiting a few seconds and trying again")
-                time.sleep(10)
-                subnet_id = claim_subnet(client, ec2_subnets, cluster_name)
-            except OutOfSubnetsException:
-                logger.critical(
-                    "All subnets are in use - either deploy more or remove some pclusters"
-                )
-                raise
+    try:
+        return claim_subnet(client, cluster_name)
+    except OutOfSubnetsException:
+        # Released subnets may have drained by now, or the pool was never built
+        logger.info("No free subnet in the pool - rebuilding it")
+        reconcile_subnet_pool(ec2_client, client)
 
-    return subnet_id
+    try:
+        return claim_subnet(client, cluster_name)
+    except OutOfSubnetsException:
+        # The creator queues the cluster: it is dispatched again once a subnet frees up
+        logger.warning("All subnets are in use - either deploy more or remove some pclusters")
+        raise
 
 
 def remove_key(keypair_name: str) -> None:
-    ec2_client = boto3.client("ec2")
-    sm_client = boto3.client("secretsmanager")
+    ec2_client = get_client("ec2")
+    sm_client = get_client("secretsmanager")
     logger.debug(f"Deleting keypair {keypair_name} from EC2")
     client_delete = ec2_client.delete_key_pair(KeyName=keypair_name)
     logger.debug(f"Keypair deletion response: {client_delete}")
 
     logger.debug("Deleting secret from SecretsManager")
-    secret_delete = sm_client.delete_secret(SecretId=keypair_name, ForceDeleteWithoutRecovery=True)
+    try:
+        secret_delete = sm_client.delete_secret(
+            SecretId=keypair_name, ForceDeleteWithoutRecovery=True
+        )
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ResourceNotFoundException":
+            raise
+        # Deleting the keypair is idempotent on the EC2 side, make it so here too
+        logger.debug(f"Secret {keypair_name} was already deleted")
+        return
     logger.debug(f"Secret deletion response: {secret_delete}")
 
 
-def list_existing_stacks(cf_client):
-    statuses = [
-        "CREATE_IN_PROGRESS",
-        "CREATE_FAILED",
-        "CREATE_COMPLETE",
-        "ROLLBACK_IN_PROGRESS",
-        "ROLLBACK_FAILED",
-        "ROLLBACK_COMPLETE",
-        "DELETE_IN_PROGRESS",
-        "DELETE_FAILED",
-        "UPDATE_IN_PROGRESS",
-        "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
-        "UPDATE_COMPLETE",
-        "UPDATE_FAILED",
-        "UPDATE_ROLLBACK_IN_PROGRESS",
-        "UPDATE_ROLLBACK_FAILED",
-        "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
-        "UPDATE_ROLLBACK_COMPLETE",
-        "REVIEW_IN_PROGRESS",
-        "IMPORT_IN_PROGRESS",
-        "IMPORT_COMPLETE",
-        "IMPORT_ROLLBACK_IN_PROGRESS",
-        "IMPORT_ROLLBACK_FAILED",
-        "IMPORT_ROLLBACK_COMPLETE",
-    ]
-    stacks = cf_client.list_stacks(StackStatusFilter=statuses)
-    existing_stack_names = [
-        stack["StackName"] for stack in stacks["StackSummaries"] if "ParentId" not in stack
-    ]
+FSX_INDEX_TTL = 300  # seconds
+FSX_NEGATIVE_TTL = 30  # seconds
+FSX_LOCAL_TTL = 30  # seconds
+
+
+def get_stack_status(cf_client, stack_name: str) -> Optional[str]:
+    """
+    Get the status of a single stack with one DescribeStacks call.
+    Returns None if the stack does not exist (deleted stacks are not returned by name).
+    """
+    try:
+        stacks = cf_client.describe_stacks(StackName=stack_name)["Stacks"]
+    except ClientError as e:
+        if is_missing_stack_error(e):
+            logger.debug(f"Stack {stack_name} does not exist")
+            return None
+        raise
+
+    return stacks[0]["StackStatus"] if stacks else None
+
+
+def stack_exists(cf_client, stack_name: str) -> bool:
+    return get_stack_status(cf_client, stack_name) is not None
+
 
-    return existing_stack_names
+class StackPosition(NamedTuple):
+    """Where to resume listing stacks: a DescribeStacks page, and a stack within it"""
 
+    page_token: Optional[str]
+    index: int
 
-def get_fsx(fsx_client, fs_name: str) -> Optional[dict]:
-    go_on = True
+
+def list_stacks(
+    cf_client,
+    matches: Callable[[dict], bool],
+    limit: Optional[int] = None,
+    start: StackPosition = StackPosition(None, 0),
+) -> Tuple[List[dict], Optional[StackPosition]]:
+    """
+    List the existing stacks matches selects, as DescribeStacks describes them, from start on.
+    Stops after limit stacks, if given.
+
+    Returns the stacks, and the position to resume from, or None if all of them were listed.
+    """
+    stacks = []
+    page_token, index = start
+    while True:
+        kwargs = {"NextToken": page_token} if page_token else {}
+        page = cf_client.describe_stacks(**kwargs)
+        page_stacks = page.get("Stacks", [])
+        for position in range(index, len(page_stacks)):
+            if limit is not None and len(stacks) == limit:
+                return stacks, StackPosition(page_token, position)
+            if matches(page_stacks[position]):
+                stacks.append(page_stacks[position])
+        page_token, index = page.get("NextToken"), 0
+        if not page_token:
+            return stacks, None
+        if limit is not None and len(stacks) == limit:
+            return stacks, StackPosition(page_token, 0)
+
+
+def get_stack_tag(stack: dict, key: str) -> Optional[str]:
+    return next((tag["Value"] for tag in stack.get("Tags", []) if tag["Key"] == key), None)
+
+
+def is_missing_stack_error(error: ClientError) -> bool:
+    error_info = error.response.get("Error", {})
+    return error_info.get("Code") == "ValidationError" and "does not exist" in error_info.get(
+        "Message", ""
+    )
+
+
+def iter_file_systems(fsx_client) -> Iterator[dict]:
     next_token = None
-    while go_on:
+    while True:
         if next_token:
             file_systems = fsx_client.describe_file_systems(NextToken=next_token)
         else:
             file_systems = fsx_client.describe_file_systems()
-        for fs in file_systems["FileSystems"]:
-            if any([t["Value"] == fs_name for t in fs["Tags"] if t["Key"] == "Name"]):
-                return fs
+        yield from file_systems["FileSystems"]
         next_token = file_systems.get("NextToken")
-        go_on = next_token is not None
-    return None
+        if next_token is None:
+            return
+
+
+def get_fsx_name(fs: dict) -> Optional[str]:
+    return next((t["Value"] for t in fs.get("Tags", []) if t["Key"] == "Name"), None)
+
+
+class FsxIndex:
+    """
+    FSx name -> filesystem ID index.
+
+    Entries live in DynamoDB so all Lambda instances share them, and are kept in memory
+    for at most FSX_LOCAL_TTL seconds. A miss triggers a single bulk refresh of the whole
+    index; names that are still not found get a short-lived negative entry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[Optional[str], float]] = {}
+
+    def lookup(self, fsx_client, dynamodb_client, fsx_name: str) -> Optional[str]:
+        now = time.time()
+        if (entry := self._entries.get(fsx_name)) and entry[1] > now:
+            return entry[0]
+
+        stored = get_fsx_index_entry(dynamodb_client, fsx_name)
+        if stored and stored["expires_at"] > now:
+            self._remember({fsx_name: stored["fsx_id"]}, stored["expires_at"])
+            return stored["fsx_id"]
+
+        indexed = self.refresh(fsx_client, dynamodb_client)
+        if fsx_name not in indexed:
+            self.reset(dynamodb_client, fsx_name)
+        return indexed.get(fsx_name)
+
+    def refresh(self, fsx_client, dynamodb_client) -> Dict[str, str]:
+        """Rebuild the index from all FSx filesystems in the account"""
+        indexed = {}
+        for fs in iter_file_systems(fsx_client):
+            if (fsx_name := get_fsx_name(fs)) and fsx_name not in indexed:
+                indexed[fsx_name] = fs["FileSystemId"]
+        logger.debug(f"Indexed {len(indexed)} FSx filesystems")
+
+        expires_at = int(time.time()) + FSX_INDEX_TTL
+        put_fsx_index_entries(dynamodb_client, indexed, expires_at)
+        self._remember(indexed, expires_at)
+        return indexed
+
+    def reset(self, dynamodb_client, fsx_name: str) -> None:
+        """Store a negative entry for fsx_name, e.g. when its filesystem is about to be created"""
+        expires_at = int(time.time()) + FSX_NEGATIVE_TTL
+        put_fsx_index_entries(dynamodb_client, {fsx_name: None}, expires_at)
+        self._remember({fsx_name: None}, expires_at)
+
+    def _remember(self, entries: Dict[str, Optional[str]], expires_at: float) -> None:
+        local_expires_at = min(expires_at, time.time() + FSX_LOCAL_TTL)
+        with self._lock:
+            for fsx_name, fsx_id in entries.items():
+                self._entries[fsx_name] = (fsx_id, local_expires_at)
+
+
+fsx_index = FsxIndex()
+
+
+def get_fsx_id(fsx_client, fs_name: str) -> Optional[str]:
+    """Get the ID of the FSx filesystem called fs_name through the shared FSx index"""
+    return fsx_index.lookup(fsx_client, dynamodb_client(), fs_name)
+
+
+def reset_fsx_index_entry(fs_name: str) -> None:
+    """Forget any indexed filesystem for fs_name, until the next refresh finds a new one"""
+    fsx_index.reset(dynamodb_client(), fs_name)
@@ -2,6 +2,9 @@ import copy
 from json import JSONEncoder
 from typing import Optional
 
+# Also the name of the cluster's stack
+CLUSTER_NAME_PREFIX = "pcluster-"
+
 
 class ClusterJSONEncoder(JSONEncoder):
     def default(self, o):
@@ -43,7 +46,7 @@ class Cluster:
 
     @property
     def name(self):
-        return f"pcluster-{self.vlab_id}-{self.project_id}"
+        return f"{CLUSTER_NAME_PREFIX}{self.vlab_id}-{self.project_id}"
 
     @property
     def fsx_name(self):
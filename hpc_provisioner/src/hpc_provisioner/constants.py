@@ -8,6 +8,8 @@ BILLING_TAG_KEY = "SBO_Billing"
 BILLING_TAG_VALUE = "hpc:parallelcluster"
 AVAILABLE_IPS_IN_UNUSED_SUBNET = 251
 REGION = "us-east-1"  # TODO: don't hardcode?
+CREATOR_FUNCTION_NAME = "hpc-resource-provisioner-creator"
+DELETER_FUNCTION_NAME = "hpc-resource-provisioner-deleter"
 
 DEFAULTS = {
     "tier": "debug",
@@ -16,5 +18,3 @@ DEFAULTS = {
     "benchmark": "false",
     "include_lustre": "true",
 }
-
-CONFIG_VALUES = {}
@@ -0,0 +1,129 @@
+import logging
+import logging.config
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, Tuple
+
+from hpc_provisioner.aws_queries import get_efs, get_security_group
+from hpc_provisioner.logging_config import LOGGING_CONFIG
+from hpc_provisioner.utils import (
+    get_ami_id,
+    get_containers_bucket,
+    get_efa_security_group_id,
+    get_fsx_policy_arn,
+    get_infra_bucket,
+    get_sbonexusdata_bucket,
+    get_scratch_bucket,
+)
+
+# The security group and EFS only change when the deployment itself changes
+DEPLOYMENT_FACTS_TTL = 3600  # seconds
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("hpc-resource-provisioner")
+
+
+class InvalidDeploymentSettings(ValueError):
+    """Raised when the environment does not describe a complete deployment"""
+
+
+@dataclass(frozen=True)
+class DeploymentSettings:
+    """The environment-derived settings of this deployment"""
+
+    sbonexusdata_bucket: str
+    containers_bucket: str
+    infra_assets_bucket: str
+    scratch_bucket: str
+    efa_security_group_id: str
+    fsx_policy_arn: str
+    ami_id: str
+
+    @classmethod
+    def from_environment(cls) -> "DeploymentSettings":
+        """Read all settings, reporting every missing variable at once"""
+        getters = {
+            "sbonexusdata_bucket": get_sbonexusdata_bucket,
+            "containers_bucket": get_containers_bucket,
+            "infra_assets_bucket": get_infra_bucket,
+            "scratch_bucket": get_scratch_bucket,
+            "efa_security_group_id": get_efa_security_group_id,
+            "fsx_policy_arn": get_fsx_policy_arn,
+            "ami_id": get_ami_id,
+        }
+        values = {}
+        errors = []
+        for field, getter in getters.items():
+            try:
+                values[field] = getter()
+            except ValueError as e:
+                errors.append(str(e))
+
+        if errors:
+            raise InvalidDeploymentSettings(f"Invalid deployment settings: {', '.join(errors)}")
+
+        return cls(**values)
+
+    @property
+    def infra_assets_bucket_name(self) -> str:
+        return self.infra_assets_bucket.replace("s3://", "")
+
+    @property
+    def create_users_script(self) -> str:
+        return f"{self.infra_assets_bucket}/scripts/create_users.py"
+
+    @property
+    def environment_script(self) -> str:
+        return f"{self.infra_assets_bucket}/scripts/environment.sh"
+
+    @property
+    def cloudwatch_agent_script(self) -> str:
+        return f"{self.infra_assets_bucket}/scripts/80_cloudwatch_agent_config_prolog.sh"
+
+
+@lru_cache(maxsize=1)
+def get_deployment_settings() -> DeploymentSettings:
+    """
+    Return the deployment settings, read from the environment once per process.
+    Raises InvalidDeploymentSettings if the environment is incomplete.
+    """
+    return DeploymentSettings.from_environment()
+
+
+class DeploymentFacts:
+    """
+    Deployment resources discovered through AWS, cached for DEPLOYMENT_FACTS_TTL seconds.
+    Call invalidate() when they may have changed, e.g. when pcluster rejects a config.
+    """
+
+    def __init__(self, ttl: float = DEPLOYMENT_FACTS_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._facts: Dict[str, Tuple[Any, float]] = {}
+
+    def security_group_id(self, ec2_client) -> str:
+        return self._get("security_group_id", lambda: get_security_group(ec2_client))
+
+    def efs_id(self, efs_client) -> str:
+        return self._get("efs_id", lambda: get_efs(efs_client))
+
+    def invalidate(self) -> None:
+        logger.debug("Invalidating deployment facts")
+        with self._lock:
+            self._facts.clear()
+
+    def _get(self, fact: str, discover: Callable[[], Any]) -> Any:
+        with self._lock:
+            if (cached := self._facts.get(fact)) and cached[1] > time.monotonic():
+                return cached[0]
+
+        value = discover()
+        logger.debug(f"Discovered {fact}: {value}")
+        with self._lock:
+            self._facts[fact] = (value, time.monotonic() + self._ttl)
+        return value
+
+
+deployment_facts = DeploymentFacts()
@@ -1,11 +1,30 @@
 import logging
 import logging.config
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
 
-import boto3
+from botocore.exceptions import ClientError
 
+from hpc_provisioner.aws_clients import get_client
 from hpc_provisioner.logging_config import LOGGING_CONFIG
 
 TABLE_NAME = "sbo-parallelcluster-subnets"
+SUBNET_POOL_TABLE_NAME = "sbo-parallelcluster-subnet-pool"
+CLUSTER_SUBNETS_TABLE_NAME = "sbo-parallelcluster-cluster-subnets"
+SUBNET_POOL_ID = "compute_cluster"
+FSX_TABLE_NAME = "sbo-parallelcluster-fsx"
+ADMISSION_QUEUE_TABLE_NAME = "sbo-parallelcluster-admission-queue"
+RATE_LIMIT_TABLE_NAME = "sbo-parallelcluster-rate-limits"
+CLUSTERS_TABLE_NAME = "sbo-parallelcluster-clusters"
+BATCH_WRITE_SIZE = 25
+
+# A claimed subnet is reserved until its cluster's stack exists, and bound to the stack after.
+# Reservations that outlive their lease belong to a creator that died: see sweep_subnet_leases
+SUBNET_RESERVED = "reserved"
+SUBNET_BOUND = "bound"
+SUBNET_LEASE_SECONDS = 1800
 
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("hpc-resource-provisioner")
@@ -15,60 +34,805 @@ class SubnetAlreadyRegisteredException(Exception):
     "Raised when trying to register a subnet that already has a DB entry"
 
 
+class SubnetLeaseLostException(Exception):
+    "Raised when binding a subnet whose reservation was swept or released in the meantime"
+
+
+class SubnetPoolChangedException(Exception):
+    "Raised when the subnet pool was changed by someone else while rebuilding it"
+
+
+class TokenBucketChangedException(Exception):
+    "Raised when a token bucket was changed by someone else while taking tokens from it"
+
+
+@dataclass(frozen=True)
+class SubnetPool:
+    """
+    The unclaimed compute subnets.
+    Released subnets are draining until EC2 reports all their addresses as available again.
+    """
+
+    free_subnets: FrozenSet[str]
+    draining_subnets: FrozenSet[str]
+    version: int
+
+
+@dataclass(frozen=True)
+class AdmissionRequest:
+    """
+    A cluster creation waiting for a free subnet.
+    cluster_spec is the serialized Cluster, as passed to the creator.
+    """
+
+    cluster: str
+    vlab_id: str
+    cluster_spec: str
+    enqueued_at: int
+
+
+@dataclass(frozen=True)
+class TokenBucket:
+    """The tokens left in a rate limit bucket at refilled_at (epoch seconds)"""
+
+    tokens: float
+    refilled_at: float
+    version: int
+
+
+@dataclass(frozen=True)
+class ClusterRecord:
+    """
+    What the provisioner itself knows about a cluster.
+
+    cluster_status, head_node_ip, fsx_id and creation_time are a cache of the description,
+    as it was at refreshed_at (epoch seconds, 0 if never described).
+    description is the JSON of the whole description pcluster returned then.
+    fsx_id is None if it was not looked up, NO_FSX_ID if no filesystem was found.
+    Stack events keep cluster_status up to date: stack_event_at is the time of the last one.
+    teardown_status and updated_at track the teardown requested through DELETE.
+    failed_steps maps the steps that failed in its last attempt to their error.
+    """
+
+    cluster: str
+    vlab_id: str
+    project_id: str
+    cluster_status: Optional[str] = None
+    head_node_ip: Optional[str] = None
+    fsx_id: Optional[str] = None
+    creation_time: Optional[str] = None
+    description: Optional[str] = None
+    refreshed_at: int = 0
+    stack_event_at: int = 0
+    teardown_status: Optional[str] = None
+    updated_at: int = 0
+    attempts: int = 0
+    failed_steps: Optional[Dict[str, str]] = None
+
+
+# The fsx_id of a cluster record once it was looked up and no filesystem was found
+NO_FSX_ID = ""
+# The attributes of a cluster record that cache its description
+DESCRIPTION_ATTRIBUTES = (
+    "cluster_status",
+    "head_node_ip",
+    "fsx_id",
+    "creation_time",
+    "description",
+)
+# The optional string attributes of a cluster record, which are left out when unset
+_CLUSTER_RECORD_STRINGS = (
+    "cluster_status",
+    "head_node_ip",
+    "fsx_id",
+    "creation_time",
+    "description",
+    "teardown_status",
+)
+
+
 def dynamodb_client():
     """
     Return the DynamoDB boto3 client
     """
-    return boto3.client("dynamodb")
+    return get_client("dynamodb")
 
 
-def get_registered_subnets(dynamodb_client) -> dict:
+def _scan_claims(dynamodb_client, **kwargs) -> Iterator[Tuple[str, str]]:
     """
-    Get all registered subnets and the clusters they are registered to
+    Stream (subnet_id, cluster) for the registered subnets, following the scan pagination
     """
+    kwargs = {
+        "TableName": TABLE_NAME,
+        "ProjectionExpression": "subnet_id, #c",
+        "ConsistentRead": True,
+        **kwargs,
+        "ExpressionAttributeNames": {"#c": "cluster", **kwargs.get("ExpressionAttributeNames", {})},
+    }
+    while True:
+        result = dynamodb_client.scan(**kwargs)
+        for item in result["Items"]:
+            yield item["subnet_id"]["S"], item["cluster"]["S"]
+        if not (last_evaluated_key := result.get("LastEvaluatedKey")):
+            return
+        kwargs["ExclusiveStartKey"] = last_evaluated_key
 
-    result = dynamodb_client.scan(TableName=TABLE_NAME)
-    logger.debug(f"Registered subnets: {result}")
 
-    return {item["subnet_id"]["S"]: item["cluster"]["S"] for item in result["Items"]}
+def iter_registered_subnets(
+    dynamodb_client, segment: int = 0, total_segments: int = 1
+) -> Iterator[Tuple[str, str]]:
+    """
+    Stream (subnet_id, cluster) for all registered subnets, following the scan pagination.
+    With total_segments > 1, only the given segment of the table is read.
+    """
+    if total_segments > 1:
+        return _scan_claims(dynamodb_client, Segment=segment, TotalSegments=total_segments)
+    return _scan_claims(dynamodb_client)
 
 
-def get_subnet(dynamodb_client, subnet_id: str) -> dict:
-    logger.debug(f"Getting subnet {subnet_id}")
-    items = dynamodb_client.get_item(
-        TableName=TABLE_NAME,
-        Key={"subnet_id": {"S": subnet_id}},
-        ConsistentRead=True,
+def get_expired_subnet_leases(dynamodb_client, now: int) -> Dict[str, str]:
+    """
+    Get the reserved subnets whose lease expired before now, and the clusters holding them
+    """
+    return dict(
+        _scan_claims(
+            dynamodb_client,
+            FilterExpression="#s = :reserved AND lease_expires < :now",
+            ExpressionAttributeNames={"#s": "state"},
+            ExpressionAttributeValues={
+                ":reserved": {"S": SUBNET_RESERVED},
+                ":now": {"N": str(now)},
+            },
+        )
     )
 
-    logger.debug(f"Result: {items}")
-    item = items.get("Item", {})
 
-    return {item["subnet_id"]["S"]: item["cluster"]["S"]} if item else {}
+def get_registered_subnets(dynamodb_client, total_segments: int = 1) -> dict:
+    """
+    Get all registered subnets and the clusters they are registered to.
+    With total_segments > 1, the segments of the table are scanned in parallel.
+    """
+
+    if total_segments <= 1:
+        registered_subnets = dict(iter_registered_subnets(dynamodb_client))
+    else:
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            segments = executor.map(
+                lambda segment: dict(
+                    iter_registered_subnets(dynamodb_client, segment, total_segments)
+                ),
+                range(total_segments),
+            )
+            registered_subnets = {}
+            for segment_subnets in segments:
+                registered_subnets.update(segment_subnets)
+    logger.debug(f"Registered subnets: {registered_subnets}")
 
+    return registered_subnets
 
-def register_subnet(dynamodb_client, subnet_id: str, cluster: str) -> None:
+
+def is_conditional_check_failure(error: ClientError) -> bool:
+    return error.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+
+def _subnet_pool_key() -> dict:
+    return {"pool_id": {"S": SUBNET_POOL_ID}}
+
+
+def is_transaction_condition_failure(error: ClientError) -> bool:
+    return error.response.get("Error", {}).get("Code") == "TransactionCanceledException" and any(
+        reason.get("Code") == "ConditionalCheckFailed"
+        for reason in error.response.get("CancellationReasons", [])
+    )
+
+
+def get_subnet_pool(dynamodb_client) -> Optional[SubnetPool]:
+    """
+    Get the subnet pool, or None if it was never built
     """
-    Register a new subnet/parallel-cluster combination.
-    Will raise SubnetAlreadyRegisteredException if there is already an entry for the subnet
+    result = dynamodb_client.get_item(
+        TableName=SUBNET_POOL_TABLE_NAME, Key=_subnet_pool_key(), ConsistentRead=True
+    )
+    if not (item := result.get("Item")):
+        return None
+
+    return SubnetPool(
+        free_subnets=frozenset(item.get("free_subnets", {}).get("SS", [])),
+        draining_subnets=frozenset(item.get("draining_subnets", {}).get("SS", [])),
+        version=int(item["version"]["N"]),
+    )
+
+
+def put_subnet_pool(
+    dynamodb_client,
+    free_subnets: FrozenSet[str],
+    draining_subnets: FrozenSet[str],
+    expected_version: Optional[int],
+) -> None:
     """
+    Replace the subnet pool, provided nobody changed it since it was at expected_version.
+    expected_version None means the pool must not exist yet.
+    Will raise SubnetPoolChangedException otherwise.
+    """
+    item = {
+        **_subnet_pool_key(),
+        "version": {"N": str((expected_version or 0) + 1)},
+    }
+    # DynamoDB does not store empty sets
+    if free_subnets:
+        item["free_subnets"] = {"SS": sorted(free_subnets)}
+    if draining_subnets:
+        item["draining_subnets"] = {"SS": sorted(draining_subnets)}
+
+    if expected_version is None:
+        condition = {"ConditionExpression": "attribute_not_exists(pool_id)"}
+    else:
+        condition = {
+            "ConditionExpression": "version = :version",
+            "ExpressionAttributeValues": {":version": {"N": str(expected_version)}},
+        }
+
+    try:
+        dynamodb_client.put_item(TableName=SUBNET_POOL_TABLE_NAME, Item=item, **condition)
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        raise SubnetPoolChangedException() from e
+
 
-    logger.debug(f"Registering subnet {subnet_id} for cluster {cluster}")
-    if get_subnet(dynamodb_client, subnet_id):
+def claim_free_subnet(
+    dynamodb_client, subnet_id: str, cluster: str, lease_seconds: int = SUBNET_LEASE_SECONDS
+) -> None:
+    """
+    Move a subnet from the free pool to the given cluster, in a single transaction.
+    The subnet is reserved for lease_seconds, or until it is bound to the cluster's stack.
+    Will raise SubnetAlreadyRegisteredException if the subnet is no longer free.
+    """
+    logger.debug(f"Claiming free subnet {subnet_id} for cluster {cluster}")
+    try:
+        dynamodb_client.transact_write_items(
+            TransactItems=[
+                {
+                    "Update": {
+                        "TableName": SUBNET_POOL_TABLE_NAME,
+                        "Key": _subnet_pool_key(),
+                        "UpdateExpression": "DELETE free_subnets :subnet ADD version :one",
+                        "ConditionExpression": "contains(free_subnets, :subnet_id)",
+                        "ExpressionAttributeValues": {
+                            ":subnet": {"SS": [subnet_id]},
+                            ":subnet_id": {"S": subnet_id},
+                            ":one": {"N": "1"},
+                        },
+                    }
+                },
+                {
+                    "Put": {
+                        "TableName": TABLE_NAME,
+                        "Item": {
+                            "subnet_id": {"S": subnet_id},
+                            "cluster": {"S": cluster},
+                            "state": {"S": SUBNET_RESERVED},
+                            "lease_expires": {"N": str(int(time.time()) + lease_seconds)},
+                        },
+                        "ConditionExpression": "attribute_not_exists(subnet_id)",
+                    }
+                },
+                _cluster_subnets_update(cluster, subnet_id, "ADD"),
+            ]
+        )
+    except ClientError as e:
+        if not is_transaction_condition_failure(e):
+            raise
         logger.debug("Someone was faster")
-        raise SubnetAlreadyRegisteredException()
+        raise SubnetAlreadyRegisteredException() from e
+
+
+def release_subnet(
+    dynamodb_client, subnet_id: str, cluster: str, expired_before: Optional[int] = None
+) -> bool:
+    """
+    Delete the claim of cluster on a subnet and return the subnet to the pool, where it drains
+    until EC2 reports it as unused. Does nothing if the cluster no longer holds the subnet.
+    With expired_before, the subnet is only released if it is still reserved by a lease
+    that expired before then.
+
+    Returns whether the subnet was released.
+    """
+    logger.debug(f"Releasing subnet {subnet_id} of cluster {cluster}")
+    delete_claim = {
+        "Delete": {
+            "TableName": TABLE_NAME,
+            "Key": {"subnet_id": {"S": subnet_id}},
+            "ConditionExpression": "#c = :cluster",
+            "ExpressionAttributeNames": {"#c": "cluster"},
+            "ExpressionAttributeValues": {":cluster": {"S": cluster}},
+        }
+    }
+    if expired_before is not None:
+        delete = delete_claim["Delete"]
+        delete["ConditionExpression"] += " AND #s = :reserved AND lease_expires < :expired_before"
+        delete["ExpressionAttributeNames"]["#s"] = "state"
+        delete["ExpressionAttributeValues"][":reserved"] = {"S": SUBNET_RESERVED}
+        delete["ExpressionAttributeValues"][":expired_before"] = {"N": str(expired_before)}
+    return_to_pool = {
+        "Update": {
+            "TableName": SUBNET_POOL_TABLE_NAME,
+            "Key": _subnet_pool_key(),
+            "UpdateExpression": "ADD draining_subnets :subnet, version :one",
+            "ConditionExpression": "attribute_exists(pool_id)",
+            "ExpressionAttributeValues": {":subnet": {"SS": [subnet_id]}, ":one": {"N": "1"}},
+        }
+    }
+    unindex = _cluster_subnets_update(cluster, subnet_id, "DELETE")
+
+    try:
+        dynamodb_client.transact_write_items(TransactItems=[delete_claim, return_to_pool, unindex])
+        return True
+    except ClientError as e:
+        if not is_transaction_condition_failure(e):
+            raise
+        if e.response["CancellationReasons"][0].get("Code") == "ConditionalCheckFailed":
+            logger.debug(f"Subnet {subnet_id} is not held by cluster {cluster} - not releasing")
+            return False
+
+    # The pool does not exist yet, and will be built from EC2 and the remaining claims
+    logger.debug(f"Could not return subnet {subnet_id} to the pool")
+    try:
+        dynamodb_client.transact_write_items(TransactItems=[delete_claim, unindex])
+    except ClientError as e:
+        if not is_transaction_condition_failure(e):
+            raise
+        logger.debug(f"Subnet {subnet_id} is not held by cluster {cluster} - not releasing")
+        return False
+    return True
+
+
+def bind_subnet(dynamodb_client, subnet_id: str, cluster: str) -> None:
+    """
+    Bind a reserved subnet to the stack of its cluster, ending its lease.
+    Will raise SubnetLeaseLostException if the cluster no longer holds the subnet.
+    """
+    logger.debug(f"Binding subnet {subnet_id} to cluster {cluster}")
+    try:
+        dynamodb_client.update_item(
+            TableName=TABLE_NAME,
+            Key={"subnet_id": {"S": subnet_id}},
+            UpdateExpression="SET #s = :bound REMOVE lease_expires",
+            ConditionExpression="#c = :cluster",
+            ExpressionAttributeNames={"#c": "cluster", "#s": "state"},
+            ExpressionAttributeValues={
+                ":bound": {"S": SUBNET_BOUND},
+                ":cluster": {"S": cluster},
+            },
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        raise SubnetLeaseLostException(f"Subnet {subnet_id} is no longer held by {cluster}") from e
+
+
+def renew_subnet_lease(
+    dynamodb_client, subnet_id: str, cluster: str, lease_seconds: int = SUBNET_LEASE_SECONDS
+) -> None:
+    """
+    Extend the lease of a subnet reserved by cluster. Does nothing if it is bound already.
+    """
+    try:
+        dynamodb_client.update_item(
+            TableName=TABLE_NAME,
+            Key={"subnet_id": {"S": subnet_id}},
+            UpdateExpression="SET lease_expires = :lease_expires",
+            ConditionExpression="#c = :cluster AND #s = :reserved",
+            ExpressionAttributeNames={"#c": "cluster", "#s": "state"},
+            ExpressionAttributeValues={
+                ":lease_expires": {"N": str(int(time.time()) + lease_seconds)},
+                ":cluster": {"S": cluster},
+                ":reserved": {"S": SUBNET_RESERVED},
+            },
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.debug(f"Subnet {subnet_id} is not reserved by {cluster} - lease not renewed")
 
+
+def _cluster_subnets_update(cluster: str, subnet_id: str, action: str) -> dict:
+    """The transaction item adding a subnet to, or deleting it from, the subnets of a cluster"""
+    return {
+        "Update": {
+            "TableName": CLUSTER_SUBNETS_TABLE_NAME,
+            "Key": {"cluster": {"S": cluster}},
+            "UpdateExpression": f"{action} subnet_ids :subnet",
+            "ExpressionAttributeValues": {":subnet": {"SS": [subnet_id]}},
+        }
+    }
+
+
+def get_cluster_subnets(dynamodb_client, cluster: str) -> Optional[FrozenSet[str]]:
+    """
+    Get the subnets claimed by a cluster.
+    Returns None if the cluster is not indexed, i.e. it claimed its subnets before the index
+    existed and backfill_cluster_subnets has not run since.
+    """
+    result = dynamodb_client.get_item(
+        TableName=CLUSTER_SUBNETS_TABLE_NAME,
+        Key={"cluster": {"S": cluster}},
+        ConsistentRead=True,
+    )
+    if not (item := result.get("Item")):
+        return None
+
+    return frozenset(item.get("subnet_ids", {}).get("SS", []))
+
+
+def backfill_cluster_subnets(dynamodb_client, registered_subnets: Dict[str, str]) -> List[str]:
+    """
+    Index the subnets of clusters that are not indexed yet, from a subnet -> cluster mapping
+    as returned by get_registered_subnets. Clusters that are already indexed are left alone,
+    as their entry is kept up to date by every claim and release.
+
+    Returns the clusters that were indexed.
+    """
+    subnets_by_cluster: Dict[str, List[str]] = {}
+    for subnet_id, cluster in registered_subnets.items():
+        subnets_by_cluster.setdefault(cluster, []).append(subnet_id)
+
+    indexed = []
+    for cluster, subnet_ids in subnets_by_cluster.items():
+        try:
+            dynamodb_client.put_item(
+                TableName=CLUSTER_SUBNETS_TABLE_NAME,
+                Item={"cluster": {"S": cluster}, "subnet_ids": {"SS": sorted(subnet_ids)}},
+                ConditionExpression="attribute_not_exists(#c)",
+                ExpressionAttributeNames={"#c": "cluster"},
+            )
+        except ClientError as e:
+            if not is_conditional_check_failure(e):
+                raise
+            continue
+        logger.info(f"Indexed subnets {subnet_ids} of cluster {cluster}")
+        indexed.append(cluster)
+
+    return indexed
+
+
+def put_admission_request(dynamodb_client, request: AdmissionRequest) -> bool:
+    """
+    Add a cluster creation to the admission queue.
+    A cluster that is already queued keeps its original position: returns False in that case.
+    """
+    try:
+        dynamodb_client.put_item(
+            TableName=ADMISSION_QUEUE_TABLE_NAME,
+            Item={
+                "cluster": {"S": request.cluster},
+                "vlab_id": {"S": request.vlab_id},
+                "cluster_spec": {"S": request.cluster_spec},
+                "enqueued_at": {"N": str(request.enqueued_at)},
+            },
+            ConditionExpression="attribute_not_exists(#c)",
+            ExpressionAttributeNames={"#c": "cluster"},
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.debug(f"Cluster {request.cluster} is already queued")
+        return False
+    return True
+
+
+def get_admission_requests(dynamodb_client) -> List[AdmissionRequest]:
+    """
+    Get all queued cluster creations, in no particular order
+    """
+    kwargs = {"TableName": ADMISSION_QUEUE_TABLE_NAME, "ConsistentRead": True}
+    requests = []
+    while True:
+        result = dynamodb_client.scan(**kwargs)
+        requests.extend(
+            AdmissionRequest(
+                cluster=item["cluster"]["S"],
+                vlab_id=item["vlab_id"]["S"],
+                cluster_spec=item["cluster_spec"]["S"],
+                enqueued_at=int(item["enqueued_at"]["N"]),
+            )
+            for item in result["Items"]
+        )
+        if not (last_evaluated_key := result.get("LastEvaluatedKey")):
+            return requests
+        kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+
+def remove_admission_request(dynamodb_client, cluster: str) -> bool:
+    """
+    Take a cluster creation off the admission queue.
+    Returns False if it was not queued (anymore), e.g. because another dispatcher took it.
+    """
+    try:
+        dynamodb_client.delete_item(
+            TableName=ADMISSION_QUEUE_TABLE_NAME,
+            Key={"cluster": {"S": cluster}},
+            ConditionExpression="attribute_exists(#c)",
+            ExpressionAttributeNames={"#c": "cluster"},
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        return False
+    return True
+
+
+def get_token_bucket(dynamodb_client, bucket: str) -> Optional[TokenBucket]:
+    """
+    Get a rate limit bucket, or None if it was never used
+    """
+    result = dynamodb_client.get_item(
+        TableName=RATE_LIMIT_TABLE_NAME, Key={"bucket": {"S": bucket}}, ConsistentRead=True
+    )
+    if not (item := result.get("Item")):
+        return None
+
+    return TokenBucket(
+        tokens=float(item["tokens"]["N"]),
+        refilled_at=float(item["refilled_at"]["N"]),
+        version=int(item["version"]["N"]),
+    )
+
+
+def put_token_bucket(
+    dynamodb_client, bucket: str, tokens: float, refilled_at: float, expected_version: Optional[int]
+) -> None:
+    """
+    Replace a rate limit bucket, provided nobody changed it since it was at expected_version.
+    expected_version None means the bucket must not exist yet.
+    Will raise TokenBucketChangedException otherwise.
+    """
+    item = {
+        "bucket": {"S": bucket},
+        "tokens": {"N": f"{tokens:.6f}"},
+        "refilled_at": {"N": f"{refilled_at:.6f}"},
+        "version": {"N": str((expected_version or 0) + 1)},
+    }
+    if expected_version is None:
+        condition = {
+            "ConditionExpression": "attribute_not_exists(#b)",
+            "ExpressionAttributeNames": {"#b": "bucket"},
+        }
+    else:
+        condition = {
+            "ConditionExpression": "version = :version",
+            "ExpressionAttributeValues": {":version": {"N": str(expected_version)}},
+        }
+
+    try:
+        dynamodb_client.put_item(TableName=RATE_LIMIT_TABLE_NAME, Item=item, **condition)
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        raise TokenBucketChangedException() from e
+
+
+def put_cluster_record(
+    dynamodb_client, record: ClusterRecord, keep_teardown_since: Optional[int] = None
+) -> bool:
+    """
+    Store a cluster record, replacing the previous one.
+    With keep_teardown_since (epoch seconds), a previous record whose teardown was requested
+    at or after that time is kept instead.
+    Returns whether the record was stored.
+    """
+    item = {
+        "cluster": {"S": record.cluster},
+        "vlab_id": {"S": record.vlab_id},
+        "project_id": {"S": record.project_id},
+        "refreshed_at": {"N": str(record.refreshed_at)},
+        "stack_event_at": {"N": str(record.stack_event_at)},
+        "updated_at": {"N": str(record.updated_at)},
+        "attempts": {"N": str(record.attempts)},
+    }
+    for attribute in _CLUSTER_RECORD_STRINGS:
+        if (value := getattr(record, attribute)) is not None:
+            item[attribute] = {"S": value}
+    if record.failed_steps:
+        item["failed_steps"] = {
+            "M": {step: {"S": error} for step, error in record.failed_steps.items()}
+        }
+    condition = {}
+    if keep_teardown_since is not None:
+        condition = {
+            "ConditionExpression": "attribute_not_exists(teardown_status) OR updated_at < :since",
+            "ExpressionAttributeValues": {":since": {"N": str(keep_teardown_since)}},
+        }
+    try:
+        dynamodb_client.put_item(TableName=CLUSTERS_TABLE_NAME, Item=item, **condition)
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.debug(f"Kept the record of {record.cluster}, whose teardown was requested")
+        return False
+    return True
+
+
+def get_cluster_record(dynamodb_client, cluster: str) -> Optional[ClusterRecord]:
+    """Get the record of a cluster, or None if there is none"""
+    result = dynamodb_client.get_item(
+        TableName=CLUSTERS_TABLE_NAME, Key={"cluster": {"S": cluster}}, ConsistentRead=True
+    )
+    if not (item := result.get("Item")):
+        return None
+
+    failed_steps = item.get("failed_steps", {}).get("M")
+    return ClusterRecord(
+        cluster=item["cluster"]["S"],
+        vlab_id=item.get("vlab_id", {}).get("S", ""),
+        project_id=item.get("project_id", {}).get("S", ""),
+        refreshed_at=int(item.get("refreshed_at", {}).get("N", 0)),
+        stack_event_at=int(item.get("stack_event_at", {}).get("N", 0)),
+        updated_at=int(item.get("updated_at", {}).get("N", 0)),
+        attempts=int(item.get("attempts", {}).get("N", 0)),
+        failed_steps={step: error["S"] for step, error in failed_steps.items()}
+        if failed_steps
+        else None,
+        **{
+            attribute: item[attribute]["S"]
+            for attribute in _CLUSTER_RECORD_STRINGS
+            if attribute in item
+        },
+    )
+
+
+def update_cluster_description(
+    dynamodb_client, record: ClusterRecord, attributes: Tuple[str, ...] = DESCRIPTION_ATTRIBUTES
+) -> bool:
+    """
+    Store the cached description of a cluster, leaving its teardown as it is.
+    Only the given description attributes are stored: those unset in record are removed.
+
+    record.refreshed_at must be the time the cluster was described at: a description older
+    than the last stack event is not stored, as it may be missing the status change.
+    Returns whether the description was stored.
+    """
+    update = ["vlab_id = :vlab_id", "project_id = :project_id", "refreshed_at = :refreshed_at"]
+    values = {
+        ":vlab_id": {"S": record.vlab_id},
+        ":project_id": {"S": record.project_id},
+        ":refreshed_at": {"N": str(record.refreshed_at)},
+    }
+    removed = []
+    for attribute in attributes:
+        if (value := getattr(record, attribute)) is not None:
+            update.append(f"{attribute} = :{attribute}")
+            values[f":{attribute}"] = {"S": value}
+        else:
+            removed.append(attribute)
+    expression = "SET " + ", ".join(update)
+    if removed:
+        expression += " REMOVE " + ", ".join(removed)
+    try:
+        dynamodb_client.update_item(
+            TableName=CLUSTERS_TABLE_NAME,
+            Key={"cluster": {"S": record.cluster}},
+            UpdateExpression=expression,
+            ConditionExpression="attribute_not_exists(stack_event_at) "
+            "OR stack_event_at <= :refreshed_at",
+            ExpressionAttributeValues=values,
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.debug(f"Description of {record.cluster} is older than its last stack event")
+        return False
+    return True
+
+
+def update_cluster_stack_status(
+    dynamodb_client, cluster: str, cluster_status: str, event_at: int
+) -> bool:
+    """
+    Set the status of a cluster as reported by a stack event at event_at (epoch seconds).
+    The rest of the cached description is marked stale, to be refreshed on the next describe.
+
+    Only clusters with a record are updated, which leaves out other stacks with a similar name,
+    and events older than the last one applied are ignored.
+    Returns whether the record was updated.
+    """
+    try:
+        dynamodb_client.update_item(
+            TableName=CLUSTERS_TABLE_NAME,
+            Key={"cluster": {"S": cluster}},
+            UpdateExpression="SET cluster_status = :status, stack_event_at = :event_at, "
+            "refreshed_at = :never",
+            ConditionExpression="attribute_exists(#c) "
+            "AND (attribute_not_exists(stack_event_at) OR stack_event_at <= :event_at)",
+            ExpressionAttributeNames={"#c": "cluster"},
+            ExpressionAttributeValues={
+                ":status": {"S": cluster_status},
+                ":event_at": {"N": str(event_at)},
+                ":never": {"N": "0"},
+            },
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        return False
+    return True
+
+
+def update_teardown_status(
+    dynamodb_client,
+    cluster: str,
+    status: str,
+    failed_steps: Optional[Dict[str, str]] = None,
+    new_attempt: bool = False,
+) -> None:
+    """
+    Set the teardown status of a cluster record, and the steps that failed to get there, if any.
+    new_attempt counts one more attempt at reaching the status.
+    The cached description is marked stale, as the teardown changes the cluster.
+    """
+    update = "SET teardown_status = :status, updated_at = :now, refreshed_at = :never"
+    values = {
+        ":status": {"S": status},
+        ":now": {"N": str(int(time.time()))},
+        ":never": {"N": "0"},
+    }
+    if failed_steps:
+        update += ", failed_steps = :failed_steps"
+        values[":failed_steps"] = {
+            "M": {step: {"S": error} for step, error in failed_steps.items()}
+        }
+    if new_attempt:
+        update += " ADD attempts :one"
+        values[":one"] = {"N": "1"}
+    if not failed_steps:
+        update += " REMOVE failed_steps"
     dynamodb_client.update_item(
-        TableName=TABLE_NAME,
-        Key={"subnet_id": {"S": subnet_id}},
-        AttributeUpdates={"cluster": {"Value": {"S": cluster}}},
+        TableName=CLUSTERS_TABLE_NAME,
+        Key={"cluster": {"S": cluster}},
+        UpdateExpression=update,
+        ExpressionAttributeValues=values,
     )
 
 
-def free_subnet(dynamodb_client, subnet_id: str) -> None:
+def delete_cluster_record(dynamodb_client, cluster: str) -> None:
+    dynamodb_client.delete_item(TableName=CLUSTERS_TABLE_NAME, Key={"cluster": {"S": cluster}})
+
+
+def get_fsx_index_entry(dynamodb_client, fsx_name: str) -> Optional[dict]:
     """
-    Delete an entry, marking the subnet as available
+    Get the indexed FSx filesystem for fsx_name, as {"fsx_id": ..., "expires_at": ...}.
+    fsx_id is None for a negative entry (no filesystem with that name).
+    Returns None if fsx_name was never indexed.
     """
-    dynamodb_client.delete_item(
-        TableName="sbo-parallelcluster-subnets", Key={"subnet_id": {"S": subnet_id}}
+    result = dynamodb_client.get_item(
+        TableName=FSX_TABLE_NAME,
+        Key={"fsx_name": {"S": fsx_name}},
     )
+    if not (item := result.get("Item")):
+        return None
+
+    return {
+        "fsx_id": item["fsx_id"]["S"] if "fsx_id" in item else None,
+        "expires_at": int(item["expires_at"]["N"]),
+    }
+
+
+def put_fsx_index_entries(
+    dynamodb_client, entries: Dict[str, Optional[str]], expires_at: int
+) -> None:
+    """
+    Store fsx_name -> fsx_id entries, all expiring at expires_at (epoch seconds).
+    A None fsx_id stores a negative entry.
+    """
+    requests = []
+    for fsx_name, fsx_id in entries.items():
+        item = {"fsx_name": {"S": fsx_name}, "expires_at": {"N": str(expires_at)}}
+        if fsx_id:
+            item["fsx_id"] = {"S": fsx_id}
+        requests.append({"PutRequest": {"Item": item}})
+
+    for i in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = {FSX_TABLE_NAME: requests[i : i + BATCH_WRITE_SIZE]}
+        while pending:
+            result = dynamodb_client.batch_write_item(RequestItems=pending)
+            pending = result.get("UnprocessedItems")
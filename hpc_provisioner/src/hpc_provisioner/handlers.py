@@ -1,55 +1,167 @@
 import copy
+import dataclasses
+import hashlib
 import json
 import logging
 import logging.config
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http import HTTPStatus
 from importlib.metadata import version
+from typing import FrozenSet, Optional, Tuple
 
-import boto3
-from pcluster.api.errors import NotFoundException
-
+from hpc_provisioner.admission import dispatch_admission_queue, get_queue_position
+from hpc_provisioner.aws_clients import get_client
 from hpc_provisioner.aws_queries import (
     create_keypair,
-    get_fsx,
-    list_existing_stacks,
+    get_fsx_id,
+    stack_exists,
     store_private_key,
+    sweep_subnet_leases,
 )
-from hpc_provisioner.cluster import Cluster, ClusterJSONEncoder
+from hpc_provisioner.cluster import CLUSTER_NAME_PREFIX, Cluster, ClusterJSONEncoder
 from hpc_provisioner.constants import (
     BILLING_TAG_KEY,
     BILLING_TAG_VALUE,
+    CREATOR_FUNCTION_NAME,
     DEFAULTS,
+    DELETER_FUNCTION_NAME,
     PROJECT_TAG_KEY,
     VLAB_TAG_KEY,
 )
-from hpc_provisioner.utils import generate_public_key
+from hpc_provisioner.deployment import get_deployment_settings
+from hpc_provisioner.dynamodb_actions import (
+    DESCRIPTION_ATTRIBUTES,
+    NO_FSX_ID,
+    ClusterRecord,
+    delete_cluster_record,
+    dynamodb_client,
+    get_cluster_record,
+    put_cluster_record,
+    update_cluster_description,
+    update_cluster_stack_status,
+    update_teardown_status,
+)
+from hpc_provisioner.metrics import request_metrics, timed
+from hpc_provisioner.utils import generate_public_key, submit_with_context
 
 from .logging_config import LOGGING_CONFIG
 from .pcluster_manager import (
+    DELETE_COMPLETE,
+    DELETE_FAILED,
+    DELETE_REQUEST_RECEIVED,
     InvalidRequest,
+    is_description_fresh,
+    is_not_found,
     pcluster_create,
-    pcluster_delete,
     pcluster_describe,
     pcluster_list,
+    pcluster_release_resources,
+    pcluster_teardown,
+    stack_status_to_cluster_status,
 )
 
+# admin keypair pipeline, sim keypair pipeline and stack existence check
+CREATE_REQUEST_WORKERS = 3
+# API Gateway gives up on the Lambda after 29s, whatever the wait asked for
+MAX_DESCRIBE_WAIT = 25  # seconds
+# Left to answer once the wait is over
+DESCRIBE_WAIT_MARGIN = 2  # seconds
+DESCRIBE_WAIT_POLL_INTERVAL = 3  # seconds
+# The description fields the cluster record does not cache, nor its ETag: the presigned URL expires
+UNCACHED_FIELDS = frozenset(["clusterConfiguration"])
+MAX_LIST_LIMIT = 100
+
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("hpc-resource-provisioner")
 
 
 def pcluster_do_create_handler(event, _context=None):
     logger.debug(f"event: {event}, _context: {_context}")
+    # Fail before touching anything if the deployment is misconfigured
+    get_deployment_settings()
     cluster = Cluster.from_dict(event["cluster"])
 
     logger.debug(f"handler: create pcluster {cluster}")
-    pcluster_create(cluster)
+    with request_metrics("creator"):
+        pcluster_create(cluster, enqueued_at=event.get("enqueued_at"))
     logger.debug(f"created pcluster {cluster}")
 
 
+def pcluster_do_delete_handler(event, _context=None):
+    """
+    The teardown worker, invoked asynchronously by the DELETE endpoint.
+    Raises if the teardown failed, so that the invocation is retried.
+    """
+    logger.debug(f"event: {event}, _context: {_context}")
+    cluster = Cluster.from_dict(event["cluster"])
+
+    logger.debug(f"handler: delete pcluster {cluster}")
+    with request_metrics("deleter"):
+        pcluster_teardown(cluster)
+    logger.debug(f"deleted pcluster {cluster}")
+
+
+def subnet_sweeper_handler(event, _context=None):
+    """
+    Run on a schedule:
+    * reclaim subnets reserved by creators that died before their stack existed
+    * dispatch queued clusters to the subnets that drained since the last run
+    """
+    logger.debug(f"event: {event}, _context: {_context}")
+    with request_metrics("sweeper"):
+        with timed("sweep_subnet_leases"):
+            swept = sweep_subnet_leases(get_client("cloudformation"), dynamodb_client())
+        with timed("dispatch_admission_queue"):
+            dispatched = dispatch_admission_queue(
+                get_client("ec2"), dynamodb_client(), get_client("lambda")
+            )
+    logger.info(f"Swept subnets: {swept}, dispatched clusters: {dispatched}")
+    return {"swept": swept, "dispatched": dispatched}
+
+
+def stack_event_handler(event, _context=None):
+    """
+    Consume the CloudFormation stack status changes EventBridge delivers, and record the status
+    of the clusters whose stack changed, so that it moves without describe polling pcluster.
+    Events of other stacks are ignored.
+    """
+    logger.debug(f"event: {event}, _context: {_context}")
+    detail = event["detail"]
+    # arn:aws:cloudformation:<region>:<account>:stack/<stack name>/<stack uuid>
+    stack_name = detail["stack-id"].split(":", 5)[5].split("/")[1]
+    if not stack_name.startswith(CLUSTER_NAME_PREFIX):
+        logger.debug(f"Ignoring event of stack {stack_name}")
+        return {"cluster": None, "updated": False}
+
+    cluster_status = stack_status_to_cluster_status(detail["status-details"]["status"])
+    event_at = int(datetime.fromisoformat(event["time"].replace("Z", "+00:00")).timestamp())
+    with request_metrics("stack_events"):
+        with timed("update_cluster_record"):
+            updated = update_cluster_stack_status(
+                dynamodb_client(), stack_name, cluster_status, event_at
+            )
+    logger.info(f"Stack {stack_name} is {cluster_status} at {event['time']}, updated: {updated}")
+    return {"cluster": stack_name, "clusterStatus": cluster_status, "updated": updated}
+
+
 def pcluster_handler(event, _context=None):
     """
     * Check whether we have a GET, a POST or a DELETE method
     * Pass on to pcluster_*_handler
+    * Log the request's phase timings and summarize them in a Server-Timing header
     """
+    endpoint = " ".join(filter(None, [event.get("httpMethod"), event.get("path")])) or "unknown"
+    with request_metrics(endpoint) as metrics:
+        response = _route_request(event, _context)
+        if metrics.phases:
+            response.setdefault("headers", {})["Server-Timing"] = metrics.server_timing()
+
+    return response
+
+
+def _route_request(event, _context=None):
     if event.get("httpMethod"):
         if event["httpMethod"] == "GET":
             if event["path"] == "/hpc-provisioner/pcluster":
@@ -80,121 +192,488 @@ def pcluster_handler(event, _context=None):
 
 
 def pcluster_create_request_handler(event, _context=None):
-    """Request the creation of an HPC cluster for a given vlab_id and project_id"""
+    """
+    Request the creation of an HPC cluster for a given vlab_id and project_id
+
+    The admin and sim keypair pipelines and the stack existence check are independent,
+    so they run concurrently. Only the creator invocation has to wait for all of them.
+    """
 
     cluster = _get_vlab_query_params(event)
 
-    ec2_client = boto3.client("ec2")
-    sm_client = boto3.client("secretsmanager")
-    cf_client = boto3.client("cloudformation")
-
-    admin_ssh_keypair = create_keypair(
-        ec2_client,
-        cluster=cluster,
-        tags=[
-            {"Key": VLAB_TAG_KEY, "Value": cluster.vlab_id},
-            {"Key": PROJECT_TAG_KEY, "Value": cluster.project_id},
-            {"Key": BILLING_TAG_KEY, "Value": BILLING_TAG_VALUE},
-        ],
-    )
+    ec2_client = get_client("ec2")
+    sm_client = get_client("secretsmanager")
+    cf_client = get_client("cloudformation")
 
-    admin_user_secret = store_private_key(sm_client, cluster, admin_ssh_keypair)
+    with ThreadPoolExecutor(max_workers=CREATE_REQUEST_WORKERS) as executor:
+        admin_future = submit_with_context(
+            executor, _provision_keypair, ec2_client, sm_client, cluster
+        )
+        sim_future = submit_with_context(
+            executor, _provision_sim_keypair, ec2_client, sm_client, cluster
+        )
+        stack_exists_future = submit_with_context(executor, _stack_exists, cf_client, cluster.name)
+
+        admin_ssh_keypair, admin_user_secret = admin_future.result()
+        sim_user_ssh_keypair, sim_user_secret, sim_pubkey = sim_future.result()
+        cluster_stack_exists = stack_exists_future.result()
+    logger.debug(f"Created sim user keypair: {sim_user_ssh_keypair}")
 
     response = {
         "cluster": {
             "clusterName": cluster.name,
             "clusterStatus": "CREATE_REQUEST_RECEIVED",
+            "ssh_user": "sim",
+            "user_private_ssh_key_arn": sim_user_secret["ARN"],
+            "admin_private_ssh_key_arn": admin_user_secret["ARN"],
         }
     }
 
+    cluster.sim_pubkey = sim_pubkey
+    logger.debug(f"Cluster: {cluster}")
+
+    if cluster_stack_exists:
+        print(f"Stack {cluster.name} already exists - exiting")
+        return response_json(response)
+
     create_args = {
         "cluster": cluster,
     }
+    logger.debug(f"calling create lambda async with arguments {create_args}")
+    with timed("invoke_async"):
+        get_client("lambda").invoke_async(
+            FunctionName=CREATOR_FUNCTION_NAME,
+            InvokeArgs=json.dumps(create_args, cls=ClusterJSONEncoder),
+        )
+    logger.debug("called create lambda async")
 
-    sim_user_ssh_keypair = create_keypair(
-        ec2_client,
-        cluster,
-        tags=[
-            {"Key": VLAB_TAG_KEY, "Value": cluster.vlab_id},
-            {"Key": PROJECT_TAG_KEY, "Value": cluster.project_id},
-            {"Key": BILLING_TAG_KEY, "Value": BILLING_TAG_VALUE},
-        ],
-        keypair_user="sim",
-    )
-
-    sim_user_secret = store_private_key(sm_client, cluster, sim_user_ssh_keypair)
-    logger.debug(f"Created sim user keypair: {sim_user_ssh_keypair}")
+    return response_json(response)
 
-    response["cluster"]["ssh_user"] = "sim"
-    response["cluster"]["user_private_ssh_key_arn"] = sim_user_secret["ARN"]
-    response["cluster"]["admin_private_ssh_key_arn"] = admin_user_secret["ARN"]
 
-    if key_material := sm_client.get_secret_value(SecretId=sim_user_secret["ARN"]):
-        cluster.sim_pubkey = generate_public_key(key_material["SecretString"])
-    else:
-        raise RuntimeError(
-            f"Something went wrong retrieving the sim user private key: {sim_user_secret['ARN']}"
+def _provision_keypair(ec2_client, sm_client, cluster, keypair_user=None) -> Tuple[dict, dict]:
+    """Create (or look up) the keypair for keypair_user and store its private key"""
+    phase_user = keypair_user or "admin"
+    with timed(f"create_{phase_user}_keypair"):
+        keypair = create_keypair(
+            ec2_client,
+            cluster,
+            tags=[
+                {"Key": VLAB_TAG_KEY, "Value": cluster.vlab_id},
+                {"Key": PROJECT_TAG_KEY, "Value": cluster.project_id},
+                {"Key": BILLING_TAG_KEY, "Value": BILLING_TAG_VALUE},
+            ],
+            keypair_user=keypair_user,
         )
-    logger.debug(f"Cluster: {cluster}")
 
-    if cluster.name in list_existing_stacks(cf_client):
-        print(f"Stack {cluster.name} already exists - exiting")
-        return response_json(response)
+    with timed(f"store_{phase_user}_private_key"):
+        secret = store_private_key(sm_client, cluster, keypair)
 
-    logger.debug(f"calling create lambda async with arguments {create_args}")
-    boto3.client("lambda").invoke_async(
-        FunctionName="hpc-resource-provisioner-creator",
-        InvokeArgs=json.dumps(create_args, cls=ClusterJSONEncoder),
-    )
-    logger.debug("called create lambda async")
+    return keypair, secret
 
-    return response_json(response)
+
+def _provision_sim_keypair(ec2_client, sm_client, cluster) -> Tuple[dict, dict, str]:
+    keypair, secret = _provision_keypair(ec2_client, sm_client, cluster, "sim")
+    return keypair, secret, _get_public_key(sm_client, keypair, secret)
+
+
+def _stack_exists(cf_client, stack_name: str) -> bool:
+    with timed("stack_exists"):
+        return stack_exists(cf_client, stack_name)
+
+
+def _get_public_key(sm_client, ssh_keypair: dict, secret: dict) -> str:
+    """
+    Derive the public key from the private key.
+    A freshly created keypair already carries its key material, only an existing one
+    needs to be read back from SecretsManager.
+    """
+    if "KeyMaterial" in ssh_keypair:
+        return generate_public_key(ssh_keypair["KeyMaterial"])
+
+    with timed("get_secret_value"):
+        key_material = sm_client.get_secret_value(SecretId=secret["ARN"])
+    if not key_material:
+        raise RuntimeError(
+            f"Something went wrong retrieving the sim user private key: {secret['ARN']}"
+        )
+    return generate_public_key(key_material["SecretString"])
 
 
 def pcluster_describe_handler(event, _context=None):
-    """Describe a cluster given the vlab_id and project_id"""
+    """
+    Describe a cluster given the vlab_id and project_id.
+    The description is served from the cluster record while it is fresh, see description_ttl.
+
+    Descriptions carry an ETag: a request whose If-None-Match still matches gets a 304.
+    A wait parameter holds the request for up to that many seconds, until the description
+    changes, see _wait_for_change.
+    """
     try:
         cluster = _get_vlab_query_params(event)
     except InvalidRequest:
-        logger.debug("No vlab_id specified - listing pclusters")
-        pc_output = pcluster_list()
+        logger.debug("No vlab_id and project_id specified - listing pclusters")
+        try:
+            list_params = _get_list_params(event)
+            with timed("list_clusters"):
+                pc_output = pcluster_list(**list_params)
+        except InvalidRequest as e:
+            return response_json({"message": str(e)}, code=400)
+        return response_json(pc_output)
+
+    try:
+        wait = _get_wait(event, _context)
+    except InvalidRequest as e:
+        return response_json({"message": str(e)}, code=400)
+    fields = _get_fields(event)
+    known_etags = _get_if_none_match(event)
+    response = _describe_cluster(cluster, fields)
+    if wait:
+        response = _wait_for_change(cluster, fields, response, known_etags, time.time() + wait)
+    if response["statusCode"] == HTTPStatus.OK and _etag_matches(
+        response["headers"]["ETag"], known_etags
+    ):
+        return {
+            "statusCode": HTTPStatus.NOT_MODIFIED,
+            "headers": {"ETag": response["headers"]["ETag"]},
+            "body": "",
+        }
+    return response
+
+
+def _describe_cluster(cluster: Cluster, fields: Optional[FrozenSet[str]] = None):
+    """
+    The description of a single cluster, as a response with its ETag.
+    Only the lookups the requested fields need are made: all of them if fields is None.
+    """
+    client = dynamodb_client()
+    with timed("get_cluster_record"):
+        record = get_cluster_record(client, cluster.name)
+    if (
+        record
+        and record.description
+        and is_description_fresh(record, time.time())
+        and (fields is None or not fields & UNCACHED_FIELDS)
+    ):
+        logger.debug(f"describe pcluster {cluster} from its record")
+        pc_output = _cached_description(record)
+        if _wants(fields, "clusterFsxId"):
+            pc_output["clusterFsxId"] = _recorded_fsx_id(client, cluster, record)
     else:
         logger.debug(f"describe pcluster {cluster}")
+        described_at = int(time.time())
         try:
-            pc_output = pcluster_describe(cluster)
+            with timed("describe_cluster"):
+                pc_output = pcluster_describe(cluster)
             pc_output["vlab_id"] = cluster.vlab_id
             pc_output["project_id"] = cluster.project_id
-            fsx_client = boto3.client("fsx")
-            if cluster_fsx := get_fsx(
-                fsx_client=fsx_client,
-                fs_name=cluster.fsx_name,
-            ):
-                pc_output["clusterFsxId"] = cluster_fsx["FileSystemId"]
-            else:
-                pc_output["clusterFsxId"] = None
+            if _wants(fields, "clusterFsxId"):
+                pc_output["clusterFsxId"] = _lookup_fsx_id(cluster)
             logger.debug(f"described pcluster {cluster}")
-        except NotFoundException as e:
-            return response_json({"message": e.content.message}, code=404)
         except Exception as e:
+            if is_not_found(e):
+                return (
+                    _describe_queued_cluster(cluster, fields)
+                    or _describe_deleted_cluster(client, cluster, record, fields)
+                    or response_json({"message": e.content.message}, code=404)
+                )
             return response_json({"message": str(type(e))}, code=500)
+        # An FSx ID that was not looked up is kept, unless none was found: it may exist by now
+        attributes = DESCRIPTION_ATTRIBUTES
+        if "clusterFsxId" not in pc_output and record and record.fsx_id:
+            attributes = tuple(attribute for attribute in attributes if attribute != "fsx_id")
+        with timed("update_cluster_record"):
+            update_cluster_description(
+                client, _description_record(cluster, pc_output, described_at), attributes
+            )
+    if (
+        _wants(fields, "teardown")
+        and record
+        and record.teardown_status not in {None, DELETE_COMPLETE}
+    ):
+        pc_output["teardown"] = _teardown_progress(record)
+
+    return _description_response(pc_output, fields)
+
+
+def _wants(fields: Optional[FrozenSet[str]], field: str) -> bool:
+    return fields is None or field in fields
+
+
+def _get_fields(event) -> Optional[FrozenSet[str]]:
+    """The description fields asked for with fields=a,b,c, or None for all of them"""
+    value = _get_param(event, "fields")
+    if not value:
+        return None
+    return frozenset(field.strip() for field in value.split(",") if field.strip())
+
+
+def _lookup_fsx_id(cluster: Cluster) -> Optional[str]:
+    fsx_client = get_client("fsx")
+    with timed("get_fsx"):
+        return get_fsx_id(fsx_client=fsx_client, fs_name=cluster.fsx_name)
+
+
+def _recorded_fsx_id(client, cluster: Cluster, record: ClusterRecord) -> Optional[str]:
+    """
+    The FSx ID of a cluster as its record caches it.
+    It is only looked up if it never was since the description was cached, and then stored.
+    """
+    if record.fsx_id is not None:
+        return record.fsx_id or None
+    fsx_id = _lookup_fsx_id(cluster)
+    with timed("update_cluster_record"):
+        update_cluster_description(
+            client, dataclasses.replace(record, fsx_id=fsx_id or NO_FSX_ID), ("fsx_id",)
+        )
+    return fsx_id
 
-    return response_json(pc_output)
+
+def _description_response(description: dict, fields: Optional[FrozenSet[str]] = None) -> dict:
+    """The response with the requested fields of description, and its ETag"""
+    if fields is not None:
+        description = {field: value for field, value in description.items() if field in fields}
+    response = response_json(description)
+    response["headers"]["ETag"] = _description_etag(description)
+    return response
+
+
+def _wait_for_change(
+    cluster: Cluster,
+    fields: Optional[FrozenSet[str]],
+    response: dict,
+    known_etags: FrozenSet[str],
+    deadline,
+):
+    """
+    Describe the cluster again until it changed from what the client knows, or until deadline.
+    The client knows the descriptions whose ETag it sent, or else the one it is about to get.
+    Errors are returned straight away.
+    """
+    if response["statusCode"] == HTTPStatus.OK and not known_etags:
+        known_etags = frozenset([response["headers"]["ETag"].removeprefix("W/")])
+    while time.time() + DESCRIBE_WAIT_POLL_INTERVAL <= deadline:
+        if response["statusCode"] != HTTPStatus.OK:
+            break
+        if not _etag_matches(response["headers"]["ETag"], known_etags):
+            break
+        with timed("wait"):
+            time.sleep(DESCRIBE_WAIT_POLL_INTERVAL)
+        response = _describe_cluster(cluster, fields)
+    return response
+
+
+def _get_param(event, name: str) -> Optional[str]:
+    """A parameter given in the event itself, or in its query string"""
+    return event.get(name) or (event.get("queryStringParameters") or {}).get(name)
+
+
+def _get_list_params(event) -> dict:
+    """
+    The clusters to list: those of vlab_id, in one of the comma-separated statuses,
+    at most limit of them, after next_token
+    """
+    params = {
+        "vlab_id": _get_param(event, "vlab_id"),
+        "next_token": _get_param(event, "next_token"),
+    }
+    if status := _get_param(event, "status"):
+        params["statuses"] = frozenset(s.strip() for s in status.split(",") if s.strip())
+    if limit := _get_param(event, "limit"):
+        try:
+            params["limit"] = int(limit)
+        except ValueError:
+            raise InvalidRequest(f"limit must be a positive number, got {limit}")
+        if params["limit"] < 1:
+            raise InvalidRequest(f"limit must be a positive number, got {limit}")
+        params["limit"] = min(params["limit"], MAX_LIST_LIMIT)
+    return params
+
+
+def _get_wait(event, context=None) -> float:
+    """
+    The number of seconds the client is willing to wait for a change, as far as the time left
+    to this Lambda and API Gateway allow
+    """
+    value = _get_param(event, "wait")
+    if not value:
+        return 0
+    try:
+        wait = int(value)
+    except ValueError:
+        raise InvalidRequest(f"wait must be a number of seconds, got {value}")
+    if wait < 0:
+        raise InvalidRequest(f"wait must be a number of seconds, got {value}")
+    wait = min(wait, MAX_DESCRIBE_WAIT)
+    if context is not None:
+        wait = min(wait, context.get_remaining_time_in_millis() / 1000 - DESCRIBE_WAIT_MARGIN)
+    return max(wait, 0)
+
+
+def _description_etag(description: dict) -> str:
+    """
+    A weak ETag over the description, which is the same whether it was served from
+    the cluster record or by pcluster: the UNCACHED_FIELDS are left out
+    """
+    cached = {field: value for field, value in description.items() if field not in UNCACHED_FIELDS}
+    digest = hashlib.sha256(json.dumps(cached, sort_keys=True).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def _get_if_none_match(event) -> FrozenSet[str]:
+    """The ETags in the If-None-Match header, without their weakness indicator"""
+    headers = {name.lower(): value for name, value in (event.get("headers") or {}).items()}
+    etags = (headers.get("if-none-match") or "").split(",")
+    return frozenset(etag.strip().removeprefix("W/") for etag in etags if etag.strip())
+
+
+def _etag_matches(etag: str, known_etags: FrozenSet[str]) -> bool:
+    """Weak comparison, as If-None-Match calls for"""
+    return "*" in known_etags or etag.removeprefix("W/") in known_etags
+
+
+def _description_record(cluster: Cluster, pc_output: dict, described_at: int) -> ClusterRecord:
+    """The parts of a fresh description worth caching in the cluster record"""
+    return ClusterRecord(
+        cluster=cluster.name,
+        vlab_id=cluster.vlab_id,
+        project_id=cluster.project_id,
+        cluster_status=pc_output.get("clusterStatus"),
+        head_node_ip=pc_output.get("headNode", {}).get("privateIpAddress"),
+        fsx_id=(pc_output["clusterFsxId"] or NO_FSX_ID) if "clusterFsxId" in pc_output else None,
+        creation_time=pc_output.get("creationTime"),
+        # The FSx ID is cached on its own, as it is not always looked up
+        description=json.dumps(
+            {
+                field: value
+                for field, value in pc_output.items()
+                if field not in UNCACHED_FIELDS and field != "clusterFsxId"
+            }
+        ),
+        refreshed_at=described_at,
+    )
+
+
+def _cached_description(record: ClusterRecord) -> dict:
+    """
+    The description cached in the cluster record, as pcluster returned it.
+    Only the UNCACHED_FIELDS are left out.
+    """
+    return json.loads(record.description)
+
+
+def _describe_queued_cluster(cluster: Cluster, fields: Optional[FrozenSet[str]] = None):
+    """A cluster that does not exist yet may be waiting in the admission queue for a subnet"""
+    with timed("get_queue_position"):
+        position = get_queue_position(dynamodb_client(), cluster.name)
+    if position is None:
+        return None
+    description = {
+        "clusterName": cluster.name,
+        "clusterStatus": "QUEUED",
+        "queuePosition": position,
+        "vlab_id": cluster.vlab_id,
+        "project_id": cluster.project_id,
+    }
+    return _description_response(description, fields)
+
+
+def _describe_deleted_cluster(
+    client,
+    cluster: Cluster,
+    record: Optional[ClusterRecord],
+    fields: Optional[FrozenSet[str]] = None,
+):
+    """
+    A cluster that no longer exists may have a recorded teardown.
+    A record that only caches its description is outdated, and dropped.
+    """
+    if record is None:
+        return None
+    if record.teardown_status is None:
+        delete_cluster_record(client, cluster.name)
+        return None
+    description = {
+        "clusterName": cluster.name,
+        "clusterStatus": record.teardown_status,
+        "vlab_id": cluster.vlab_id,
+        "project_id": cluster.project_id,
+        "teardown": _teardown_progress(record),
+    }
+    return _description_response(description, fields)
+
+
+def _teardown_progress(record: ClusterRecord) -> dict:
+    progress = {
+        "status": record.teardown_status,
+        "attempts": record.attempts,
+        "updated_at": record.updated_at,
+    }
+    if record.failed_steps:
+        progress["failed_steps"] = record.failed_steps
+    return progress
 
 
 def pcluster_delete_handler(event, _context=None):
-    """Delete a cluster given the vlab_id and project_id"""
+    """
+    Request the deletion of a cluster given the vlab_id and project_id.
+    The teardown itself runs in the deleter: describe reports its progress.
+    """
     cluster = _get_vlab_query_params(event)
-
     logger.debug(f"delete pcluster {cluster}")
+
+    client = dynamodb_client()
     try:
-        pc_output = pcluster_delete(cluster)
-        logger.debug(f"deleted pcluster {cluster.vlab_id}-{cluster.project_id}")
-    except NotFoundException as e:
-        return {"statusCode": 404, "body": e.content.message}
+        with timed("stack_exists"):
+            cluster_stack_exists = stack_exists(get_client("cloudformation"), cluster.name)
+        if not cluster_stack_exists:
+            with timed("get_queue_position"):
+                queued = get_queue_position(client, cluster.name) is not None
+            if not queued:
+                # Nothing for the deleter to do, but what a failed creator may have left behind
+                pcluster_release_resources(cluster)
+                return response_json(
+                    {"message": f"Cluster {cluster.name} does not exist"}, code=404
+                )
+
+        with timed("put_cluster_record"):
+            put_cluster_record(
+                client,
+                ClusterRecord(
+                    cluster=cluster.name,
+                    vlab_id=cluster.vlab_id,
+                    project_id=cluster.project_id,
+                    teardown_status=DELETE_REQUEST_RECEIVED,
+                    updated_at=int(time.time()),
+                ),
+            )
     except Exception as e:
-        return {"statusCode": 500, "body": str(type(e))}
+        logger.exception(f"Could not request the deletion of {cluster.name}")
+        return response_json({"message": str(e)}, code=500)
 
-    return response_json(pc_output)
+    try:
+        with timed("invoke_async"):
+            get_client("lambda").invoke_async(
+                FunctionName=DELETER_FUNCTION_NAME,
+                InvokeArgs=json.dumps({"cluster": cluster}, cls=ClusterJSONEncoder),
+            )
+    except Exception as e:
+        logger.exception(f"Could not invoke the deleter for {cluster.name}")
+        # The teardown won't run: don't let describe report it as requested
+        try:
+            update_teardown_status(
+                client,
+                cluster.name,
+                DELETE_FAILED,
+                failed_steps={"invoke_deleter": f"{type(e).__name__}: {e}"},
+            )
+        except Exception:
+            logger.exception(f"Could not record the failed deletion of {cluster.name}")
+        return response_json({"message": str(e)}, code=500)
+    logger.debug("called delete lambda async")
+
+    return response_json(
+        {"cluster": {"clusterName": cluster.name, "clusterStatus": DELETE_REQUEST_RECEIVED}}
+    )
 
 
 def _get_vlab_query_params(incoming_event) -> Cluster:
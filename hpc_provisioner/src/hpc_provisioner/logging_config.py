@@ -1,13 +1,30 @@
 LOGGING_CONFIG = {
     "version": 1,
     "disable_existing_loggers": False,
-    "formatters": {"fmt": {"format": "[%(asctime)s] [%(levelname)s] %(msg)s"}},
+    "formatters": {
+        "fmt": {"format": "[%(asctime)s] [%(levelname)s] %(msg)s"},
+        "raw": {"format": "%(message)s"},
+    },
     "handlers": {
         "sh": {
             "class": "logging.StreamHandler",
             "level": "DEBUG",
             "formatter": "fmt",
         },
+        # CloudWatch only picks up Embedded Metric Format documents without any prefix
+        "metrics": {
+            "class": "logging.StreamHandler",
+            "level": "INFO",
+            "formatter": "raw",
+            "stream": "ext://sys.stdout",
+        },
+    },
+    "loggers": {
+        "hpc-resource-provisioner": {"level": "DEBUG", "handlers": ["sh"]},
+        "hpc-resource-provisioner.metrics": {
+            "level": "INFO",
+            "handlers": ["metrics"],
+            "propagate": False,
+        },
     },
-    "loggers": {"hpc-resource-provisioner": {"level": "DEBUG", "handlers": ["sh"]}},
 }
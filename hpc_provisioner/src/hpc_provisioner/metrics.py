@@ -0,0 +1,107 @@
+import json
+import logging
+import logging.config
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from hpc_provisioner.logging_config import LOGGING_CONFIG
+
+METRICS_NAMESPACE = "HPCResourceProvisioner"
+TOTAL_PHASE = "total"
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("hpc-resource-provisioner")
+metrics_logger = logging.getLogger("hpc-resource-provisioner.metrics")
+
+_current_metrics: ContextVar[Optional["RequestMetrics"]] = ContextVar(
+    "current_metrics", default=None
+)
+
+
+class RequestMetrics:
+    """
+    Phase durations for a single request, in milliseconds.
+    A phase that runs more than once is reported as the sum of its runs.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._phases: Dict[str, float] = {}
+
+    def record(self, phase: str, duration_ms: float) -> None:
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0.0) + duration_ms
+
+    @property
+    def phases(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._phases)
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def server_timing(self) -> str:
+        """Render the phases as a Server-Timing header value"""
+        timings = {**self.phases, TOTAL_PHASE: self.total_ms()}
+        return ", ".join(f"{phase};dur={duration:.1f}" for phase, duration in timings.items())
+
+    def emf(self) -> dict:
+        """Render the phases as a CloudWatch Embedded Metric Format document"""
+        timings = {**self.phases, TOTAL_PHASE: self.total_ms()}
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["Endpoint"]],
+                        "Metrics": [{"Name": phase, "Unit": "Milliseconds"} for phase in timings],
+                    }
+                ],
+            },
+            "Endpoint": self.endpoint,
+            **{phase: round(duration, 1) for phase, duration in timings.items()},
+        }
+
+    def emit(self) -> None:
+        metrics_logger.info(json.dumps(self.emf()))
+
+
+@contextmanager
+def request_metrics(endpoint: str) -> Iterator[RequestMetrics]:
+    """
+    Collect phase timings for everything that runs inside this block,
+    and log them as an EMF line when it exits.
+    """
+    metrics = RequestMetrics(endpoint)
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+        metrics.emit()
+
+
+def current_metrics() -> Optional[RequestMetrics]:
+    return _current_metrics.get()
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """
+    Time the enclosed block as `phase` of the current request.
+    Outside of request_metrics this only costs a context variable lookup.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics := _current_metrics.get():
+            duration_ms = (time.perf_counter() - start) * 1000
+            metrics.record(phase, duration_ms)
+            logger.debug(f"{phase} took {duration_ms:.1f} ms")
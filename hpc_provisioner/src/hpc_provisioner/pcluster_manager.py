@@ -2,49 +2,86 @@
 # This is the top-level script to create a Parallel Cluster
 # It requires the `base_system` terraform to have been applied. If not it will error out.
 
+import base64
 import json
 import logging
 import logging.config
-import pathlib
+import os
 import tempfile
-from typing import List, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional
 
-import boto3
 import yaml
-from botocore.client import ClientError
-from pcluster import lib as pc
-from pcluster.api.errors import CreateClusterBadRequestException, InternalServiceException
+from botocore.exceptions import ClientError
 
+from hpc_provisioner.admission import enqueue_cluster
+from hpc_provisioner.aws_clients import get_client
 from hpc_provisioner.aws_queries import (
+    OutOfSubnetsException,
+    StackPosition,
+    bind_cluster_subnet,
     get_available_subnet,
-    get_efs,
     get_keypair_name,
-    get_security_group,
+    get_stack_tag,
+    list_stacks,
     release_subnets,
     remove_key,
+    reset_fsx_index_entry,
+    stack_exists,
 )
 from hpc_provisioner.cluster import Cluster
 from hpc_provisioner.constants import (
     BILLING_TAG_KEY,
     BILLING_TAG_VALUE,
-    CONFIG_VALUES,
     PCLUSTER_CONFIG_TPL,
     PCLUSTER_DEV_CONFIG_TPL,
     PROJECT_TAG_KEY,
     REGION,
     VLAB_TAG_KEY,
 )
-from hpc_provisioner.logging_config import LOGGING_CONFIG
-from hpc_provisioner.utils import (
-    get_ami_id,
-    get_containers_bucket,
-    get_efa_security_group_id,
-    get_fsx_policy_arn,
-    get_infra_bucket,
-    get_sbonexusdata_bucket,
-    get_scratch_bucket,
+from hpc_provisioner.deployment import deployment_facts, get_deployment_settings
+from hpc_provisioner.dynamodb_actions import (
+    ClusterRecord,
+    dynamodb_client,
+    put_cluster_record,
+    remove_admission_request,
+    update_teardown_status,
 )
-from hpc_provisioner.yaml_loader import load_yaml_extended
+from hpc_provisioner.logging_config import LOGGING_CONFIG
+from hpc_provisioner.metrics import timed
+from hpc_provisioner.rate_limiter import CREATE_CLUSTER_COSTS, acquire_tokens
+from hpc_provisioner.utils import submit_with_context
+from hpc_provisioner.yaml_loader import RenderContext, compile_template, render_template
+
+# The progress of a teardown, as recorded in the cluster record
+DELETE_REQUEST_RECEIVED = "DELETE_REQUEST_RECEIVED"
+DELETE_IN_PROGRESS = "DELETE_IN_PROGRESS"
+DELETE_FAILED = "DELETE_FAILED"
+DELETE_COMPLETE = "DELETE_COMPLETE"
+
+# How long a cached description is served before pcluster is asked again.
+# Clusters in transition are polled for their next status, settled ones rarely change,
+# nor do clusters whose status changes are reported by stack events.
+TRANSITION_DESCRIPTION_TTL = 15  # seconds
+SETTLED_DESCRIPTION_TTL = 300  # seconds
+
+# The tags pcluster puts on the stacks it creates, image stacks being the ones with an image ID
+PCLUSTER_VERSION_TAG = "parallelcluster:version"
+PCLUSTER_IMAGE_ID_TAG = "parallelcluster:image_id"
+
+# The stack statuses pcluster reports as a different cluster status, the others are the same
+STACK_STATUS_CLUSTER_STATUS = {
+    "ROLLBACK_IN_PROGRESS": "CREATE_FAILED",
+    "ROLLBACK_FAILED": "CREATE_FAILED",
+    "ROLLBACK_COMPLETE": "CREATE_FAILED",
+    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS": "UPDATE_IN_PROGRESS",
+    "UPDATE_ROLLBACK_IN_PROGRESS": "UPDATE_IN_PROGRESS",
+    "UPDATE_ROLLBACK_FAILED": "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS": "UPDATE_IN_PROGRESS",
+    "UPDATE_ROLLBACK_COMPLETE": "UPDATE_FAILED",
+}
 
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("hpc-resource-provisioner")
@@ -58,44 +95,75 @@ class InvalidRequest(Exception):
     """When the request is invalid, likely due to invalid or missing data"""
 
 
+class TeardownError(Exception):
+    """Steps of a cluster teardown failed: errors maps each failed step to its error"""
+
+    def __init__(self, errors: Dict[str, Exception]):
+        self.errors = errors
+        super().__init__(
+            "Teardown failed: " + ", ".join(f"{step}: {error!r}" for step, error in errors.items())
+        )
+
+
+def __getattr__(name):
+    # Importing pcluster.lib takes more than a second, and most requests never need it.
+    # Keep `pcluster_manager.pc` available, but only import it on first use.
+    if name == "pc":
+        return _pcluster_lib()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _pcluster_lib():
+    from pcluster import lib as pc  # noqa: PLC0415
+
+    return pc
+
+
 def populate_config(
     cluster: Cluster,
     create_users_args: Optional[List[str]] = None,
-) -> None:
+) -> RenderContext:
     """
-    populate config values for loading cluster config yaml
+    Gather the config values for rendering the cluster config yaml
 
-    :param cluster_name: name of the cluster
+    :param cluster: the cluster to render the config for
     :param create_users_args: arguments to create_users.py
+    :return: an immutable render context, only used for this cluster
     """
-    ec2_client = boto3.client("ec2")
-    efs_client = boto3.client("efs")
-    # base_security_group_id and efs_id should be fairly static and change only if
-    # something changes about the deployment.
+    settings = get_deployment_settings()
+    ec2_client = get_client("ec2")
+    efs_client = get_client("efs")
+    # base_security_group_id and efs_id only change if something changes about the deployment,
+    # so they are cached - see DeploymentFacts.
     # base_subnet_id is where the interesting stuff happens
-    CONFIG_VALUES["base_subnet_id"] = get_available_subnet(ec2_client, cluster.name)
-    CONFIG_VALUES["base_security_group_id"] = get_security_group(ec2_client)
-    CONFIG_VALUES["efs_id"] = get_efs(efs_client)
-    CONFIG_VALUES["ssh_key"] = cluster.admin_ssh_key_name
-    CONFIG_VALUES["sbonexusdata_bucket"] = get_sbonexusdata_bucket()
-    CONFIG_VALUES["containers_bucket"] = get_containers_bucket()
-    CONFIG_VALUES["fsx_policy_arn"] = get_fsx_policy_arn()
+    config_values = {
+        "base_subnet_id": get_available_subnet(ec2_client, cluster.name),
+        "base_security_group_id": deployment_facts.security_group_id(ec2_client),
+        "efs_id": deployment_facts.efs_id(efs_client),
+        "ssh_key": cluster.admin_ssh_key_name,
+        "sbonexusdata_bucket": settings.sbonexusdata_bucket,
+        "containers_bucket": settings.containers_bucket,
+        "fsx_policy_arn": settings.fsx_policy_arn,
+        "efa_security_group_id": settings.efa_security_group_id,
+        "environment_args": [cluster.name],
+        "ami_id": settings.ami_id,
+        "infra_assets_bucket": settings.infra_assets_bucket_name,
+        "create_users_script": settings.create_users_script,
+        "environment_script": settings.environment_script,
+        "lustre_name": cluster.fsx_name,
+    }
     if cluster.benchmark:
-        CONFIG_VALUES["scratch_bucket"] = get_scratch_bucket()
+        config_values["scratch_bucket"] = settings.scratch_bucket
     else:
-        CONFIG_VALUES["scratch_bucket"] = "/".join(
-            [get_scratch_bucket(), cluster.vlab_id, cluster.project_id]
+        config_values["scratch_bucket"] = "/".join(
+            [settings.scratch_bucket, cluster.vlab_id, cluster.project_id]
         )
-    CONFIG_VALUES["efa_security_group_id"] = get_efa_security_group_id()
     if create_users_args:
-        CONFIG_VALUES["create_users_args"] = create_users_args
-    CONFIG_VALUES["environment_args"] = [cluster.name]
-    CONFIG_VALUES["ami_id"] = get_ami_id()
-    CONFIG_VALUES["infra_assets_bucket"] = get_infra_bucket().replace("s3://", "")
-    CONFIG_VALUES["create_users_script"] = f"{get_infra_bucket()}/scripts/create_users.py"
-    CONFIG_VALUES["environment_script"] = f"{get_infra_bucket()}/scripts/environment.sh"
-    CONFIG_VALUES["lustre_name"] = cluster.fsx_name
-    logger.debug(f"Config values: {CONFIG_VALUES}")
+        config_values["create_users_args"] = create_users_args
+
+    render_context = RenderContext(config_values)
+    logger.debug(f"Config values: {render_context}")
+    return render_context
 
 
 def populate_tags(pcluster_config: dict, vlab_id: str, project_id: str) -> list:
@@ -109,26 +177,20 @@ def populate_tags(pcluster_config: dict, vlab_id: str, project_id: str) -> list:
 
 
 def cluster_already_exists(cluster_name: str) -> bool:
-    try:
-        cloudformation_client = boto3.client("cloudformation")
-        cloudformation_client.describe_stacks(StackName=cluster_name)
+    if stack_exists(get_client("cloudformation"), cluster_name):
         logger.debug(f"Stack {cluster_name} already exists - nothing to do")
         return True
-    except ClientError:
-        logger.debug(f"Stack {cluster_name} does not exist yet - creating")
-        return False
+    logger.debug(f"Stack {cluster_name} does not exist yet - creating")
+    return False
 
 
-def load_pcluster_config(dev: bool) -> dict:
+def load_pcluster_config(dev: bool, render_context: RenderContext) -> dict:
     if dev:
         pcluster_config_path = PCLUSTER_DEV_CONFIG_TPL
     else:
         pcluster_config_path = PCLUSTER_CONFIG_TPL
-    with open(pcluster_config_path, "r") as f:
-        logger.debug(f"Loading config {pcluster_config_path} with CONFIG_VALUES {CONFIG_VALUES}")
-        pcluster_config = load_yaml_extended(f, CONFIG_VALUES)
-
-    return pcluster_config
+    logger.debug(f"Rendering config {pcluster_config_path} with {render_context}")
+    return render_template(compile_template(pcluster_config_path), render_context)
 
 
 def get_tier_config(pcluster_config: dict, chosen_tier: str) -> list:
@@ -144,20 +206,36 @@ def get_tier_config(pcluster_config: dict, chosen_tier: str) -> list:
     return queues
 
 
-def write_config(cluster_name: str, pcluster_config: dict) -> str:
-    output_file = f"deployment-{cluster_name}.yaml"
-    output_file = tempfile.NamedTemporaryFile(delete=False)
+# The C emitter is much faster for the large queue configs, but may not be compiled in
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
 
-    logger.debug(f"Writing pcluster config to {output_file.name}")
-    with open(output_file.name, "w") as out:
-        yaml.dump(pcluster_config, out, sort_keys=False)
 
+def dump_config(pcluster_config: dict) -> str:
     logger.debug(f"pcluster config is {pcluster_config}")
+    return yaml.dump(pcluster_config, Dumper=YamlDumper, sort_keys=False)
+
+
+@contextmanager
+def in_memory_config(config_content: str) -> Iterator[str]:
+    """
+    Hold the serialized config in an anonymous in-memory file for as long as the context
+    is open, and yield a path pcluster can read it from.
+    """
+    if not hasattr(os, "memfd_create"):
+        # Only Linux has anonymous in-memory files; fall back to a temporary file elsewhere
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+            f.write(config_content)
+            f.flush()
+            yield f.name
+        return
 
-    return output_file.name
+    with os.fdopen(os.memfd_create("pcluster-config"), "w") as f:
+        f.write(config_content)
+        f.flush()
+        yield f"/proc/self/fd/{f.fileno()}"
 
 
-def pcluster_create(cluster: Cluster):
+def pcluster_create(cluster: Cluster, enqueued_at: Optional[int] = None):
     """Create a pcluster for a given vlab
 
     Args:
@@ -165,14 +243,17 @@ def pcluster_create(cluster: Cluster):
         project_id: The id of the project within the vlab
         options: a dict of user provided options.
             All possible options can be seen in DEFAULTS.
+        enqueued_at: when the cluster was first queued, if it was dispatched from the
+            admission queue
 
+    If no subnet is available, the cluster is queued instead of created.
     """
     logger.info(f"Creating pcluster: {cluster}")
 
-    if cluster_already_exists(cluster.name):
-        return
+    with timed("cluster_already_exists"):
+        if cluster_already_exists(cluster.name):
+            return
 
-    fsx_client = boto3.client("fsx")
     cluster_users = json.dumps(
         [
             {
@@ -189,9 +270,17 @@ def pcluster_create(cluster: Cluster):
         f"--users={cluster_users}",
     ]
 
-    populate_config(cluster=cluster, create_users_args=create_users_args)
-
-    pcluster_config = load_pcluster_config(cluster.dev)
+    with timed("populate_config"):
+        try:
+            render_context = populate_config(cluster=cluster, create_users_args=create_users_args)
+        except OutOfSubnetsException:
+            with timed("enqueue_cluster"):
+                position = enqueue_cluster(dynamodb_client(), cluster, enqueued_at)
+            logger.warning(f"No subnet available for {cluster.name} - queued at {position}")
+            return None
+
+    with timed("load_template"):
+        pcluster_config = load_pcluster_config(cluster.dev, render_context)
     pcluster_config["Tags"] = populate_tags(pcluster_config, cluster.vlab_id, cluster.project_id)
     pcluster_config["Scheduling"]["SlurmQueues"] = get_tier_config(pcluster_config, cluster.tier)
     if cluster.include_lustre is False:
@@ -199,46 +288,262 @@ def pcluster_create(cluster: Cluster):
     if cluster.benchmark:
         pcluster_config["HeadNode"]["CustomActions"]["OnNodeConfigured"]["Sequence"].append(
             {
-                "Script": f"{get_infra_bucket()}/scripts/80_cloudwatch_agent_config_prolog.sh",
+                "Script": get_deployment_settings().cloudwatch_agent_script,
                 "Args": [cluster.name],
             }
         )
 
-    output_file_name = write_config(cluster.name, pcluster_config)
+    with timed("dump_config"):
+        config_content = dump_config(pcluster_config)
 
+    from pcluster.api.errors import (  # noqa: PLC0415
+        CreateClusterBadRequestException,
+        InternalServiceException,
+    )
+
+    # create_cluster makes a burst of calls: keep all creators together within the API quotas
+    acquire_tokens(dynamodb_client(), CREATE_CLUSTER_COSTS)
+
+    created_at = int(time.time())
     try:
         logger.debug("Actual create_cluster command")
-        return pc.create_cluster(
-            cluster_name=cluster.name,
-            cluster_configuration=output_file_name,
-            rollback_on_failure=False,
+        with in_memory_config(config_content) as config_path, timed("create_cluster"):
+            create_response = _pcluster_lib().create_cluster(
+                cluster_name=cluster.name,
+                cluster_configuration=config_path,
+                rollback_on_failure=False,
+            )
+        # The stack exists now, so the subnet can no longer be swept as a leaked reservation
+        with timed("bind_subnet"):
+            bind_cluster_subnet(cluster.name, render_context["base_subnet_id"])
+        # A previous cluster with the same name may still be indexed with its old filesystem,
+        # and recorded with its old description and teardown.
+        # The new record lets stack events update the cluster's status. A DELETE may have
+        # come in since the stack exists: its teardown is kept.
+        reset_fsx_index_entry(cluster.fsx_name)
+        put_cluster_record(
+            dynamodb_client(),
+            ClusterRecord(
+                cluster=cluster.name, vlab_id=cluster.vlab_id, project_id=cluster.project_id
+            ),
+            keep_teardown_since=created_at,
         )
+        return create_response
     except CreateClusterBadRequestException as e:
         logger.critical(f"Exception: {e.content}")
+        # The cached security group or EFS may no longer be valid
+        deployment_facts.invalidate()
         raise
     except InternalServiceException as e:
         logger.critical(f"Exception: {e.content}")
         raise
-    finally:
-        logger.debug("Cleaning up temporary config file")
-        pathlib.Path(output_file_name).unlink()
-        logger.debug("Cleaned up temporary config file")
 
 
-def pcluster_list():
-    """List the existing pclusters"""
-    return pc.list_clusters(region=REGION)
+def pcluster_list(
+    vlab_id: Optional[str] = None,
+    statuses: Optional[FrozenSet[str]] = None,
+    limit: Optional[int] = None,
+    next_token: Optional[str] = None,
+) -> dict:
+    """
+    List the existing pclusters the way pcluster does, only those of vlab_id and in one of
+    statuses if given. Clusters are selected by their stack's tags and status, before any of
+    them is summarized.
+
+    With a limit, at most that many are listed, and the nextToken returned lists the next ones.
+    Raises InvalidRequest for a next_token that was not returned by a previous list.
+    """
+
+    def matches(stack: dict) -> bool:
+        # Like pcluster: top-level stacks it created, for clusters rather than images
+        if (
+            stack.get("ParentId")
+            or not get_stack_tag(stack, PCLUSTER_VERSION_TAG)
+            or get_stack_tag(stack, PCLUSTER_IMAGE_ID_TAG)
+        ):
+            return False
+        if vlab_id and get_stack_tag(stack, VLAB_TAG_KEY) != vlab_id:
+            return False
+        return not statuses or stack_status_to_cluster_status(stack["StackStatus"]) in statuses
+
+    start = _decode_list_token(next_token) if next_token else StackPosition(None, 0)
+    try:
+        stacks, next_position = list_stacks(get_client("cloudformation"), matches, limit, start)
+    except ClientError as e:
+        # CloudFormation rejects page tokens it did not hand out
+        if start.page_token and e.response.get("Error", {}).get("Code") == "ValidationError":
+            raise InvalidRequest(f"Invalid next_token {next_token}") from e
+        raise
+    result = {"clusters": [_cluster_summary(stack) for stack in stacks]}
+    if next_position:
+        result["nextToken"] = _encode_list_token(next_position)
+    return result
+
+
+def _cluster_summary(stack: dict) -> dict:
+    """The summary pcluster lists a cluster with"""
+    parameters = {
+        parameter["ParameterKey"]: parameter["ParameterValue"]
+        for parameter in stack.get("Parameters", [])
+    }
+    return {
+        "clusterName": stack["StackName"],
+        "cloudformationStackStatus": stack["StackStatus"],
+        "cloudformationStackArn": stack["StackId"],
+        "region": REGION,
+        "version": get_stack_tag(stack, PCLUSTER_VERSION_TAG),
+        "clusterStatus": stack_status_to_cluster_status(stack["StackStatus"]),
+        "scheduler": {"type": parameters.get("Scheduler")},
+    }
+
+
+def _encode_list_token(position: StackPosition) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(position)).encode()).decode()
+
+
+def _decode_list_token(next_token: str) -> StackPosition:
+    try:
+        page_token, index = json.loads(base64.urlsafe_b64decode(next_token.encode()))
+    except (TypeError, ValueError):
+        raise InvalidRequest(f"Invalid next_token {next_token}")
+    if not (page_token is None or isinstance(page_token, str)) or not (
+        isinstance(index, int) and not isinstance(index, bool) and index >= 0
+    ):
+        raise InvalidRequest(f"Invalid next_token {next_token}")
+    return StackPosition(page_token, index)
 
 
 def pcluster_describe(cluster: Cluster):
     """Describe a cluster, given the vlab_id and project_id"""
     logger.debug("About to describe")
-    return pc.describe_cluster(cluster_name=cluster.name, region=REGION)
+    return _pcluster_lib().describe_cluster(cluster_name=cluster.name, region=REGION)
+
+
+def description_ttl(cluster_status: Optional[str]) -> int:
+    """The number of seconds a description with cluster_status stays fresh"""
+    if cluster_status and not cluster_status.endswith("_IN_PROGRESS"):
+        return SETTLED_DESCRIPTION_TTL
+    return TRANSITION_DESCRIPTION_TTL
+
+
+def is_description_fresh(record: ClusterRecord, now: float) -> bool:
+    """Whether the description cached in record can be served instead of describing the cluster"""
+    if not (record.refreshed_at and record.cluster_status):
+        return False
+    if record.stack_event_at:
+        # The next stack event will mark the description stale
+        ttl = SETTLED_DESCRIPTION_TTL
+    else:
+        ttl = description_ttl(record.cluster_status)
+    return now - record.refreshed_at < ttl
+
+
+def stack_status_to_cluster_status(stack_status: str) -> str:
+    """The cluster status pcluster reports for a stack status"""
+    return STACK_STATUS_CLUSTER_STATUS.get(stack_status, stack_status)
 
 
 def pcluster_delete(cluster: Cluster):
-    """Destroy a cluster, given the vlab_id and project_id"""
-    release_subnets(cluster.name)
-    remove_key(get_keypair_name(cluster))
-    remove_key(get_keypair_name(cluster, "sim"))
-    return pc.delete_cluster(cluster_name=cluster.name, region=REGION)
+    """
+    Destroy a cluster, given the vlab_id and project_id.
+    Its subnets go back to the pool, where they drain until EC2 reports them as unused. Queued
+    clusters are dispatched to drained subnets by the subnet sweeper, so its schedule sets how
+    long they wait after a delete.
+
+    The teardown steps are independent and idempotent, so they run concurrently, and all of
+    them run even if some fail. Failed steps raise a TeardownError with all their errors.
+    """
+    results = run_steps(
+        {
+            "dequeue_cluster": lambda: _dequeue_cluster(cluster),
+            **_resource_steps(cluster),
+            "delete_cluster": lambda: _pcluster_lib().delete_cluster(
+                cluster_name=cluster.name, region=REGION
+            ),
+        }
+    )
+    return results["delete_cluster"]
+
+
+def pcluster_release_resources(cluster: Cluster) -> None:
+    """
+    Release what a cluster holds outside of its stack: its subnets and keypairs.
+    A creator that failed before the stack existed may have left them behind.
+    Failed steps raise a TeardownError, as in pcluster_delete.
+    """
+    run_steps(_resource_steps(cluster))
+
+
+def _resource_steps(cluster: Cluster) -> Dict[str, Callable[[], Any]]:
+    return {
+        "release_subnets": lambda: release_subnets(cluster.name),
+        "remove_admin_key": lambda: remove_key(get_keypair_name(cluster)),
+        "remove_sim_key": lambda: remove_key(get_keypair_name(cluster, "sim")),
+    }
+
+
+def run_steps(steps: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+    """
+    Run steps concurrently, each timed as its own phase.
+    Returns the result of each step, or raises a TeardownError if any of them failed.
+    """
+
+    def run_step(step: str, fn: Callable[[], Any]) -> Any:
+        with timed(step):
+            return fn()
+
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = {
+            step: submit_with_context(executor, run_step, step, fn) for step, fn in steps.items()
+        }
+
+    results = {}
+    errors = {}
+    for step, future in futures.items():
+        try:
+            results[step] = future.result()
+        except Exception as e:
+            logger.error(f"Step {step} failed: {e!r}")
+            errors[step] = e
+
+    if errors:
+        raise TeardownError(errors)
+    return results
+
+
+def pcluster_teardown(cluster: Cluster) -> None:
+    """
+    Run pcluster_delete in the teardown worker, recording its progress in the cluster record.
+    A stack that is already gone counts as deleted, so that retries succeed.
+    Other failures are recorded and raised again, for the invocation to be retried.
+    """
+    client = dynamodb_client()
+    update_teardown_status(client, cluster.name, DELETE_IN_PROGRESS, new_attempt=True)
+    try:
+        pcluster_delete(cluster)
+    except TeardownError as e:
+        failed_steps = {
+            step: f"{type(error).__name__}: {error}"
+            for step, error in e.errors.items()
+            if not (step == "delete_cluster" and is_not_found(error))
+        }
+        if failed_steps:
+            update_teardown_status(client, cluster.name, DELETE_FAILED, failed_steps=failed_steps)
+            raise
+        logger.info(f"Stack of {cluster.name} was already deleted")
+    update_teardown_status(client, cluster.name, DELETE_COMPLETE)
+
+
+def is_not_found(exception: Exception) -> bool:
+    """
+    Check whether pcluster reported a missing cluster.
+    pcluster.api.errors is only imported here, on the error path, to keep cold starts fast.
+    """
+    from pcluster.api.errors import NotFoundException  # noqa: PLC0415
+
+    return isinstance(exception, NotFoundException)
+
+
+def _dequeue_cluster(cluster: Cluster) -> None:
+    if remove_admission_request(dynamodb_client(), cluster.name):
+        logger.info(f"Removed {cluster.name} from the admission queue")
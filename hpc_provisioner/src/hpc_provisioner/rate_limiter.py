@@ -0,0 +1,131 @@
+import logging
+import logging.config
+import time
+from typing import Callable, Dict, NamedTuple, Optional
+
+from hpc_provisioner.dynamodb_actions import (
+    TokenBucketChangedException,
+    get_token_bucket,
+    put_token_bucket,
+)
+from hpc_provisioner.logging_config import LOGGING_CONFIG
+from hpc_provisioner.metrics import timed
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("hpc-resource-provisioner")
+
+
+class RateLimit(NamedTuple):
+    """API calls per second, and the burst of calls allowed after a quiet period"""
+
+    rate: float
+    capacity: float
+
+
+# The share of the account's API quotas all creators together may use
+RATE_LIMITS = {
+    "cloudformation": RateLimit(rate=1.0, capacity=5.0),
+    "ec2": RateLimit(rate=10.0, capacity=50.0),
+    "iam": RateLimit(rate=5.0, capacity=20.0),
+}
+# Roughly the calls pcluster makes per service while validating and creating a cluster
+CREATE_CLUSTER_COSTS = {"cloudformation": 3, "ec2": 25, "iam": 5}
+# Longer waits than this are better spent in the Lambda retry than in a sleeping creator
+MAX_RATE_LIMIT_WAIT = 300  # seconds
+RESERVE_ATTEMPTS = 10
+
+
+class RateLimitExceededException(Exception):
+    """Raised when tokens would only be available after more than the allowed wait"""
+
+
+def reserve_tokens(
+    dynamodb_client,
+    service: str,
+    cost: float,
+    now: Optional[float] = None,
+    max_wait: float = MAX_RATE_LIMIT_WAIT,
+) -> float:
+    """
+    Take cost tokens from the bucket of service, shared by all creators.
+
+    The bucket may go into debt: the tokens are reserved straight away, and the caller
+    has to wait until the debt is paid off by the refill. Concurrent creators thus wait
+    in the order they reserved, without polling DynamoDB.
+
+    Returns the number of seconds to wait before making the calls.
+    """
+    limit = RATE_LIMITS[service]
+    for _ in range(RESERVE_ATTEMPTS):
+        current_time = time.time() if now is None else now
+        bucket = get_token_bucket(dynamodb_client, service)
+        if bucket is None:
+            tokens = limit.capacity
+            expected_version = None
+        else:
+            elapsed = max(current_time - bucket.refilled_at, 0.0)
+            tokens = min(limit.capacity, bucket.tokens + elapsed * limit.rate)
+            expected_version = bucket.version
+
+        tokens -= cost
+        wait = max(-tokens / limit.rate, 0.0)
+        if wait > max_wait:
+            raise RateLimitExceededException(
+                f"{service} tokens only available in {wait:.1f}s, more than {max_wait}s"
+            )
+        try:
+            put_token_bucket(dynamodb_client, service, tokens, current_time, expected_version)
+        except TokenBucketChangedException:
+            logger.debug(f"Rate limit bucket {service} changed - trying again")
+            continue
+        return wait
+
+    raise TokenBucketChangedException(f"Could not reserve {service} tokens")
+
+
+def refund_tokens(dynamodb_client, service: str, cost: float, now: Optional[float] = None) -> None:
+    """Give back cost tokens reserved from the bucket of service for calls that won't be made"""
+    limit = RATE_LIMITS[service]
+    for _ in range(RESERVE_ATTEMPTS):
+        current_time = time.time() if now is None else now
+        bucket = get_token_bucket(dynamodb_client, service)
+        if bucket is None:
+            return
+        elapsed = max(current_time - bucket.refilled_at, 0.0)
+        tokens = min(limit.capacity, bucket.tokens + elapsed * limit.rate + cost)
+        try:
+            put_token_bucket(dynamodb_client, service, tokens, current_time, bucket.version)
+        except TokenBucketChangedException:
+            logger.debug(f"Rate limit bucket {service} changed - trying again")
+            continue
+        return
+
+    logger.warning(f"Could not refund {cost} {service} tokens")
+
+
+def acquire_tokens(
+    dynamodb_client, costs: Dict[str, float], sleep: Callable[[float], None] = time.sleep
+) -> float:
+    """
+    Reserve tokens for the calls about to be made to each service, then wait until
+    all of them are available. The time spent waiting is reported as the rate_limit_wait phase.
+    If the tokens of any service can't be reserved, those already reserved are refunded.
+
+    Returns the number of seconds waited.
+    """
+    waits = {}
+    with timed("reserve_tokens"):
+        try:
+            for service, cost in costs.items():
+                waits[service] = reserve_tokens(dynamodb_client, service, cost)
+        except (RateLimitExceededException, TokenBucketChangedException):
+            # The calls won't be made: don't make other creators wait for them
+            for reserved in waits:
+                refund_tokens(dynamodb_client, reserved, costs[reserved])
+            raise
+    wait = max(waits.values(), default=0.0)
+    if wait > 0:
+        logger.info(f"Waiting {wait:.1f}s for API rate limits: {waits}")
+        with timed("rate_limit_wait"):
+            sleep(wait)
+    return wait
@@ -1,6 +1,8 @@
+import contextvars
 import json
 import os
-from typing import List
+from concurrent.futures import Executor, Future
+from typing import Callable, List
 
 from cryptography.hazmat.primitives import serialization
 
@@ -52,6 +54,11 @@ def get_ami_id() -> str:
     return _get_env_var("PCLUSTER_AMI_ID")
 
 
+def get_admission_policy() -> str:
+    """The order in which queued cluster creations are dispatched: fifo (default) or vlab_fair"""
+    return os.environ.get("ADMISSION_POLICY", "fifo")
+
+
 def generate_public_key(key_material):
     private_key = serialization.load_pem_private_key(key_material.encode(), password=None)
     public_key = private_key.public_key()
@@ -59,3 +66,12 @@ def generate_public_key(key_material):
         encoding=serialization.Encoding.OpenSSH, format=serialization.PublicFormat.OpenSSH
     )
     return public_bytes.decode("utf-8")
+
+
+def submit_with_context(executor: Executor, fn: Callable, *args, **kwargs) -> Future:
+    """
+    Submit fn to executor, running it in a copy of the current context,
+    so that context variables such as the request metrics follow it into the worker thread
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
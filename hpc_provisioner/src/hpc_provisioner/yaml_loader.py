@@ -1,29 +1,105 @@
+import copy
+from collections.abc import Mapping
+from functools import lru_cache
 from pathlib import Path
+from typing import Any, Iterator, NamedTuple
 
 import yaml
 
 
+class RenderContext(Mapping):
+    """
+    The values for the !config placeholders of a single cluster config.
+
+    Immutable: values are copied on the way in and on the way out, so rendering one
+    config can never change the values used for another one.
+    """
+
+    def __init__(self, values: Mapping):
+        self._values = copy.deepcopy(dict(values))
+
+    def __getitem__(self, key: str) -> Any:
+        return copy.deepcopy(self._values[key])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __repr__(self) -> str:
+        return f"RenderContext({self._values})"
+
+
 class YamlLoader(yaml.SafeLoader):
     """A custom Yaml Loader for handling of includes and config values"""
 
-    def __init__(self, stream, config_map):
+    def __init__(self, stream, render_context: Mapping):
         self._root = Path(stream.name).parent
-        self._config_map = config_map
+        self._render_context = render_context
         super(YamlLoader, self).__init__(stream)
 
     def include(self, node):
         filename = self._root / str(self.construct_scalar(node))
         with open(filename, "r") as f:
-            return YamlLoader(f, self._config_map).get_single_data()
+            return YamlLoader(f, self._render_context).get_single_data()
 
     def config(self, node):
         config_entry = str(self.construct_scalar(node))
-        return self._config_map[config_entry]
+        return self._render_context[config_entry]
 
 
 YamlLoader.add_constructor("!include", YamlLoader.include)
 YamlLoader.add_constructor("!config", YamlLoader.config)
 
 
-def load_yaml_extended(stream, configs):
-    return YamlLoader(stream, configs).get_single_data()
+def load_yaml_extended(stream, render_context: Mapping):
+    return YamlLoader(stream, render_context).get_single_data()
+
+
+class ConfigPlaceholder(NamedTuple):
+    """A !config node in a compiled template"""
+
+    name: str
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """Loads a template with its includes resolved, but !config values left as placeholders"""
+
+    def __init__(self, stream):
+        self._root = Path(stream.name).parent
+        super(TemplateLoader, self).__init__(stream)
+
+    def include(self, node):
+        filename = self._root / str(self.construct_scalar(node))
+        with open(filename, "r") as f:
+            return TemplateLoader(f).get_single_data()
+
+    def config(self, node):
+        return ConfigPlaceholder(str(self.construct_scalar(node)))
+
+
+TemplateLoader.add_constructor("!include", TemplateLoader.include)
+TemplateLoader.add_constructor("!config", TemplateLoader.config)
+
+
+@lru_cache(maxsize=None)
+def compile_template(path: str) -> Any:
+    """
+    Parse a template and its includes, once per process.
+    The result is shared: it must only be read, e.g. through render_template.
+    """
+    with open(path, "r") as f:
+        return TemplateLoader(f).get_single_data()
+
+
+def render_template(template: Any, render_context: Mapping) -> Any:
+    """Build a new config from a compiled template, filling in the placeholders"""
+    if isinstance(template, dict):
+        return {key: render_template(value, render_context) for key, value in template.items()}
+    if isinstance(template, list):
+        return [render_template(value, render_context) for value in template]
+    if isinstance(template, ConfigPlaceholder):
+        return render_context[template.name]
+    # Scalars are immutable and can be shared with the compiled template
+    return template
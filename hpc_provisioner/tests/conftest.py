@@ -1,13 +1,567 @@
 import copy
 import json
+import random
+import re
+import threading
+import time
+import types
+import zlib
+from unittest.mock import patch
 
 import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
 
 from hpc_provisioner.cluster import Cluster
+from hpc_provisioner.deployment import deployment_facts
 
 PROJECT_ID = "testproject"
 VLAB_ID = "testvlab"
 
+DYNAMODB_KEY_SCHEMA = {
+    "sbo-parallelcluster-subnets": ("subnet_id",),
+    "sbo-parallelcluster-subnet-pool": ("pool_id",),
+    "sbo-parallelcluster-cluster-subnets": ("cluster",),
+    "sbo-parallelcluster-fsx": ("fsx_name",),
+    "sbo-parallelcluster-admission-queue": ("cluster",),
+    "sbo-parallelcluster-rate-limits": ("bucket",),
+    "sbo-parallelcluster-clusters": ("cluster",),
+}
+
+EXPRESSION_TOKEN = re.compile(
+    r"\s*(?:(?P<name>#\w+)|(?P<value>:\w+)|(?P<op><>|<=|>=|[=<>(),+-])|(?P<word>\w+))"
+)
+
+
+def conditional_check_failed(message: str) -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ConditionalCheckFailedException", "Message": message}},
+        "ConditionalCheck",
+    )
+
+
+def from_attribute_value(value):
+    (kind, data), *_ = value.items()
+    if kind == "N":
+        return float(data)
+    if kind in ("SS", "NS"):
+        return set(data)
+    return data
+
+
+def to_attribute_value(kind, data):
+    if kind == "N":
+        return {"N": str(int(data) if float(data).is_integer() else data)}
+    if kind in ("SS", "NS"):
+        return {kind: sorted(data)}
+    return {kind: data}
+
+
+class Expression:
+    """
+    Evaluates the subset of DynamoDB condition and update expressions the provisioner uses:
+    comparisons, AND/OR/NOT, attribute_exists, attribute_not_exists, contains, if_not_exists,
+    +/-, and the SET, REMOVE, ADD and DELETE clauses.
+    """
+
+    def __init__(self, expression, names=None, values=None):
+        self.tokens = [
+            (m.lastgroup, m.group(m.lastgroup))
+            for m in EXPRESSION_TOKEN.finditer(expression)
+            if m.lastgroup
+        ]
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self, expected=None):
+        token = self.peek()
+        if expected and token[1].upper() != expected:
+            raise NotImplementedError(f"Expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def keyword(self, *words):
+        kind, text = self.peek()
+        return kind == "word" and text.upper() in words
+
+    def path(self):
+        kind, text = self.next()
+        return self.names[text] if kind == "name" else text
+
+    def operand(self, item):
+        kind, text = self.peek()
+        if kind == "value":
+            self.next()
+            value = self.values[text]
+        elif self.keyword("IF_NOT_EXISTS"):
+            self.next(), self.next("(")
+            attribute = self.path()
+            self.next(",")
+            default = self.operand(item)
+            self.next(")")
+            value = item.get(attribute, default)
+        else:
+            value = item.get(self.path())
+        if self.peek()[1] in ("+", "-"):
+            sign = 1 if self.next()[1] == "+" else -1
+            other = self.operand(item)
+            total = from_attribute_value(value) + sign * from_attribute_value(other)
+            return to_attribute_value("N", total)
+        return value
+
+    def evaluate(self, item):
+        result = self.disjunction(item)
+        if self.peek()[0]:
+            raise NotImplementedError(f"Unexpected {self.peek()}")
+        return result
+
+    def disjunction(self, item):
+        result = self.conjunction(item)
+        while self.keyword("OR"):
+            self.next()
+            result = self.conjunction(item) or result
+        return result
+
+    def conjunction(self, item):
+        result = self.negation(item)
+        while self.keyword("AND"):
+            self.next()
+            result = self.negation(item) and result
+        return result
+
+    def negation(self, item):
+        if self.keyword("NOT"):
+            self.next()
+            return not self.negation(item)
+        if self.peek()[1] == "(":
+            self.next()
+            result = self.disjunction(item)
+            self.next(")")
+            return result
+        if self.keyword("ATTRIBUTE_EXISTS", "ATTRIBUTE_NOT_EXISTS"):
+            exists = self.next()[1].upper() == "ATTRIBUTE_EXISTS"
+            self.next("(")
+            attribute = self.path()
+            self.next(")")
+            return (attribute in item) == exists
+        if self.keyword("CONTAINS"):
+            self.next(), self.next("(")
+            attribute = item.get(self.path())
+            self.next(",")
+            value = from_attribute_value(self.operand(item))
+            self.next(")")
+            return attribute is not None and value in from_attribute_value(attribute)
+        left = self.operand(item)
+        operator = self.next()[1]
+        right = self.operand(item)
+        if left is None or right is None:
+            return operator == "<>" and left != right
+        left, right = from_attribute_value(left), from_attribute_value(right)
+        return {
+            "=": left == right,
+            "<>": left != right,
+            "<": left < right,
+            "<=": left <= right,
+            ">": left > right,
+            ">=": left >= right,
+        }[operator]
+
+    def update(self, item):
+        item = copy.deepcopy(item)
+        while self.peek()[0]:
+            clause = self.next()[1].upper()
+            while True:
+                attribute = self.path()
+                if clause == "SET":
+                    self.next("=")
+                    item[attribute] = self.operand(item)
+                elif clause == "REMOVE":
+                    item.pop(attribute, None)
+                else:
+                    value = self.operand(item)
+                    kind = next(iter(value))
+                    current = from_attribute_value(item[attribute]) if attribute in item else None
+                    if clause == "ADD" and kind == "N":
+                        item[attribute] = to_attribute_value(
+                            "N", (current or 0) + from_attribute_value(value)
+                        )
+                    elif clause == "ADD":
+                        updated = (current or set()) | from_attribute_value(value)
+                        item[attribute] = to_attribute_value(kind, updated)
+                    elif current is not None:
+                        remaining = current - from_attribute_value(value)
+                        if remaining:
+                            item[attribute] = to_attribute_value(kind, remaining)
+                        else:
+                            item.pop(attribute)
+                if self.peek()[1] != ",":
+                    break
+                self.next()
+        return item
+
+
+class FakeDynamoDBClient:
+    """
+    A thread-safe, in-memory stand-in for the DynamoDB client.
+    Each call is atomic, like in DynamoDB itself; latency is added before every call
+    so that concurrent callers interleave.
+    """
+
+    def __init__(self, key_schema=None, latency: float = 0.0):
+        self.key_schema = key_schema or DYNAMODB_KEY_SCHEMA
+        self.latency = latency
+        # Like the 1 MB limit of DynamoDB, but in items
+        self.scan_page_size = 100
+        self.tables = {table: {} for table in self.key_schema}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append(operation)
+
+    def _key(self, table_name, item):
+        return tuple(
+            from_attribute_value(item[attribute]) for attribute in self.key_schema[table_name]
+        )
+
+    def _check_condition(self, item, request):
+        condition = request.get("ConditionExpression")
+        if condition is None:
+            return
+        expression = Expression(
+            condition,
+            request.get("ExpressionAttributeNames"),
+            request.get("ExpressionAttributeValues"),
+        )
+        if not expression.evaluate(item or {}):
+            raise conditional_check_failed(condition)
+
+    def _put(self, request):
+        table = self.tables[request["TableName"]]
+        key = self._key(request["TableName"], request["Item"])
+        self._check_condition(table.get(key), request)
+        return lambda: table.__setitem__(key, copy.deepcopy(request["Item"]))
+
+    def _delete(self, request):
+        table = self.tables[request["TableName"]]
+        key = self._key(request["TableName"], request["Key"])
+        self._check_condition(table.get(key), request)
+        return lambda: table.pop(key, None)
+
+    def _update(self, request):
+        table = self.tables[request["TableName"]]
+        key = self._key(request["TableName"], request["Key"])
+        current = table.get(key)
+        self._check_condition(current, request)
+        updated = Expression(
+            request["UpdateExpression"],
+            request.get("ExpressionAttributeNames"),
+            request.get("ExpressionAttributeValues"),
+        ).update(current or copy.deepcopy(request["Key"]))
+        return lambda: table.__setitem__(key, updated)
+
+    def _condition_check(self, request):
+        table = self.tables[request["TableName"]]
+        self._check_condition(table.get(self._key(request["TableName"], request["Key"])), request)
+        return lambda: None
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        self._call("get_item")
+        with self._lock:
+            item = self.tables[TableName].get(self._key(TableName, Key))
+            return {"Item": copy.deepcopy(item)} if item else {}
+
+    def put_item(self, **request):
+        self._call("put_item")
+        with self._lock:
+            self._put(request)()
+        return {}
+
+    def delete_item(self, **request):
+        self._call("delete_item")
+        with self._lock:
+            self._delete(request)()
+        return {}
+
+    def update_item(self, **request):
+        self._call("update_item")
+        with self._lock:
+            self._update(request)()
+            item = self.tables[request["TableName"]][
+                self._key(request["TableName"], request["Key"])
+            ]
+            if request.get("ReturnValues") == "ALL_NEW":
+                return {"Attributes": copy.deepcopy(item)}
+        return {}
+
+    def transact_write_items(self, TransactItems):
+        self._call("transact_write_items")
+        operations = {
+            "Put": self._put,
+            "Delete": self._delete,
+            "Update": self._update,
+            "ConditionCheck": self._condition_check,
+        }
+        with self._lock:
+            writes, reasons = [], []
+            for transact_item in TransactItems:
+                (operation, request), *_ = transact_item.items()
+                try:
+                    writes.append(operations[operation](request))
+                    reasons.append({"Code": "None"})
+                except ClientError:
+                    reasons.append({"Code": "ConditionalCheckFailed"})
+            if len(writes) < len(TransactItems):
+                raise ClientError(
+                    {
+                        "Error": {"Code": "TransactionCanceledException", "Message": "Canceled"},
+                        "CancellationReasons": reasons,
+                    },
+                    "TransactWriteItems",
+                )
+            for write in writes:
+                write()
+        return {}
+
+    def scan(self, TableName, **kwargs):
+        self._call("scan")
+        with self._lock:
+            keys = sorted(
+                key
+                for key in self.tables[TableName]
+                if zlib.crc32(repr(key).encode()) % kwargs.get("TotalSegments", 1)
+                == kwargs.get("Segment", 0)
+            )
+            if start_key := kwargs.get("ExclusiveStartKey"):
+                start_key = self._key(TableName, start_key)
+                keys = [key for key in keys if key > start_key]
+            page_size = kwargs.get("Limit", self.scan_page_size)
+            page = [copy.deepcopy(self.tables[TableName][key]) for key in keys[:page_size]]
+        result = {}
+        if len(keys) > page_size:
+            result["LastEvaluatedKey"] = {
+                attribute: page[-1][attribute] for attribute in self.key_schema[TableName]
+            }
+        if filter_expression := kwargs.get("FilterExpression"):
+            page = [
+                item
+                for item in page
+                if Expression(
+                    filter_expression,
+                    kwargs.get("ExpressionAttributeNames"),
+                    kwargs.get("ExpressionAttributeValues"),
+                ).evaluate(item)
+            ]
+        if projection := kwargs.get("ProjectionExpression"):
+            names = kwargs.get("ExpressionAttributeNames", {})
+            attributes = [names.get(name.strip(), name.strip()) for name in projection.split(",")]
+            page = [{a: item[a] for a in attributes if a in item} for item in page]
+        return {"Items": page, "Count": len(page), **result}
+
+
+class FakeCloudFormationClient:
+    """
+    An in-memory stand-in for the CloudFormation client, holding stack name -> status,
+    or stack name -> the stack as DescribeStacks describes it
+    """
+
+    def __init__(self, stacks=None, page_size=100):
+        self.stacks = dict(stacks or {})
+        self.page_size = page_size
+        self.describe_calls = 0
+
+    def _stack(self, name):
+        stack = self.stacks[name]
+        if isinstance(stack, str):
+            return {"StackName": name, "StackStatus": stack}
+        return {"StackName": name, **stack}
+
+    def describe_stacks(self, StackName=None, NextToken=None):
+        self.describe_calls += 1
+        if StackName is None:
+            if NextToken and not NextToken.isdigit():
+                raise ClientError(
+                    {"Error": {"Code": "ValidationError", "Message": "Invalid NextToken"}},
+                    "DescribeStacks",
+                )
+            start = int(NextToken or 0)
+            names = list(self.stacks)[start : start + self.page_size]
+            page = {"Stacks": [self._stack(name) for name in names]}
+            if start + self.page_size < len(self.stacks):
+                page["NextToken"] = str(start + self.page_size)
+            return page
+        if StackName not in self.stacks:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ValidationError",
+                        "Message": f"Stack with id {StackName} does not exist",
+                    }
+                },
+                "DescribeStacks",
+            )
+        return {"Stacks": [self._stack(StackName)]}
+
+
+class VirtualClock:
+    """
+    Stands in for the clock botocore backs off and rate limits with,
+    so throttling scenarios that span minutes run in milliseconds
+    """
+
+    # Waits shorter than this would not move a clock at epoch-like values
+    RESOLUTION = 0.001
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def sleep(self, seconds):
+        self.now += max(seconds, self.RESOLUTION)
+
+    def current_time(self):
+        return self.now
+
+    def condition(self, lock):
+        return VirtualCondition(self, lock)
+
+
+class VirtualCondition:
+    """The condition botocore's token bucket waits on for capacity, waiting in virtual time"""
+
+    def __init__(self, clock, lock):
+        self._clock = clock
+        self._lock = lock
+
+    def __enter__(self):
+        return self._lock.__enter__()
+
+    def __exit__(self, *args):
+        return self._lock.__exit__(*args)
+
+    def wait(self, timeout):
+        self._clock.sleep(timeout)
+
+    def notify(self):
+        pass
+
+
+class RawBody:
+    def __init__(self, body: str):
+        self._body = body.encode()
+
+    def stream(self, **kwargs):
+        yield self._body
+
+
+# Success and throttling responses per protocol, for the calls the throttling tests make
+THROTTLING_RESPONSES = {
+    "json": (
+        "{}",
+        '{"__type": "ThrottlingException", "message": "Rate exceeded"}',
+    ),
+    "query": (
+        "<DescribeStacksResponse><DescribeStacksResult><Stacks/></DescribeStacksResult>"
+        "</DescribeStacksResponse>",
+        "<ErrorResponse><Error><Code>Throttling</Code><Message>Rate exceeded</Message>"
+        "</Error></ErrorResponse>",
+    ),
+    "ec2": (
+        "<DescribeSubnetsResponse><subnetSet/></DescribeSubnetsResponse>",
+        "<Response><Errors><Error><Code>RequestLimitExceeded</Code>"
+        "<Message>Request limit exceeded.</Message></Error></Errors></Response>",
+    ),
+}
+
+
+class ThrottlingService:
+    """
+    An AWS service that serves `rate` requests per (virtual) second and throttles the rest.
+    Register it on a client with `attach`: requests never leave the process.
+    """
+
+    def __init__(self, clock: VirtualClock, rate: float, latency: float = 0.02):
+        self.clock = clock
+        self.rate = rate
+        self.latency = latency
+        self.requests = 0
+        self.throttled = 0
+        self._tokens = rate
+        self._refilled_at = clock.now
+
+    def attach(self, client):
+        protocol = client.meta.service_model.protocol
+        self._responses = THROTTLING_RESPONSES["json" if protocol.startswith("json") else protocol]
+        service_id = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register(f"before-send.{service_id}", self.handle)
+        return client
+
+    def handle(self, request, **kwargs):
+        self.clock.sleep(self.latency)
+        self.requests += 1
+        self._tokens = min(
+            self.rate, self._tokens + (self.clock.now - self._refilled_at) * self.rate
+        )
+        self._refilled_at = self.clock.now
+        success, throttling = self._responses
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return AWSResponse(request.url, 200, {}, RawBody(success))
+        self.throttled += 1
+        return AWSResponse(request.url, 400, {}, RawBody(throttling))
+
+
+@pytest.fixture
+def virtual_clock(monkeypatch):
+    """
+    Run botocore's backoff and adaptive rate limiting on a virtual clock, with a fixed seed
+    for the backoff jitter. Clients have to be created while the fixture is active.
+    """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    clock = VirtualClock()
+    random_state = random.getstate()
+    random.seed(0)
+    with (
+        patch("botocore.endpoint.time", clock),
+        patch("botocore.retries.bucket.Clock", lambda: clock),
+        patch(
+            "botocore.retries.bucket.threading",
+            types.SimpleNamespace(Lock=threading.Lock, Condition=clock.condition),
+        ),
+    ):
+        yield clock
+    random.setstate(random_state)
+
+
+@pytest.fixture
+def throttling_service(virtual_clock):
+    """Create ThrottlingServices serving a given rate of requests on the virtual clock"""
+    return lambda rate: ThrottlingService(virtual_clock, rate)
+
+
+@pytest.fixture
+def fake_cloudformation_client():
+    return FakeCloudFormationClient()
+
+
+@pytest.fixture(autouse=True)
+def clean_deployment_facts():
+    deployment_facts.invalidate()
+    yield
+    deployment_facts.invalidate()
+
+
+@pytest.fixture
+def fake_dynamodb_client():
+    return FakeDynamoDBClient()
+
 
 @pytest.fixture
 def test_cluster():
@@ -32,6 +586,11 @@ def create_event(test_cluster):
     return {"cluster": test_cluster.as_dict(), "path": "/hpc-provisioner/pcluster"}
 
 
+@pytest.fixture
+def deleter_event(test_cluster):
+    return {"cluster": test_cluster.as_dict()}
+
+
 @pytest.fixture
 def event():
     return {
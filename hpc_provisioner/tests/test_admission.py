@@ -0,0 +1,166 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+
+from hpc_provisioner.admission import (
+    InvalidAdmissionPolicy,
+    dispatch_admission_queue,
+    enqueue_cluster,
+    get_queue_position,
+    order_admission_requests,
+)
+from hpc_provisioner.cluster import Cluster
+from hpc_provisioner.dynamodb_actions import (
+    AdmissionRequest,
+    get_admission_requests,
+    get_subnet_pool,
+    put_subnet_pool,
+)
+
+
+def request(vlab_id: str, project_id: str, enqueued_at: int) -> AdmissionRequest:
+    return AdmissionRequest(f"pcluster-{vlab_id}-{project_id}", vlab_id, "{}", enqueued_at)
+
+
+def queued_clusters(requests):
+    return [request.cluster for request in requests]
+
+
+QUEUE = [
+    request("vlab1", "a", 1),
+    request("vlab1", "b", 2),
+    request("vlab1", "c", 3),
+    request("vlab2", "a", 4),
+    request("vlab3", "a", 5),
+    request("vlab2", "b", 6),
+]
+
+
+def test_order_fifo():
+    assert queued_clusters(order_admission_requests(list(reversed(QUEUE)), "fifo")) == (
+        queued_clusters(QUEUE)
+    )
+
+
+def test_order_vlab_fair():
+    assert queued_clusters(order_admission_requests(QUEUE, "vlab_fair")) == [
+        "pcluster-vlab1-a",
+        "pcluster-vlab2-a",
+        "pcluster-vlab3-a",
+        "pcluster-vlab1-b",
+        "pcluster-vlab2-b",
+        "pcluster-vlab1-c",
+    ]
+
+
+def test_order_policy_from_environment(monkeypatch):
+    monkeypatch.setenv("ADMISSION_POLICY", "vlab_fair")
+    assert queued_clusters(order_admission_requests(QUEUE))[1] == "pcluster-vlab2-a"
+    monkeypatch.delenv("ADMISSION_POLICY")
+    assert queued_clusters(order_admission_requests(QUEUE))[1] == "pcluster-vlab1-b"
+
+
+def test_invalid_policy():
+    with pytest.raises(InvalidAdmissionPolicy):
+        order_admission_requests(QUEUE, "lifo")
+
+
+def test_enqueue_cluster(fake_dynamodb_client):
+    first = Cluster(project_id="a", vlab_id="vlab1")
+    second = Cluster(project_id="b", vlab_id="vlab1")
+    assert enqueue_cluster(fake_dynamodb_client, second, 2) == 1
+    assert enqueue_cluster(fake_dynamodb_client, first, 1) == 1
+    assert enqueue_cluster(fake_dynamodb_client, second) == 2
+    assert get_queue_position(fake_dynamodb_client, second.name) == 2
+    assert get_queue_position(fake_dynamodb_client, "pcluster-other") is None
+
+
+def seed_queue(dynamodb_client, count):
+    for i in range(count):
+        enqueue_cluster(dynamodb_client, Cluster(project_id=str(i), vlab_id="vlab"), i + 1)
+
+
+def dispatched_clusters(lambda_client):
+    return [
+        json.loads(call.kwargs["InvokeArgs"])["cluster"]["project_id"]
+        for call in lambda_client.invoke_async.call_args_list
+    ]
+
+
+def test_dispatch_admission_queue(fake_dynamodb_client):
+    seed_queue(fake_dynamodb_client, 3)
+    put_subnet_pool(
+        fake_dynamodb_client, frozenset(["sub-1", "sub-2"]), frozenset(), expected_version=None
+    )
+    mock_lambda_client = MagicMock()
+    assert dispatch_admission_queue(MagicMock(), fake_dynamodb_client, mock_lambda_client) == [
+        "pcluster-vlab-0",
+        "pcluster-vlab-1",
+    ]
+    assert dispatched_clusters(mock_lambda_client) == ["0", "1"]
+    first_call = mock_lambda_client.invoke_async.call_args_list[0]
+    assert first_call.kwargs["FunctionName"] == "hpc-resource-provisioner-creator"
+    assert json.loads(first_call.kwargs["InvokeArgs"])["enqueued_at"] == 1
+    assert queued_clusters(get_admission_requests(fake_dynamodb_client)) == ["pcluster-vlab-2"]
+
+
+def test_dispatch_empty_queue(fake_dynamodb_client):
+    mock_ec2_client = MagicMock()
+    assert dispatch_admission_queue(mock_ec2_client, fake_dynamodb_client, MagicMock()) == []
+    mock_ec2_client.describe_subnets.assert_not_called()
+    assert get_subnet_pool(fake_dynamodb_client) is None
+
+
+def test_dispatch_reconciles_drained_subnets(fake_dynamodb_client):
+    seed_queue(fake_dynamodb_client, 2)
+    put_subnet_pool(fake_dynamodb_client, frozenset(), frozenset(["sub-1"]), expected_version=None)
+    mock_ec2_client = MagicMock()
+    mock_ec2_client.describe_subnets.return_value = {
+        "Subnets": [{"SubnetId": "sub-1", "AvailableIpAddressCount": 251}]
+    }
+    mock_lambda_client = MagicMock()
+    assert dispatch_admission_queue(mock_ec2_client, fake_dynamodb_client, mock_lambda_client) == [
+        "pcluster-vlab-0"
+    ]
+    assert get_subnet_pool(fake_dynamodb_client).free_subnets == frozenset(["sub-1"])
+
+
+def test_dispatch_without_capacity(fake_dynamodb_client):
+    seed_queue(fake_dynamodb_client, 1)
+    put_subnet_pool(fake_dynamodb_client, frozenset(), frozenset(), expected_version=None)
+    mock_lambda_client = MagicMock()
+    assert dispatch_admission_queue(MagicMock(), fake_dynamodb_client, mock_lambda_client) == []
+    mock_lambda_client.invoke_async.assert_not_called()
+    assert len(get_admission_requests(fake_dynamodb_client)) == 1
+
+
+def test_dispatch_requeues_on_invoke_failure(fake_dynamodb_client):
+    seed_queue(fake_dynamodb_client, 1)
+    put_subnet_pool(fake_dynamodb_client, frozenset(["sub-1"]), frozenset(), expected_version=None)
+    mock_lambda_client = MagicMock()
+    mock_lambda_client.invoke_async.side_effect = RuntimeError("throttled")
+    with pytest.raises(RuntimeError):
+        dispatch_admission_queue(MagicMock(), fake_dynamodb_client, mock_lambda_client)
+    (request,) = get_admission_requests(fake_dynamodb_client)
+    assert request.enqueued_at == 1
+
+
+def test_concurrent_dispatchers_dispatch_once(fake_dynamodb_client):
+    """A request taken off the queue by another dispatcher in the meantime is skipped"""
+    seed_queue(fake_dynamodb_client, 2)
+    put_subnet_pool(
+        fake_dynamodb_client, frozenset(["sub-1", "sub-2"]), frozenset(), expected_version=None
+    )
+    other_lambda_client = MagicMock()
+    mock_lambda_client = MagicMock()
+
+    def dispatch_concurrently(**kwargs):
+        if not other_lambda_client.invoke_async.called:
+            dispatch_admission_queue(MagicMock(), fake_dynamodb_client, other_lambda_client)
+
+    mock_lambda_client.invoke_async.side_effect = dispatch_concurrently
+    dispatch_admission_queue(MagicMock(), fake_dynamodb_client, mock_lambda_client)
+    assert sorted(
+        dispatched_clusters(mock_lambda_client) + dispatched_clusters(other_lambda_client)
+    ) == ["0", "1"]
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import pytest
+from botocore.exceptions import ClientError
+
+from hpc_provisioner import aws_clients
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    aws_clients.reset_clients()
+    yield
+    aws_clients.reset_clients()
+
+
+def test_get_client_is_reused():
+    assert aws_clients.get_client("ec2") is aws_clients.get_client("ec2")
+    assert aws_clients.get_client("ec2") is not aws_clients.get_client("secretsmanager")
+
+
+def test_get_client_shares_session():
+    ec2_client = aws_clients.get_client("ec2")
+    aws_clients.get_client("secretsmanager")
+    assert aws_clients._registry.session() is aws_clients._registry.session()
+    assert ec2_client.meta.region_name == "us-east-1"
+
+
+def test_get_client_connection_pool():
+    config = aws_clients.get_client("dynamodb").meta.config
+    assert config.max_pool_connections == aws_clients.MAX_POOL_CONNECTIONS
+    assert config.tcp_keepalive is True
+
+
+def test_get_client_concurrently():
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        clients = list(executor.map(aws_clients.get_client, ["cloudformation"] * 64))
+    assert all(client is clients[0] for client in clients)
+
+
+def test_reset_clients():
+    ec2_client = aws_clients.get_client("ec2")
+    aws_clients.reset_clients()
+    assert aws_clients.get_client("ec2") is not ec2_client
+
+
+@pytest.mark.parametrize(
+    "service_name,mode,max_attempts",
+    [
+        ("cloudformation", "adaptive", 10),
+        ("ec2", "adaptive", 10),
+        ("secretsmanager", "adaptive", 10),
+        ("dynamodb", "standard", 10),
+        ("lambda", "standard", 5),
+    ],
+)
+def test_get_client_retry_policy(service_name, mode, max_attempts):
+    config = aws_clients.get_client(service_name).meta.config
+    assert config.retries == {"mode": mode, "total_max_attempts": max_attempts}
+
+
+THROTTLED_CALLS = {
+    "cloudformation": lambda client: client.describe_stacks(StackName="pcluster-vlab-1"),
+    "ec2": lambda client: client.describe_subnets(),
+    "secretsmanager": lambda client: client.get_secret_value(SecretId="pcluster-vlab-1"),
+    "dynamodb": lambda client: client.get_item(TableName="t", Key={"k": {"S": "1"}}),
+}
+
+
+def sustained_throughput(client, call, clock, calls: int) -> Tuple[float, int]:
+    """Make calls back to back: return the successful calls per second, and the failed calls"""
+    started_at = clock.now
+    failed = 0
+    for _ in range(calls):
+        try:
+            call(client)
+        except ClientError:
+            failed += 1
+    return (calls - failed) / (clock.now - started_at), failed
+
+
+@pytest.mark.parametrize("service_name", THROTTLED_CALLS)
+@pytest.mark.parametrize("rate", [5, 20])
+def test_sustained_throughput_under_throttling(
+    virtual_clock, throttling_service, service_name, rate
+):
+    """
+    Drive a service at more than it allows: every call has to succeed eventually, at close
+    to the rate the service allows, with fewer throttled requests than botocore's defaults.
+    """
+    calls = 10 * rate
+    call = THROTTLED_CALLS[service_name]
+    service = throttling_service(rate)
+    client = service.attach(aws_clients.get_client(service_name))
+    throughput, failed = sustained_throughput(client, call, virtual_clock, calls)
+
+    default_service = throttling_service(rate)
+    default_client = default_service.attach(aws_clients._registry.session().client(service_name))
+    default_throughput, default_failed = sustained_throughput(
+        default_client, call, virtual_clock, calls
+    )
+
+    print(
+        f"{service_name} at {rate}/s: {throughput:.2f}/s, {failed} failed, "
+        f"{service.throttled}/{service.requests} requests throttled; "
+        f"defaults: {default_throughput:.2f}/s, {default_failed} failed, "
+        f"{default_service.throttled}/{default_service.requests} requests throttled"
+    )
+    assert failed == 0
+    assert throughput > 0.9 * rate
+    assert service.throttled < default_service.throttled
@@ -1,5 +1,7 @@
 import logging
-from unittest.mock import MagicMock, call, patch
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, MagicMock, call, patch
 
 import pytest
 from botocore.exceptions import ClientError
@@ -7,7 +9,9 @@ from botocore.exceptions import ClientError
 from hpc_provisioner.aws_queries import (
     CouldNotDetermineEFSException,
     CouldNotDetermineSecurityGroupException,
+    FsxIndex,
     OutOfSubnetsException,
+    bind_cluster_subnet,
     claim_subnet,
     create_keypair,
     create_secret,
@@ -15,8 +19,13 @@ from hpc_provisioner.aws_queries import (
     get_efs,
     get_secret,
     get_security_group,
+    get_stack_status,
+    reconcile_subnet_pool,
+    release_subnets,
     remove_key,
+    stack_exists,
     store_private_key,
+    sweep_subnet_leases,
 )
 from hpc_provisioner.constants import (
     BILLING_TAG_KEY,
@@ -24,7 +33,16 @@ from hpc_provisioner.constants import (
     PROJECT_TAG_KEY,
     VLAB_TAG_KEY,
 )
-from hpc_provisioner.dynamodb_actions import SubnetAlreadyRegisteredException
+from hpc_provisioner.dynamodb_actions import (
+    SubnetAlreadyRegisteredException,
+    claim_free_subnet,
+    get_cluster_subnets,
+    get_expired_subnet_leases,
+    get_registered_subnets,
+    get_subnet_pool,
+    put_subnet_pool,
+    release_subnet,
+)
 
 logger = logging.getLogger("test_logger")
 fmt = logging.Formatter("[%(asctime)s] [%(levelname)s] %(msg)s")
@@ -81,6 +99,23 @@ def test_get_efs(filesystems):
     assert efs == filesystems["FileSystems"][0]["FileSystemId"]
 
 
+def test_get_efs_paginated():
+    mock_efs_client = MagicMock()
+    mock_efs_client.describe_file_systems.side_effect = [
+        {"FileSystems": [{"FileSystemId": "fs-123", "Tags": []}], "NextMarker": "page2"},
+        {
+            "FileSystems": [
+                {
+                    "FileSystemId": "fs-234",
+                    "Tags": [{"Key": "HPC_Goal", "Value": "compute_cluster"}],
+                }
+            ]
+        },
+    ]
+    assert get_efs(mock_efs_client) == "fs-234"
+    mock_efs_client.describe_file_systems.assert_has_calls([call(), call(Marker="page2")])
+
+
 @pytest.mark.parametrize(
     "filesystems",
     [
@@ -148,137 +183,257 @@ def test_get_security_group_fails(security_groups):
         get_security_group(mock_ec2_client)
 
 
-@patch("hpc_provisioner.aws_queries.free_subnet")
+def register_legacy_claim(dynamodb_client, subnet_id, cluster):
+    """A claim as written before the subnet pool existed: no state, lease or cluster index"""
+    dynamodb_client.put_item(
+        TableName="sbo-parallelcluster-subnets",
+        Item={"subnet_id": {"S": subnet_id}, "cluster": {"S": cluster}},
+    )
+
+
+def seed_subnet_pool(dynamodb_client, free_subnets, draining_subnets=()):
+    put_subnet_pool(
+        dynamodb_client, frozenset(free_subnets), frozenset(draining_subnets), expected_version=None
+    )
+
+
+def compute_subnets(**available_ips):
+    return {
+        "Subnets": [
+            {"SubnetId": subnet_id.replace("_", "-"), "AvailableIpAddressCount": count}
+            for subnet_id, count in available_ips.items()
+        ]
+    }
+
+
+@patch("hpc_provisioner.aws_queries.release_subnet")
 @pytest.mark.parametrize(
-    "ec2_subnets,claimed_subnets,cluster_name",
+    "claimed_subnets,cluster_name",
     [
-        ([{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}], {"sub-1": "cluster1"}, "cluster1"),
-        (
-            [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}, {"SubnetId": "sub-3"}],
-            {"sub-1": "cluster1", "sub-2": "cluster1"},
-            "cluster1",
-        ),
+        ({"sub-1": "cluster1"}, "cluster1"),
+        ({"sub-1": "cluster1", "sub-2": "cluster1"}, "cluster1"),
     ],
 )
-def test_claim_subnet_existing_claims(
-    patched_free_subnet, ec2_subnets, claimed_subnets, cluster_name
-):
+def test_claim_subnet_existing_claims(patched_release_subnet, claimed_subnets, cluster_name):
     """
     1. One subnet was already claimed: nothing gets released, one gets returned
     2. Two subnets were already claimed: one gets released, one gets returned
     """
     mock_dynamodb_client = MagicMock()
-    with patch("hpc_provisioner.aws_queries.get_registered_subnets") as mock_get_registered_subnets:
-        mock_get_registered_subnets.return_value = claimed_subnets
-        subnet = claim_subnet(mock_dynamodb_client, ec2_subnets, cluster_name)
+    with patch("hpc_provisioner.aws_queries.get_cluster_subnets") as mock_get_cluster_subnets:
+        mock_get_cluster_subnets.return_value = frozenset(claimed_subnets)
+        subnet = claim_subnet(mock_dynamodb_client, cluster_name)
         if len(claimed_subnets.keys()) == 1:
-            patched_free_subnet.assert_not_called()
+            patched_release_subnet.assert_not_called()
         else:
-            assert patched_free_subnet.call_count == 1
+            patched_release_subnet.assert_called_once_with(
+                mock_dynamodb_client, "sub-1", cluster_name
+            )
         assert subnet == [*claimed_subnets][-1]
+    mock_dynamodb_client.transact_write_items.assert_not_called()
+    mock_dynamodb_client.scan.assert_not_called()
 
 
-@patch("hpc_provisioner.aws_queries.free_subnet")
-def test_all_ec2_subnets_are_registered(patched_free_subnet):
-    ec2_subnets = [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}]
-    mock_dynamodb_client = MagicMock()
-    with patch("hpc_provisioner.aws_queries.get_registered_subnets") as mock_get_registered_subnets:
-        mock_get_registered_subnets.return_value = {"sub-1": "cluster1", "sub-2": "cluster2"}
-        with pytest.raises(OutOfSubnetsException, match="All subnets are in use"):
-            claim_subnet(mock_dynamodb_client, ec2_subnets, "cluster3")
-        patched_free_subnet.assert_not_called()
+def test_no_free_subnets_in_pool(fake_dynamodb_client):
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=[], draining_subnets=["sub-1"])
+    register_legacy_claim(fake_dynamodb_client, "sub-2", "cluster2")
+    with pytest.raises(OutOfSubnetsException, match="Could not find a subnet"):
+        claim_subnet(fake_dynamodb_client, "cluster3")
+
+
+def test_claim_subnet_without_pool(fake_dynamodb_client):
+    with pytest.raises(OutOfSubnetsException):
+        claim_subnet(fake_dynamodb_client, "cluster1")
 
 
-@patch("hpc_provisioner.aws_queries.get_subnet", return_value={"sub-2": "cluster1"})
-@patch("hpc_provisioner.aws_queries.free_subnet")
+@patch("hpc_provisioner.aws_queries.random.choice", side_effect=lambda subnets: subnets[0])
 @patch("hpc_provisioner.aws_queries.logger")
-def test_claim_subnet_claimed_between_list_and_register(
-    patched_logger,
-    patched_free_subnet,
-    patched_get_subnet,
+def test_claim_subnet_claimed_between_read_and_claim(
+    patched_logger, patched_choice, fake_dynamodb_client
 ):
     """
-    The subnet was not part of get_registered_subnets,
-    but was claimed while we were checking the result of that call
-    for existing claims for our cluster.
+    The subnet was free when we read the pool, but somebody claimed it before our transaction.
     """
-    mock_dynamodb_client = MagicMock()
-    ec2_subnets = [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}]
-    cluster_name = "cluster1"
-    with patch("hpc_provisioner.aws_queries.get_registered_subnets") as mock_get_registered_subnets:
-        mock_get_registered_subnets.return_value = {}
-        with patch("hpc_provisioner.aws_queries.register_subnet") as mock_register_subnet:
-            mock_register_subnet.side_effect = [SubnetAlreadyRegisteredException(), None]
-            subnet = claim_subnet(mock_dynamodb_client, ec2_subnets, cluster_name)
-    patched_free_subnet.assert_not_called()
-    patched_logger.debug.assert_any_call("Subnet was registered just before us - continuing")
-    patched_get_subnet.assert_called_once_with(mock_dynamodb_client, "sub-2")
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-1", "sub-2"])
+    with patch(
+        "hpc_provisioner.aws_queries.claim_free_subnet",
+        side_effect=[SubnetAlreadyRegisteredException(), None],
+    ) as mock_claim_free_subnet:
+        subnet = claim_subnet(fake_dynamodb_client, "cluster1")
+    patched_logger.debug.assert_any_call("Subnet was claimed just before us - continuing")
+    assert mock_claim_free_subnet.call_args_list == [
+        call(fake_dynamodb_client, "sub-1", "cluster1"),
+        call(fake_dynamodb_client, "sub-2", "cluster1"),
+    ]
     assert subnet == "sub-2"
 
 
-@patch(
-    "hpc_provisioner.aws_queries.get_subnet",
-    side_effect=[{"sub-1": "cluster1"}, {"sub-2": "cluster2"}],
-)
-@patch("hpc_provisioner.aws_queries.free_subnet")
-@patch("hpc_provisioner.aws_queries.logger")
-def test_claim_subnet_claimed_between_register_and_write(
-    patched_logger,
-    patched_free_subnet,
-    patched_get_subnet,
-):
+def test_claim_subnet_happy_path(fake_dynamodb_client):
     """
-    The subnet was not part of get_registered_subnets,
-    but was registered at the same time as someone else (simultaneous writes).
-    The other write won.
+    No weird behaviour, just claiming a subnet that nobody else is trying to claim.
     """
-    mock_dynamodb_client = MagicMock()
-    ec2_subnets = [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}]
-    cluster_name = "cluster2"
-
-    with patch("hpc_provisioner.aws_queries.get_registered_subnets") as mock_get_registered_subnets:
-        mock_get_registered_subnets.return_value = {}
-        with patch("hpc_provisioner.aws_queries.register_subnet") as mock_register_subnet:
-            mock_register_subnet.return_value = None
-            subnet = claim_subnet(mock_dynamodb_client, ec2_subnets, cluster_name)
-    patched_free_subnet.assert_not_called()
-    patched_logger.info.assert_any_call("Subnet sub-1 already claimed for cluster cluster1")
-    first_get_subnet = call(mock_dynamodb_client, "sub-1")
-    second_get_subnet = call(mock_dynamodb_client, "sub-2")
-    patched_get_subnet.assert_has_calls([first_get_subnet, second_get_subnet])
-    assert subnet == "sub-2"
+    seed_subnet_pool(
+        fake_dynamodb_client, free_subnets=["sub-1", "sub-2"], draining_subnets=["sub-3"]
+    )
+    register_legacy_claim(fake_dynamodb_client, "sub-4", "cluster4")
+    subnet = claim_subnet(fake_dynamodb_client, "cluster1")
+    assert fake_dynamodb_client.calls.count("scan") == 0
+    assert subnet in {"sub-1", "sub-2"}
+    assert get_registered_subnets(fake_dynamodb_client) == {subnet: "cluster1", "sub-4": "cluster4"}
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster1") == {subnet}
+    pool = get_subnet_pool(fake_dynamodb_client)
+    assert pool.free_subnets == {"sub-1", "sub-2"} - {subnet}
+    assert pool.draining_subnets == {"sub-3"}
+    assert fake_dynamodb_client.calls.count("transact_write_items") == 1
+    assert claim_subnet(fake_dynamodb_client, "cluster1") == subnet
+    assert fake_dynamodb_client.calls.count("transact_write_items") == 1
+
+
+def test_claim_subnet_concurrently(fake_dynamodb_client):
+    """Many clusters claiming at once never end up sharing a subnet"""
+    subnets = [f"sub-{i}" for i in range(8)]
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=subnets)
+    fake_dynamodb_client.latency = 0.001
+    clusters = [f"cluster{i}" for i in range(32)]
+
+    def claim(cluster_name):
+        try:
+            return claim_subnet(fake_dynamodb_client, cluster_name)
+        except OutOfSubnetsException:
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        claims = dict(zip(clusters, executor.map(claim, clusters)))
+
+    claimed = {cluster: subnet for cluster, subnet in claims.items() if subnet}
+    assert len(claimed) == len(subnets)
+    assert set(claimed.values()) == set(subnets)
+    assert get_registered_subnets(fake_dynamodb_client) == {
+        subnet: cluster for cluster, subnet in claimed.items()
+    }
+    assert get_subnet_pool(fake_dynamodb_client).free_subnets == frozenset()
 
 
-@patch(
-    "hpc_provisioner.aws_queries.get_subnet",
-    return_value={"sub-1": "cluster1"},
-)
-@patch("hpc_provisioner.aws_queries.free_subnet")
-@patch("hpc_provisioner.aws_queries.logger")
-def test_claim_subnet_happy_path(
-    patched_logger,
-    patched_free_subnet,
-    patched_get_subnet,
-):
+@patch("hpc_provisioner.aws_queries.dynamodb_client")
+def test_release_subnets(patched_dynamodb_client, fake_dynamodb_client):
+    patched_dynamodb_client.return_value = fake_dynamodb_client
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-1", "sub-2", "sub-3"])
+    claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster1")
+    claim_free_subnet(fake_dynamodb_client, "sub-2", "cluster2")
+    release_subnets("cluster1")
+    assert fake_dynamodb_client.calls.count("scan") == 0
+    assert get_registered_subnets(fake_dynamodb_client) == {"sub-2": "cluster2"}
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster1") == frozenset()
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster2") == {"sub-2"}
+    pool = get_subnet_pool(fake_dynamodb_client)
+    assert pool.free_subnets == {"sub-3"}
+    assert pool.draining_subnets == {"sub-1"}
+
+
+@patch("hpc_provisioner.aws_queries.dynamodb_client")
+def test_release_subnets_not_indexed(patched_dynamodb_client, fake_dynamodb_client):
+    """Subnets claimed before the cluster index existed are still found"""
+    patched_dynamodb_client.return_value = fake_dynamodb_client
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-3"])
+    register_legacy_claim(fake_dynamodb_client, "sub-1", "cluster1")
+    register_legacy_claim(fake_dynamodb_client, "sub-2", "cluster2")
+    release_subnets("cluster1")
+    assert get_registered_subnets(fake_dynamodb_client) == {"sub-2": "cluster2"}
+    assert get_subnet_pool(fake_dynamodb_client).draining_subnets == {"sub-1"}
+
+
+def test_release_subnet_without_pool(fake_dynamodb_client):
+    register_legacy_claim(fake_dynamodb_client, "sub-1", "cluster1")
+    release_subnet(fake_dynamodb_client, "sub-1", "cluster2")
+    assert get_registered_subnets(fake_dynamodb_client) == {"sub-1": "cluster1"}
+    release_subnet(fake_dynamodb_client, "sub-1", "cluster1")
+    assert get_registered_subnets(fake_dynamodb_client) == {}
+    assert get_subnet_pool(fake_dynamodb_client) is None
+
+
+def test_reconcile_subnet_pool(fake_dynamodb_client):
+    mock_ec2_client = MagicMock()
+    mock_ec2_client.describe_subnets.side_effect = [
+        {**compute_subnets(sub_1=251, sub_2=120), "NextToken": "page-2"},
+        compute_subnets(sub_3=251, sub_4=200),
+    ]
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-old"])
+    register_legacy_claim(fake_dynamodb_client, "sub-2", "cluster2")
+    pool = reconcile_subnet_pool(mock_ec2_client, fake_dynamodb_client)
+    assert pool == get_subnet_pool(fake_dynamodb_client)
+    assert pool.free_subnets == {"sub-1", "sub-3"}
+    assert pool.draining_subnets == {"sub-4"}
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster2") == {"sub-2"}
+    assert mock_ec2_client.describe_subnets.call_args_list == [
+        call(Filters=[{"Name": "tag:HPC_Goal", "Values": ["compute_cluster"]}]),
+        call(
+            Filters=[{"Name": "tag:HPC_Goal", "Values": ["compute_cluster"]}],
+            NextToken="page-2",
+        ),
+    ]
+
+
+def test_reconcile_subnet_pool_concurrent_change(fake_dynamodb_client):
+    """A subnet claimed while rebuilding the pool does not end up back in it"""
+    mock_ec2_client = MagicMock()
+    mock_ec2_client.describe_subnets.return_value = compute_subnets(sub_1=251, sub_2=251)
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-1", "sub-2"])
+
+    def claim_while_listing(**kwargs):
+        if not get_registered_subnets(fake_dynamodb_client):
+            claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster1")
+        return compute_subnets(sub_1=251, sub_2=251)
+
+    mock_ec2_client.describe_subnets.side_effect = claim_while_listing
+    pool = reconcile_subnet_pool(mock_ec2_client, fake_dynamodb_client)
+    assert pool.free_subnets == {"sub-2"}
+    assert mock_ec2_client.describe_subnets.call_count == 2
+
+
+def test_sweep_subnet_leases(fake_dynamodb_client, fake_cloudformation_client):
     """
-    No weird behaviour, just claiming a subnet that nobody else is trying to claim.
+    Expired reservations are released if their stack never appeared, and bound otherwise.
+    Unexpired reservations and bound subnets are left alone.
     """
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-1", "sub-2", "sub-3", "sub-4"])
+    with patch("hpc_provisioner.dynamodb_actions.time.time", return_value=1000):
+        claim_free_subnet(fake_dynamodb_client, "sub-1", "crashed", lease_seconds=60)
+        claim_free_subnet(fake_dynamodb_client, "sub-2", "slow", lease_seconds=60)
+        claim_free_subnet(fake_dynamodb_client, "sub-3", "creating", lease_seconds=600)
+        claim_free_subnet(fake_dynamodb_client, "sub-4", "created", lease_seconds=60)
+    with patch("hpc_provisioner.aws_queries.dynamodb_client", return_value=fake_dynamodb_client):
+        bind_cluster_subnet("created", "sub-4")
+    fake_cloudformation_client.stacks = {
+        "slow": "CREATE_IN_PROGRESS",
+        "creating": "CREATE_IN_PROGRESS",
+        "created": "CREATE_COMPLETE",
+    }
 
-    mock_dynamodb_client = MagicMock()
-    ec2_subnets = [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}]
-    cluster_name = "cluster1"
+    swept = sweep_subnet_leases(fake_cloudformation_client, fake_dynamodb_client, now=1100)
+    assert swept == {"sub-1": "released", "sub-2": "bound"}
+    assert get_registered_subnets(fake_dynamodb_client) == {
+        "sub-2": "slow",
+        "sub-3": "creating",
+        "sub-4": "created",
+    }
+    assert get_cluster_subnets(fake_dynamodb_client, "crashed") == frozenset()
+    assert get_subnet_pool(fake_dynamodb_client).draining_subnets == {"sub-1"}
+    assert sweep_subnet_leases(fake_cloudformation_client, fake_dynamodb_client, now=1100) == {}
 
-    with patch("hpc_provisioner.aws_queries.get_registered_subnets") as mock_get_registered_subnets:
-        mock_get_registered_subnets.return_value = {}
-        with patch("hpc_provisioner.aws_queries.register_subnet") as mock_register_subnet:
-            mock_register_subnet.return_value = None
-            subnet = claim_subnet(mock_dynamodb_client, ec2_subnets, cluster_name)
-    patched_free_subnet.assert_not_called()
-    patched_get_subnet.assert_called_once_with(mock_dynamodb_client, "sub-1")
-    assert subnet == "sub-1"
+
+def test_reclaim_renews_lease(fake_dynamodb_client):
+    seed_subnet_pool(fake_dynamodb_client, free_subnets=["sub-1"])
+    with patch("hpc_provisioner.dynamodb_actions.time.time", return_value=1000):
+        claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster1", lease_seconds=60)
+    with patch("hpc_provisioner.dynamodb_actions.time.time", return_value=2000):
+        assert claim_subnet(fake_dynamodb_client, "cluster1") == "sub-1"
+    assert get_expired_subnet_leases(fake_dynamodb_client, now=1100) == {}
 
 
-def test_no_available_subnets():
+@patch("hpc_provisioner.aws_queries.dynamodb_client")
+@patch("hpc_provisioner.aws_queries.time")
+def test_no_available_subnets(mock_time, patched_dynamodb_client, fake_dynamodb_client):
+    patched_dynamodb_client.return_value = fake_dynamodb_client
     mock_ec2_client = MagicMock()
     mock_ec2_client.describe_subnets.return_value = {"Subnets": []}
     with pytest.raises(OutOfSubnetsException):
@@ -286,36 +441,45 @@ def test_no_available_subnets():
 
 
 @patch("hpc_provisioner.aws_queries.dynamodb_client")
+@patch("hpc_provisioner.aws_queries.reconcile_subnet_pool")
 @patch("hpc_provisioner.aws_queries.claim_subnet", side_effect=OutOfSubnetsException())
 @patch("hpc_provisioner.aws_queries.logger")
 @patch("hpc_provisioner.aws_queries.time")
-def test_out_of_subnets(mock_time, mock_logger, mock_claim_subnet, mock_dynamodb_client):
+def test_out_of_subnets(
+    mock_time, mock_logger, mock_claim_subnet, mock_reconcile_subnet_pool, mock_dynamodb_client
+):
     mock_ec2_client = MagicMock()
-    mock_ec2_client.describe_subnets.return_value = {
-        "Subnets": [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}]
-    }
     with pytest.raises(OutOfSubnetsException):
         get_available_subnet(mock_ec2_client, "cluster1")
-    mock_logger.critical.assert_any_call(
+    mock_logger.warning.assert_any_call(
         "All subnets are in use - either deploy more or remove some pclusters"
     )
-    mock_time.sleep.assert_called_once_with(10)
+    # The creator queues the cluster instead of waiting for a subnet
+    mock_time.sleep.assert_not_called()
+    assert mock_reconcile_subnet_pool.call_count == 1
 
 
 @patch("hpc_provisioner.aws_queries.claim_subnet", return_value="sub-1")
 @patch("hpc_provisioner.aws_queries.dynamodb_client")
 def test_get_available_subnet(mock_dynamodb_client, mock_claim_subnet):
-    ec2_subnets = {"Subnets": [{"SubnetId": "sub-1"}, {"SubnetId": "sub-2"}]}
     cluster_name = "cluster1"
     mock_ec2_client = MagicMock()
-    mock_ec2_client.describe_subnets.return_value = ec2_subnets
     subnet = get_available_subnet(mock_ec2_client, cluster_name)
-    mock_claim_subnet.assert_called_once_with(
-        mock_dynamodb_client(), ec2_subnets["Subnets"], cluster_name
-    )
+    mock_claim_subnet.assert_called_once_with(mock_dynamodb_client(), cluster_name)
+    mock_ec2_client.describe_subnets.assert_not_called()
     assert subnet == "sub-1"
 
 
+@patch("hpc_provisioner.aws_queries.dynamodb_client")
+def test_get_available_subnet_builds_pool(patched_dynamodb_client, fake_dynamodb_client):
+    patched_dynamodb_client.return_value = fake_dynamodb_client
+    mock_ec2_client = MagicMock()
+    mock_ec2_client.describe_subnets.return_value = compute_subnets(sub_1=251)
+    assert get_available_subnet(mock_ec2_client, "cluster1") == "sub-1"
+    assert get_available_subnet(mock_ec2_client, "cluster1") == "sub-1"
+    mock_ec2_client.describe_subnets.assert_called_once()
+
+
 def test_create_keypair(test_cluster):
     mock_ec2_client = MagicMock()
     mock_ec2_client.describe_key_pairs.side_effect = ClientError(
@@ -406,14 +570,144 @@ def test_store_private_key(keypair_exists, secret_exists, test_cluster):
             store_private_key(mock_sm_client, test_cluster, ssh_keypair)
 
 
-@patch("hpc_provisioner.aws_queries.boto3")
-def test_remove_key(patched_boto3):
+@patch("hpc_provisioner.aws_queries.get_client")
+def test_remove_key(patched_get_client):
     test_key_name = "test_keypair"
     patched_ec2_client = MagicMock()
     patched_sm_client = MagicMock()
-    patched_boto3.client.side_effect = [patched_ec2_client, patched_sm_client]
+    patched_get_client.side_effect = lambda x: {
+        "ec2": patched_ec2_client,
+        "secretsmanager": patched_sm_client,
+    }[x]
     remove_key(test_key_name)
     patched_ec2_client.delete_key_pair.assert_called_once_with(KeyName=test_key_name)
     patched_sm_client.delete_secret.assert_called_once_with(
         SecretId=test_key_name, ForceDeleteWithoutRecovery=True
     )
+
+
+@patch("hpc_provisioner.aws_queries.get_client")
+def test_remove_key_missing_secret(patched_get_client):
+    patched_sm_client = MagicMock()
+    patched_sm_client.delete_secret.side_effect = ClientError(
+        {"Error": {"Code": "ResourceNotFoundException", "Message": "not found"}}, "DeleteSecret"
+    )
+    patched_get_client.side_effect = lambda x: {
+        "ec2": MagicMock(),
+        "secretsmanager": patched_sm_client,
+    }[x]
+    remove_key("test_keypair")
+    patched_sm_client.delete_secret.assert_called_once()
+
+
+def test_get_stack_status():
+    mock_cf_client = MagicMock()
+    mock_cf_client.describe_stacks.return_value = {
+        "Stacks": [{"StackName": "pcluster-1", "StackStatus": "CREATE_IN_PROGRESS"}]
+    }
+    assert get_stack_status(mock_cf_client, "pcluster-1") == "CREATE_IN_PROGRESS"
+    assert stack_exists(mock_cf_client, "pcluster-1")
+    mock_cf_client.describe_stacks.assert_called_with(StackName="pcluster-1")
+
+
+def test_get_stack_status_missing_stack():
+    mock_cf_client = MagicMock()
+    mock_cf_client.describe_stacks.side_effect = ClientError(
+        error_response={
+            "Error": {
+                "Code": "ValidationError",
+                "Message": "Stack with id pcluster-1 does not exist",
+            }
+        },
+        operation_name="DescribeStacks",
+    )
+    assert get_stack_status(mock_cf_client, "pcluster-1") is None
+    assert not stack_exists(mock_cf_client, "pcluster-1")
+
+
+def test_get_stack_status_other_error():
+    mock_cf_client = MagicMock()
+    mock_cf_client.describe_stacks.side_effect = ClientError(
+        error_response={"Error": {"Code": "Throttling", "Message": "Rate exceeded"}},
+        operation_name="DescribeStacks",
+    )
+    with pytest.raises(ClientError):
+        get_stack_status(mock_cf_client, "pcluster-1")
+
+
+def fsx_pages():
+    return [
+        {
+            "FileSystems": [
+                {"FileSystemId": "fs-1", "Tags": [{"Key": "Name", "Value": "vlab1-project1"}]},
+                {"FileSystemId": "fs-2", "Tags": [{"Key": "Other", "Value": "vlab2-project2"}]},
+            ],
+            "NextToken": "page2",
+        },
+        {
+            "FileSystems": [
+                {"FileSystemId": "fs-3", "Tags": [{"Key": "Name", "Value": "vlab3-project3"}]},
+            ]
+        },
+    ]
+
+
+@patch("hpc_provisioner.aws_queries.put_fsx_index_entries")
+@patch("hpc_provisioner.aws_queries.get_fsx_index_entry", return_value=None)
+def test_fsx_index_refresh_on_miss(patched_get_entry, patched_put_entries):
+    mock_fsx_client = MagicMock()
+    mock_fsx_client.describe_file_systems.side_effect = fsx_pages()
+    mock_dynamodb_client = MagicMock()
+    index = FsxIndex()
+
+    assert index.lookup(mock_fsx_client, mock_dynamodb_client, "vlab3-project3") == "fs-3"
+    mock_fsx_client.describe_file_systems.assert_has_calls([call(), call(NextToken="page2")])
+    patched_put_entries.assert_called_once()
+    assert patched_put_entries.call_args.args[1] == {
+        "vlab1-project1": "fs-1",
+        "vlab3-project3": "fs-3",
+    }
+
+    # Served from memory from now on, including the other names from the bulk refresh
+    assert index.lookup(mock_fsx_client, mock_dynamodb_client, "vlab1-project1") == "fs-1"
+    assert mock_fsx_client.describe_file_systems.call_count == 2
+    patched_get_entry.assert_called_once()
+
+
+@patch("hpc_provisioner.aws_queries.put_fsx_index_entries")
+@patch("hpc_provisioner.aws_queries.get_fsx_index_entry", return_value=None)
+def test_fsx_index_negative_entry(patched_get_entry, patched_put_entries):
+    mock_fsx_client = MagicMock()
+    mock_fsx_client.describe_file_systems.side_effect = fsx_pages()
+    mock_dynamodb_client = MagicMock()
+    index = FsxIndex()
+
+    assert index.lookup(mock_fsx_client, mock_dynamodb_client, "unknown") is None
+    patched_put_entries.assert_called_with(mock_dynamodb_client, {"unknown": None}, ANY)
+
+    assert index.lookup(mock_fsx_client, mock_dynamodb_client, "unknown") is None
+    assert mock_fsx_client.describe_file_systems.call_count == 2
+
+
+@patch("hpc_provisioner.aws_queries.put_fsx_index_entries")
+@patch("hpc_provisioner.aws_queries.get_fsx_index_entry")
+def test_fsx_index_shared_entry(patched_get_entry, patched_put_entries):
+    mock_fsx_client = MagicMock()
+    mock_dynamodb_client = MagicMock()
+    patched_get_entry.return_value = {"fsx_id": "fs-1", "expires_at": time.time() + 60}
+
+    assert FsxIndex().lookup(mock_fsx_client, mock_dynamodb_client, "vlab1-project1") == "fs-1"
+    patched_get_entry.assert_called_once_with(mock_dynamodb_client, "vlab1-project1")
+    mock_fsx_client.describe_file_systems.assert_not_called()
+    patched_put_entries.assert_not_called()
+
+
+@patch("hpc_provisioner.aws_queries.put_fsx_index_entries")
+@patch("hpc_provisioner.aws_queries.get_fsx_index_entry")
+def test_fsx_index_expired_entry(patched_get_entry, patched_put_entries):
+    mock_fsx_client = MagicMock()
+    mock_fsx_client.describe_file_systems.side_effect = fsx_pages()
+    patched_get_entry.return_value = {"fsx_id": "fs-old", "expires_at": time.time() - 1}
+
+    assert FsxIndex().lookup(mock_fsx_client, MagicMock(), "vlab1-project1") == "fs-1"
+    assert mock_fsx_client.describe_file_systems.call_count == 2
@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from hpc_provisioner.deployment import (
+    DeploymentFacts,
+    DeploymentSettings,
+    InvalidDeploymentSettings,
+    get_deployment_settings,
+)
+
+
+def test_deployment_settings_from_environment():
+    settings = DeploymentSettings.from_environment()
+    assert settings.infra_assets_bucket == "sboinfrastructureassets-test"
+    assert settings.ami_id == "ami-12345"
+    assert settings.create_users_script == "sboinfrastructureassets-test/scripts/create_users.py"
+    assert settings.environment_script == "sboinfrastructureassets-test/scripts/environment.sh"
+
+
+def test_deployment_settings_s3_url(monkeypatch):
+    monkeypatch.setenv("INFRA_ASSETS_BUCKET", "s3://infra-bucket")
+    settings = DeploymentSettings.from_environment()
+    assert settings.infra_assets_bucket_name == "infra-bucket"
+    assert settings.create_users_script == "s3://infra-bucket/scripts/create_users.py"
+
+
+def test_deployment_settings_missing_variables(monkeypatch):
+    monkeypatch.delenv("PCLUSTER_AMI_ID")
+    monkeypatch.delenv("SCRATCH_BUCKET")
+    with pytest.raises(InvalidDeploymentSettings, match="SCRATCH_BUCKET.*PCLUSTER_AMI_ID"):
+        DeploymentSettings.from_environment()
+
+
+def test_get_deployment_settings_is_cached():
+    assert get_deployment_settings() is get_deployment_settings()
+
+
+def test_deployment_settings_are_immutable():
+    with pytest.raises(AttributeError):
+        get_deployment_settings().ami_id = "ami-other"
+
+
+@patch("hpc_provisioner.deployment.get_efs", return_value="efs-123")
+@patch("hpc_provisioner.deployment.get_security_group", return_value="sg-123")
+def test_deployment_facts_are_cached(patched_get_security_group, patched_get_efs):
+    mock_ec2_client = MagicMock()
+    mock_efs_client = MagicMock()
+    facts = DeploymentFacts(ttl=60)
+    for _ in range(3):
+        assert facts.security_group_id(mock_ec2_client) == "sg-123"
+        assert facts.efs_id(mock_efs_client) == "efs-123"
+    patched_get_security_group.assert_called_once_with(mock_ec2_client)
+    patched_get_efs.assert_called_once_with(mock_efs_client)
+
+
+@patch("hpc_provisioner.deployment.get_security_group", side_effect=["sg-123", "sg-234"])
+def test_deployment_facts_invalidate(patched_get_security_group):
+    facts = DeploymentFacts(ttl=60)
+    assert facts.security_group_id(MagicMock()) == "sg-123"
+    facts.invalidate()
+    assert facts.security_group_id(MagicMock()) == "sg-234"
+
+
+@patch("hpc_provisioner.deployment.get_security_group", side_effect=["sg-123", "sg-234"])
+def test_deployment_facts_expire(patched_get_security_group):
+    facts = DeploymentFacts(ttl=0)
+    assert facts.security_group_id(MagicMock()) == "sg-123"
+    assert facts.security_group_id(MagicMock()) == "sg-234"
@@ -1,12 +1,37 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
 
 import pytest
 from hpc_provisioner.dynamodb_actions import (
+    AdmissionRequest,
+    ClusterRecord,
     SubnetAlreadyRegisteredException,
-    free_subnet,
-    get_subnet,
-    register_subnet,
+    SubnetLeaseLostException,
+    SubnetPoolChangedException,
+    TokenBucketChangedException,
+    backfill_cluster_subnets,
+    bind_subnet,
+    claim_free_subnet,
+    get_admission_requests,
+    get_cluster_record,
+    get_cluster_subnets,
+    get_expired_subnet_leases,
+    get_fsx_index_entry,
+    get_registered_subnets,
+    get_subnet_pool,
+    get_token_bucket,
+    put_admission_request,
+    put_cluster_record,
+    put_fsx_index_entries,
+    put_subnet_pool,
+    put_token_bucket,
+    release_subnet,
+    remove_admission_request,
+    renew_subnet_lease,
+    update_cluster_description,
+    update_cluster_stack_status,
+    update_teardown_status,
 )
 
 logger = logging.getLogger("test_logger")
@@ -22,53 +47,341 @@ logger.addHandler(sh)
 logger.setLevel(logging.DEBUG)
 
 
-def test_get_subnet():
-    subnet_id = "sub=1"
-    cluster = "cluster-1"
+def register_legacy_claim(dynamodb_client, subnet_id, cluster):
+    """A claim as written before the subnet pool existed: no state, lease or cluster index"""
+    dynamodb_client.put_item(
+        TableName="sbo-parallelcluster-subnets",
+        Item={"subnet_id": {"S": subnet_id}, "cluster": {"S": cluster}},
+    )
+
+
+@pytest.mark.parametrize("total_segments", [1, 4])
+def test_get_registered_subnets(fake_dynamodb_client, total_segments):
+    fake_dynamodb_client.scan_page_size = 7
+    registered_subnets = {f"sub-{i}": f"cluster-{i % 5}" for i in range(50)}
+    for subnet_id, cluster in registered_subnets.items():
+        register_legacy_claim(fake_dynamodb_client, subnet_id, cluster)
+
+    assert get_registered_subnets(fake_dynamodb_client, total_segments) == registered_subnets
+    assert fake_dynamodb_client.calls.count("scan") >= 50 / 7
+
+
+def test_get_registered_subnets_projection():
     mock_dynamodb_client = MagicMock()
-    mock_dynamodb_client.get_item.return_value = {
-        "Item": {"subnet_id": {"S": subnet_id}, "cluster": {"S": cluster}}
+    mock_dynamodb_client.scan.return_value = {
+        "Items": [{"subnet_id": {"S": "sub-1"}, "cluster": {"S": "cluster-1"}}]
     }
-    result = get_subnet(mock_dynamodb_client, subnet_id=subnet_id)
-    mock_dynamodb_client.get_item.assert_called_once_with(
+    assert get_registered_subnets(mock_dynamodb_client) == {"sub-1": "cluster-1"}
+    mock_dynamodb_client.scan.assert_called_once_with(
         TableName="sbo-parallelcluster-subnets",
-        Key={"subnet_id": {"S": subnet_id}},
+        ProjectionExpression="subnet_id, #c",
+        ExpressionAttributeNames={"#c": "cluster"},
         ConsistentRead=True,
     )
 
-    assert result == {subnet_id: cluster}
 
+def test_claim_free_subnet_concurrently(fake_dynamodb_client):
+    """Many clusters claiming the same subnets at once: each is claimed exactly once"""
+    subnets = [f"sub-{i}" for i in range(8)]
+    put_subnet_pool(fake_dynamodb_client, frozenset(subnets), frozenset(), expected_version=None)
+    fake_dynamodb_client.latency = 0.001
 
-def test_register_subnet_already_registered():
-    subnet_id = "sub-1"
-    cluster = "cluster-1"
-    mock_dynamodb_client = MagicMock()
+    def claim(cluster):
+        claimed = []
+        for subnet_id in subnets:
+            try:
+                claim_free_subnet(fake_dynamodb_client, subnet_id, cluster)
+            except SubnetAlreadyRegisteredException:
+                continue
+            claimed.append(subnet_id)
+        return claimed
+
+    clusters = [f"cluster-{i}" for i in range(32)]
+    with ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        claims = dict(zip(clusters, executor.map(claim, clusters)))
+
+    winners = {subnet_id: cluster for cluster, claimed in claims.items() for subnet_id in claimed}
+    assert sum(len(claimed) for claimed in claims.values()) == len(subnets)
+    assert get_registered_subnets(fake_dynamodb_client) == winners
+    assert get_subnet_pool(fake_dynamodb_client).free_subnets == frozenset()
+
+
+def test_put_subnet_pool_concurrent_change(fake_dynamodb_client):
+    put_subnet_pool(fake_dynamodb_client, frozenset(["sub-1"]), frozenset(), expected_version=None)
+    with pytest.raises(SubnetPoolChangedException):
+        put_subnet_pool(fake_dynamodb_client, frozenset(), frozenset(), expected_version=None)
+
+    pool = get_subnet_pool(fake_dynamodb_client)
+    claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster-1")
+    with pytest.raises(SubnetPoolChangedException):
+        put_subnet_pool(
+            fake_dynamodb_client, frozenset(["sub-1"]), frozenset(), expected_version=pool.version
+        )
+    assert get_subnet_pool(fake_dynamodb_client).free_subnets == frozenset()
+
+
+def test_claim_free_subnet_not_in_pool(fake_dynamodb_client):
+    put_subnet_pool(fake_dynamodb_client, frozenset(["sub-1"]), frozenset(), expected_version=None)
     with pytest.raises(SubnetAlreadyRegisteredException):
-        with patch(
-            "hpc_provisioner.dynamodb_actions.get_subnet", return_value={subnet_id: cluster}
-        ) as mock_get_subnet:
-            register_subnet(mock_dynamodb_client, subnet_id, cluster)
-            mock_get_subnet.assert_called_once_with(mock_dynamodb_client, subnet_id)
+        claim_free_subnet(fake_dynamodb_client, "sub-2", "cluster-1")
+    assert "sub-2" not in get_registered_subnets(fake_dynamodb_client)
+
+
+def test_backfill_cluster_subnets(fake_dynamodb_client):
+    put_subnet_pool(fake_dynamodb_client, frozenset(["sub-3"]), frozenset(), expected_version=None)
+    claim_free_subnet(fake_dynamodb_client, "sub-3", "cluster-2")
+    registered_subnets = {"sub-1": "cluster-1", "sub-2": "cluster-1", "sub-4": "cluster-2"}
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster-1") is None
 
+    assert backfill_cluster_subnets(fake_dynamodb_client, registered_subnets) == ["cluster-1"]
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster-1") == {"sub-1", "sub-2"}
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster-2") == {"sub-3"}
+    assert backfill_cluster_subnets(fake_dynamodb_client, registered_subnets) == []
 
-@patch("hpc_provisioner.dynamodb_actions.get_subnet", return_value=None)
-def test_register_subnet(mock_get_subnet):
-    subnet_id = "sub-1"
-    cluster = "cluster-1"
+
+def test_release_subnet_updates_cluster_index(fake_dynamodb_client):
+    put_subnet_pool(
+        fake_dynamodb_client, frozenset(["sub-1", "sub-2"]), frozenset(), expected_version=None
+    )
+    claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster-1")
+    claim_free_subnet(fake_dynamodb_client, "sub-2", "cluster-1")
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster-1") == {"sub-1", "sub-2"}
+    release_subnet(fake_dynamodb_client, "sub-1", "cluster-1")
+    assert get_cluster_subnets(fake_dynamodb_client, "cluster-1") == {"sub-2"}
+
+
+def test_subnet_lease(fake_dynamodb_client):
+    put_subnet_pool(
+        fake_dynamodb_client, frozenset(["sub-1", "sub-2"]), frozenset(), expected_version=None
+    )
+    with patch("hpc_provisioner.dynamodb_actions.time.time", return_value=1000):
+        claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster-1", lease_seconds=60)
+        claim_free_subnet(fake_dynamodb_client, "sub-2", "cluster-2", lease_seconds=60)
+    claim = fake_dynamodb_client.get_item(
+        TableName="sbo-parallelcluster-subnets", Key={"subnet_id": {"S": "sub-1"}}
+    )["Item"]
+    assert claim["state"] == {"S": "reserved"}
+    assert claim["lease_expires"] == {"N": "1060"}
+    register_legacy_claim(fake_dynamodb_client, "sub-3", "cluster-3")
+
+    assert get_expired_subnet_leases(fake_dynamodb_client, now=1060) == {}
+    assert get_expired_subnet_leases(fake_dynamodb_client, now=1061) == {
+        "sub-1": "cluster-1",
+        "sub-2": "cluster-2",
+    }
+
+    bind_subnet(fake_dynamodb_client, "sub-1", "cluster-1")
+    with patch("hpc_provisioner.dynamodb_actions.time.time", return_value=1100):
+        renew_subnet_lease(fake_dynamodb_client, "sub-1", "cluster-1", lease_seconds=60)
+        renew_subnet_lease(fake_dynamodb_client, "sub-2", "cluster-2", lease_seconds=60)
+    claim = fake_dynamodb_client.get_item(
+        TableName="sbo-parallelcluster-subnets", Key={"subnet_id": {"S": "sub-1"}}
+    )["Item"]
+    assert claim["state"] == {"S": "bound"}
+    assert "lease_expires" not in claim
+    assert get_expired_subnet_leases(fake_dynamodb_client, now=1061) == {}
+    assert get_expired_subnet_leases(fake_dynamodb_client, now=1161) == {"sub-2": "cluster-2"}
+
+
+def test_release_expired_subnet(fake_dynamodb_client):
+    put_subnet_pool(fake_dynamodb_client, frozenset(["sub-1"]), frozenset(), expected_version=None)
+    with patch("hpc_provisioner.dynamodb_actions.time.time", return_value=1000):
+        claim_free_subnet(fake_dynamodb_client, "sub-1", "cluster-1", lease_seconds=60)
+    assert not release_subnet(fake_dynamodb_client, "sub-1", "cluster-1", expired_before=1060)
+    assert release_subnet(fake_dynamodb_client, "sub-1", "cluster-1", expired_before=1061)
+    assert "sub-1" not in get_registered_subnets(fake_dynamodb_client)
+
+
+def test_bind_released_subnet(fake_dynamodb_client):
+    with pytest.raises(SubnetLeaseLostException):
+        bind_subnet(fake_dynamodb_client, "sub-1", "cluster-1")
+
+
+@pytest.mark.parametrize(
+    "item,expected",
+    [
+        (None, None),
+        (
+            {"fsx_name": {"S": "fsx-1"}, "fsx_id": {"S": "fs-1"}, "expires_at": {"N": "100"}},
+            {"fsx_id": "fs-1", "expires_at": 100},
+        ),
+        (
+            {"fsx_name": {"S": "fsx-1"}, "expires_at": {"N": "100"}},
+            {"fsx_id": None, "expires_at": 100},
+        ),
+    ],
+)
+def test_get_fsx_index_entry(item, expected):
     mock_dynamodb_client = MagicMock()
-    register_subnet(mock_dynamodb_client, subnet_id, cluster)
-    mock_get_subnet.assert_called_once_with(mock_dynamodb_client, subnet_id)
-    mock_dynamodb_client.update_item.assert_called_once_with(
-        TableName="sbo-parallelcluster-subnets",
-        Key={"subnet_id": {"S": subnet_id}},
-        AttributeUpdates={"cluster": {"Value": {"S": cluster}}},
+    mock_dynamodb_client.get_item.return_value = {"Item": item} if item else {}
+    assert get_fsx_index_entry(mock_dynamodb_client, "fsx-1") == expected
+    mock_dynamodb_client.get_item.assert_called_once_with(
+        TableName="sbo-parallelcluster-fsx", Key={"fsx_name": {"S": "fsx-1"}}
     )
 
 
-def test_free_subnet():
-    subnet_id = "sub-1"
+def test_put_fsx_index_entries():
+    entries = {f"fsx-{i}": f"fs-{i}" for i in range(30)}
+    entries["missing"] = None
     mock_dynamodb_client = MagicMock()
-    free_subnet(mock_dynamodb_client, subnet_id)
-    mock_dynamodb_client.delete_item.assert_called_once_with(
-        TableName="sbo-parallelcluster-subnets", Key={"subnet_id": {"S": subnet_id}}
+    unprocessed = {"sbo-parallelcluster-fsx": [{"PutRequest": {"Item": {}}}]}
+    mock_dynamodb_client.batch_write_item.side_effect = [
+        {"UnprocessedItems": unprocessed},
+        {},
+        {},
+    ]
+    put_fsx_index_entries(mock_dynamodb_client, entries, expires_at=100)
+
+    calls = mock_dynamodb_client.batch_write_item.call_args_list
+    assert len(calls) == 3
+    first_batch = calls[0].kwargs["RequestItems"]["sbo-parallelcluster-fsx"]
+    assert len(first_batch) == 25
+    assert first_batch[0]["PutRequest"]["Item"] == {
+        "fsx_name": {"S": "fsx-0"},
+        "fsx_id": {"S": "fs-0"},
+        "expires_at": {"N": "100"},
+    }
+    assert calls[1].kwargs["RequestItems"] == unprocessed
+    last_batch = calls[2].kwargs["RequestItems"]["sbo-parallelcluster-fsx"]
+    assert len(last_batch) == 6
+    assert last_batch[-1]["PutRequest"]["Item"] == {
+        "fsx_name": {"S": "missing"},
+        "expires_at": {"N": "100"},
+    }
+
+
+def test_admission_queue(fake_dynamodb_client):
+    fake_dynamodb_client.scan_page_size = 2
+    requests = [
+        AdmissionRequest(f"pcluster-vlab-{i}", "vlab", f'{{"project_id": "{i}"}}', i)
+        for i in range(5)
+    ]
+    for request in requests:
+        assert put_admission_request(fake_dynamodb_client, request)
+    # Queueing a cluster again keeps its original position
+    assert not put_admission_request(
+        fake_dynamodb_client, AdmissionRequest("pcluster-vlab-0", "vlab", "{}", 10)
+    )
+    assert sorted(get_admission_requests(fake_dynamodb_client), key=lambda r: r.enqueued_at) == (
+        requests
+    )
+    assert remove_admission_request(fake_dynamodb_client, "pcluster-vlab-0")
+    assert not remove_admission_request(fake_dynamodb_client, "pcluster-vlab-0")
+    assert len(get_admission_requests(fake_dynamodb_client)) == 4
+
+
+def test_token_bucket(fake_dynamodb_client):
+    assert get_token_bucket(fake_dynamodb_client, "ec2") is None
+    put_token_bucket(fake_dynamodb_client, "ec2", 12.5, 1700000000.25, expected_version=None)
+    bucket = get_token_bucket(fake_dynamodb_client, "ec2")
+    assert (bucket.tokens, bucket.refilled_at, bucket.version) == (12.5, 1700000000.25, 1)
+    with pytest.raises(TokenBucketChangedException):
+        put_token_bucket(fake_dynamodb_client, "ec2", 0, 1700000001, expected_version=None)
+    put_token_bucket(fake_dynamodb_client, "ec2", -3.0, 1700000001, expected_version=1)
+    with pytest.raises(TokenBucketChangedException):
+        put_token_bucket(fake_dynamodb_client, "ec2", 0, 1700000002, expected_version=1)
+    assert get_token_bucket(fake_dynamodb_client, "ec2").tokens == -3.0
+
+
+def test_cluster_record(fake_dynamodb_client):
+    assert get_cluster_record(fake_dynamodb_client, "pcluster-a") is None
+    description = ClusterRecord(
+        cluster="pcluster-a",
+        vlab_id="vlab",
+        project_id="project",
+        cluster_status="CREATE_COMPLETE",
+        head_node_ip="172.32.12.104",
+        creation_time="2024-06-04T09:26:29.320Z",
+        refreshed_at=1700000000,
+    )
+    update_cluster_description(fake_dynamodb_client, description)
+    assert get_cluster_record(fake_dynamodb_client, "pcluster-a") == description
+
+    # The description is kept apart from the teardown
+    update_teardown_status(
+        fake_dynamodb_client, "pcluster-a", "DELETE_IN_PROGRESS", new_attempt=True
+    )
+    update_cluster_description(
+        fake_dynamodb_client,
+        ClusterRecord("pcluster-a", "vlab", "project", refreshed_at=1700000001),
+    )
+    record = get_cluster_record(fake_dynamodb_client, "pcluster-a")
+    assert (record.teardown_status, record.attempts) == ("DELETE_IN_PROGRESS", 1)
+    assert (record.cluster_status, record.head_node_ip, record.refreshed_at) == (
+        None,
+        None,
+        1700000001,
+    )
+
+    # Changing the teardown makes the description stale
+    update_cluster_description(fake_dynamodb_client, description)
+    update_teardown_status(
+        fake_dynamodb_client, "pcluster-a", "DELETE_FAILED", failed_steps={"a": "RuntimeError: a"}
+    )
+    record = get_cluster_record(fake_dynamodb_client, "pcluster-a")
+    assert (record.cluster_status, record.refreshed_at) == ("CREATE_COMPLETE", 0)
+    assert record.failed_steps == {"a": "RuntimeError: a"}
+
+    put_cluster_record(
+        fake_dynamodb_client,
+        ClusterRecord("pcluster-a", "vlab", "project", teardown_status="DELETE_REQUEST_RECEIVED"),
+    )
+    assert get_cluster_record(fake_dynamodb_client, "pcluster-a") == ClusterRecord(
+        "pcluster-a", "vlab", "project", teardown_status="DELETE_REQUEST_RECEIVED"
+    )
+
+
+def test_put_cluster_record_keeps_teardown(fake_dynamodb_client):
+    created = ClusterRecord("pcluster-a", "vlab", "project")
+    # The teardown of a previous cluster with the same name is replaced
+    put_cluster_record(
+        fake_dynamodb_client,
+        ClusterRecord(
+            "pcluster-a", "vlab", "project", teardown_status="DELETE_COMPLETE", updated_at=1000
+        ),
+    )
+    assert put_cluster_record(fake_dynamodb_client, created, keep_teardown_since=2000)
+    assert get_cluster_record(fake_dynamodb_client, "pcluster-a") == created
+
+    # The teardown of this one, requested while it was being created, is kept
+    teardown = ClusterRecord(
+        "pcluster-a", "vlab", "project", teardown_status="DELETE_REQUEST_RECEIVED", updated_at=2001
+    )
+    put_cluster_record(fake_dynamodb_client, teardown)
+    assert not put_cluster_record(fake_dynamodb_client, created, keep_teardown_since=2000)
+    assert get_cluster_record(fake_dynamodb_client, "pcluster-a") == teardown
+
+
+def test_cluster_stack_status(fake_dynamodb_client):
+    # Only clusters with a record are followed
+    assert not update_cluster_stack_status(
+        fake_dynamodb_client, "pcluster-a", "CREATE_IN_PROGRESS", 1700000000
+    )
+    assert get_cluster_record(fake_dynamodb_client, "pcluster-a") is None
+
+    put_cluster_record(fake_dynamodb_client, ClusterRecord("pcluster-a", "vlab", "project"))
+    assert update_cluster_stack_status(
+        fake_dynamodb_client, "pcluster-a", "CREATE_IN_PROGRESS", 1700000000
+    )
+    description = ClusterRecord(
+        "pcluster-a",
+        "vlab",
+        "project",
+        cluster_status="CREATE_IN_PROGRESS",
+        refreshed_at=1700000010,
+    )
+    assert update_cluster_description(fake_dynamodb_client, description)
+    assert update_cluster_stack_status(
+        fake_dynamodb_client, "pcluster-a", "CREATE_COMPLETE", 1700000020
+    )
+    # Out of order events, and descriptions older than the last event, are not stored
+    assert not update_cluster_stack_status(
+        fake_dynamodb_client, "pcluster-a", "CREATE_IN_PROGRESS", 1700000000
+    )
+    assert not update_cluster_description(fake_dynamodb_client, description)
+    record = get_cluster_record(fake_dynamodb_client, "pcluster-a")
+    assert (record.cluster_status, record.refreshed_at, record.stack_event_at) == (
+        "CREATE_COMPLETE",
+        0,
+        1700000020,
     )
@@ -0,0 +1,20 @@
+import json
+import subprocess
+import sys
+
+# Importing the handlers used to take well over a second because pcluster was pulled in
+# at module level. Check that it is still only loaded when a handler needs it.
+LIST_PCLUSTER_MODULES = """
+import json
+import sys
+
+import hpc_provisioner.handlers
+print(json.dumps([m for m in sys.modules if m == "pcluster" or m.startswith("pcluster.")]))
+"""
+
+
+def test_handlers_import_does_not_load_pcluster():
+    result = subprocess.run(
+        [sys.executable, "-c", LIST_PCLUSTER_MODULES], capture_output=True, check=True, text=True
+    )
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == []
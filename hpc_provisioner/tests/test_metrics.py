@@ -0,0 +1,84 @@
+import json
+from unittest.mock import patch
+
+from hpc_provisioner import handlers
+from hpc_provisioner.metrics import (
+    METRICS_NAMESPACE,
+    TOTAL_PHASE,
+    current_metrics,
+    request_metrics,
+    timed,
+)
+
+
+def test_timed_outside_request():
+    with timed("lonely_phase"):
+        pass
+    assert current_metrics() is None
+
+
+@patch("hpc_provisioner.metrics.metrics_logger")
+def test_request_metrics(patched_metrics_logger):
+    with request_metrics("GET /hpc-provisioner/pcluster") as metrics:
+        with timed("describe_cluster"):
+            pass
+        with timed("create_keypair"):
+            pass
+        with timed("create_keypair"):
+            pass
+        assert current_metrics() is metrics
+    assert current_metrics() is None
+
+    assert set(metrics.phases) == {"describe_cluster", "create_keypair"}
+    patched_metrics_logger.info.assert_called_once()
+    emf = json.loads(patched_metrics_logger.info.call_args.args[0])
+    directive = emf["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == METRICS_NAMESPACE
+    assert directive["Dimensions"] == [["Endpoint"]]
+    assert {m["Name"] for m in directive["Metrics"]} == {
+        "describe_cluster",
+        "create_keypair",
+        TOTAL_PHASE,
+    }
+    assert emf["Endpoint"] == "GET /hpc-provisioner/pcluster"
+    assert emf[TOTAL_PHASE] >= emf["describe_cluster"]
+
+
+@patch("hpc_provisioner.metrics.metrics_logger")
+def test_request_metrics_emitted_on_error(patched_metrics_logger):
+    try:
+        with request_metrics("DELETE /hpc-provisioner/pcluster"):
+            with timed("delete_cluster"):
+                raise RuntimeError()
+    except RuntimeError:
+        pass
+    emf = json.loads(patched_metrics_logger.info.call_args.args[0])
+    assert "delete_cluster" in emf
+
+
+@patch("hpc_provisioner.handlers.dynamodb_client")
+@patch("hpc_provisioner.handlers.update_cluster_description")
+@patch("hpc_provisioner.handlers.get_cluster_record", return_value=None)
+@patch("hpc_provisioner.handlers.get_client")
+@patch("hpc_provisioner.handlers.get_fsx_id", return_value=None)
+@patch("hpc_provisioner.handlers.pcluster_describe", return_value={"clusterStatus": "CREATING"})
+def test_server_timing_header(
+    patched_describe,
+    patched_get_fsx,
+    patched_get_client,
+    patched_get_cluster_record,
+    patched_update_cluster_description,
+    patched_dynamodb_client,
+    get_event,
+):
+    response = handlers.pcluster_handler(get_event)
+    server_timing = response["headers"]["Server-Timing"]
+    phases = [entry.split(";")[0] for entry in server_timing.split(", ")]
+    assert phases == [
+        "get_cluster_record",
+        "describe_cluster",
+        "get_fsx",
+        "update_cluster_record",
+        TOTAL_PHASE,
+    ]
+    assert all(";dur=" in entry for entry in server_timing.split(", "))
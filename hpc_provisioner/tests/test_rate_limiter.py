@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from hpc_provisioner.dynamodb_actions import get_token_bucket
+from hpc_provisioner.metrics import request_metrics
+from hpc_provisioner.rate_limiter import (
+    RATE_LIMITS,
+    RateLimitExceededException,
+    acquire_tokens,
+    refund_tokens,
+    reserve_tokens,
+)
+
+NOW = 1_700_000_000.0
+
+
+def test_reserve_tokens_within_capacity(fake_dynamodb_client):
+    capacity = RATE_LIMITS["ec2"].capacity
+    assert reserve_tokens(fake_dynamodb_client, "ec2", 20, now=NOW) == 0
+    assert reserve_tokens(fake_dynamodb_client, "ec2", capacity - 20, now=NOW) == 0
+    bucket = get_token_bucket(fake_dynamodb_client, "ec2")
+    assert bucket.tokens == 0
+    assert bucket.refilled_at == NOW
+
+
+def test_reserve_tokens_in_debt(fake_dynamodb_client):
+    limit = RATE_LIMITS["cloudformation"]
+    reserve_tokens(fake_dynamodb_client, "cloudformation", limit.capacity, now=NOW)
+    assert reserve_tokens(fake_dynamodb_client, "cloudformation", 3, now=NOW) == 3 / limit.rate
+    # The next creator waits for the debt of the previous one too
+    assert reserve_tokens(fake_dynamodb_client, "cloudformation", 3, now=NOW) == 6 / limit.rate
+
+
+def test_reserve_tokens_refill(fake_dynamodb_client):
+    limit = RATE_LIMITS["ec2"]
+    reserve_tokens(fake_dynamodb_client, "ec2", limit.capacity, now=NOW)
+    assert reserve_tokens(fake_dynamodb_client, "ec2", limit.rate, now=NOW + 1) == 0
+    # The bucket never refills beyond its capacity
+    assert reserve_tokens(fake_dynamodb_client, "ec2", limit.capacity, now=NOW + 3600) == 0
+    assert reserve_tokens(fake_dynamodb_client, "ec2", limit.rate, now=NOW + 3600) == 1
+
+
+def test_reserve_tokens_max_wait(fake_dynamodb_client):
+    limit = RATE_LIMITS["cloudformation"]
+    reserve_tokens(fake_dynamodb_client, "cloudformation", limit.capacity, now=NOW)
+    with pytest.raises(RateLimitExceededException):
+        reserve_tokens(fake_dynamodb_client, "cloudformation", 10 * limit.rate, now=NOW, max_wait=5)
+    # Nothing was reserved
+    assert get_token_bucket(fake_dynamodb_client, "cloudformation").tokens == 0
+
+
+def test_reserve_tokens_concurrently(fake_dynamodb_client):
+    """Creators racing for the same bucket each get their own place in line"""
+    fake_dynamodb_client.latency = 0.001
+    limit = RATE_LIMITS["cloudformation"]
+    creators = 8
+    with ThreadPoolExecutor(max_workers=creators) as executor:
+        waits = list(
+            executor.map(
+                lambda _: reserve_tokens(fake_dynamodb_client, "cloudformation", 3, now=NOW),
+                range(creators),
+            )
+        )
+    expected = [max(3 * (i + 1) - limit.capacity, 0) / limit.rate for i in range(creators)]
+    assert sorted(waits) == expected
+
+
+def test_acquire_tokens(fake_dynamodb_client):
+    mock_sleep = MagicMock()
+    costs = {"cloudformation": RATE_LIMITS["cloudformation"].capacity + 2, "ec2": 1}
+    with patch("hpc_provisioner.rate_limiter.time.time", return_value=NOW):
+        with request_metrics("creator") as metrics:
+            assert acquire_tokens(fake_dynamodb_client, costs, sleep=mock_sleep) == 2.0
+    mock_sleep.assert_called_once_with(2.0)
+    assert "rate_limit_wait" in metrics.phases
+    assert "reserve_tokens" in metrics.phases
+
+
+def test_acquire_tokens_without_wait(fake_dynamodb_client):
+    mock_sleep = MagicMock()
+    assert acquire_tokens(fake_dynamodb_client, {"ec2": 1}, sleep=mock_sleep) == 0
+    mock_sleep.assert_not_called()
+
+
+def test_acquire_tokens_refunds_when_over_budget(fake_dynamodb_client):
+    """A create that fails on its second service does not leave the first one drained"""
+    mock_sleep = MagicMock()
+    reserve_tokens(fake_dynamodb_client, "cloudformation", 1000, now=NOW, max_wait=float("inf"))
+    costs = {"ec2": RATE_LIMITS["ec2"].capacity, "cloudformation": 1}
+    with patch("hpc_provisioner.rate_limiter.time.time", return_value=NOW):
+        with pytest.raises(RateLimitExceededException):
+            acquire_tokens(fake_dynamodb_client, costs, sleep=mock_sleep)
+    mock_sleep.assert_not_called()
+    assert get_token_bucket(fake_dynamodb_client, "ec2").tokens == RATE_LIMITS["ec2"].capacity
+    # The next creator gets the ec2 tokens without waiting
+    assert reserve_tokens(fake_dynamodb_client, "ec2", 1, now=NOW) == 0
+
+
+def test_refund_tokens(fake_dynamodb_client):
+    limit = RATE_LIMITS["cloudformation"]
+    reserve_tokens(fake_dynamodb_client, "cloudformation", limit.capacity + 3, now=NOW)
+    refund_tokens(fake_dynamodb_client, "cloudformation", 3, now=NOW)
+    assert get_token_bucket(fake_dynamodb_client, "cloudformation").tokens == 0
+    # The bucket never refills beyond its capacity
+    refund_tokens(fake_dynamodb_client, "cloudformation", 100, now=NOW)
+    assert get_token_bucket(fake_dynamodb_client, "cloudformation").tokens == limit.capacity
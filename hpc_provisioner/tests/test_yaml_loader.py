@@ -0,0 +1,134 @@
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+
+from hpc_provisioner.constants import PCLUSTER_CONFIG_TPL, PCLUSTER_DEV_CONFIG_TPL
+from hpc_provisioner.pcluster_manager import load_pcluster_config
+from hpc_provisioner.yaml_loader import (
+    RenderContext,
+    compile_template,
+    load_yaml_extended,
+    render_template,
+)
+
+
+def render_context(cluster_name: str, subnet_id: str) -> RenderContext:
+    return RenderContext(
+        {
+            "base_subnet_id": subnet_id,
+            "base_security_group_id": "sg-123",
+            "efs_id": "fs-123",
+            "ssh_key": cluster_name,
+            "sbonexusdata_bucket": "s3://sbonexusdata-test",
+            "containers_bucket": "s3://containers-test",
+            "fsx_policy_arn": "arn:aws:iam::123456:policy/fsx_policy",
+            "efa_security_group_id": "sg-234",
+            "environment_args": [cluster_name],
+            "ami_id": "ami-12345",
+            "infra_assets_bucket": "infra-test",
+            "create_users_script": "s3://infra-test/scripts/create_users.py",
+            "environment_script": "s3://infra-test/scripts/environment.sh",
+            "lustre_name": cluster_name,
+            "scratch_bucket": "s3://scratch-test",
+            "create_users_args": ["--vlab-id=vlab"],
+            "projects_fsx": {"FileSystemId": "fs-projects"},
+            "scratch_fsx": {"FileSystemId": "fs-scratch"},
+        }
+    )
+
+
+def test_render_context_is_immutable():
+    environment_args = ["pcluster-1"]
+    context = RenderContext({"environment_args": environment_args})
+    environment_args.append("changed")
+    context["environment_args"].append("changed")
+    assert context["environment_args"] == ["pcluster-1"]
+    with pytest.raises(TypeError):
+        context["environment_args"] = []
+
+
+def test_load_pcluster_config():
+    config = load_pcluster_config(False, render_context("pcluster-1", "subnet-1"))
+    assert config["HeadNode"]["Networking"]["SubnetId"] == "subnet-1"
+    assert config["HeadNode"]["Ssh"]["KeyName"] == "pcluster-1"
+    assert config["SharedStorage"][0]["EfsSettings"]["FileSystemId"] == "fs-123"
+    assert all(
+        queue["Networking"]["SubnetIds"] == ["subnet-1"]
+        for queue in config["Scheduling"]["SlurmQueues"]
+    )
+
+
+def test_render_configs_concurrently():
+    """Each cluster's config only ever contains its own values"""
+    clusters = {f"pcluster-{i}": f"subnet-{i}" for i in range(16)}
+
+    def render(cluster_name):
+        return load_pcluster_config(False, render_context(cluster_name, clusters[cluster_name]))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        configs = dict(zip(clusters, executor.map(render, clusters)))
+
+    for cluster_name, config in configs.items():
+        assert config["HeadNode"]["Networking"]["SubnetId"] == clusters[cluster_name]
+        assert config["HeadNode"]["Ssh"]["KeyName"] == cluster_name
+        sequence = config["HeadNode"]["CustomActions"]["OnNodeConfigured"]["Sequence"]
+        assert sequence[1]["Args"] == [cluster_name]
+
+
+def load_uncompiled(path: str, context: RenderContext):
+    with open(path, "r") as f:
+        return load_yaml_extended(f, context)
+
+
+@pytest.mark.parametrize("path", [PCLUSTER_CONFIG_TPL, PCLUSTER_DEV_CONFIG_TPL])
+def test_compiled_template_matches_loader(path):
+    context = render_context("pcluster-1", "subnet-1")
+    assert render_template(compile_template(path), context) == load_uncompiled(path, context)
+
+
+def test_compiled_template_is_not_modified_by_rendering():
+    template = compile_template(PCLUSTER_CONFIG_TPL)
+    assert compile_template(PCLUSTER_CONFIG_TPL) is template
+    config = render_template(template, render_context("pcluster-1", "subnet-1"))
+    config["HeadNode"]["Networking"]["SubnetId"] = "changed"
+    config["Scheduling"]["SlurmQueues"].clear()
+    assert render_template(template, render_context("pcluster-2", "subnet-2")) == (
+        load_uncompiled(PCLUSTER_CONFIG_TPL, render_context("pcluster-2", "subnet-2"))
+    )
+
+
+def test_missing_config_value():
+    with pytest.raises(KeyError):
+        render_template(compile_template(PCLUSTER_CONFIG_TPL), RenderContext({}))
+
+
+def allocated_bytes(fn) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_render_does_not_parse_templates():
+    """Once compiled, a template is rendered for every cluster without reading YAML again"""
+    compile_template(PCLUSTER_CONFIG_TPL)
+    with patch("hpc_provisioner.yaml_loader.open") as patched_open:
+        with patch("hpc_provisioner.yaml_loader.TemplateLoader") as patched_template_loader:
+            for i in range(3):
+                load_pcluster_config(False, render_context(f"pcluster-{i}", f"subnet-{i}"))
+    patched_open.assert_not_called()
+    patched_template_loader.assert_not_called()
+
+
+def test_render_allocates_less_than_parsing():
+    context = render_context("pcluster-1", "subnet-1")
+    compile_template(PCLUSTER_CONFIG_TPL)
+    uncompiled_bytes = allocated_bytes(lambda: load_uncompiled(PCLUSTER_CONFIG_TPL, context))
+    compiled_bytes = allocated_bytes(
+        lambda: render_template(compile_template(PCLUSTER_CONFIG_TPL), context)
+    )
+    assert compiled_bytes < uncompiled_bytes / 2
@@ -1,4 +1,8 @@
 from hpc_provisioner import handlers
+from hpc_provisioner.deployment import get_deployment_settings
+
+# Fail at cold start, rather than halfway through a create, if the environment is incomplete
+get_deployment_settings()
 
 
 def lambda_handler(event, _context=None):
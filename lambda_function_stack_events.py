@@ -0,0 +1,5 @@
+from hpc_provisioner import handlers
+
+
+def lambda_handler(event, _context=None):
+    return handlers.stack_event_handler(event, _context)